@@ -0,0 +1,182 @@
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpRequest, HttpResponse
+
+# Per request performance numbers: queries, SQL time, the slowest query and
+# named timings such as template rendering or cart resolution. Requests are
+# only measured when they get a Server-Timing header or are sampled for the
+# log, everyone else pays for one context variable lookup per query.
+logger = logging.getLogger("teashop.performance")
+
+_current_metrics: ContextVar[Optional["RequestMetrics"]] = ContextVar(
+    "request_metrics", default=None
+)
+
+
+class RequestMetrics:
+    def __init__(self, log_sampled: bool = False) -> None:
+        self.log_sampled = log_sampled
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.slowest_sql: Optional[str] = None
+        self.slowest_time = 0.0
+        self.timings: dict[str, float] = {}
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.queries += 1
+            self.db_time += duration
+            if duration >= self.slowest_time:
+                self.slowest_sql, self.slowest_time = sql, duration
+
+    def add_timing(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def get_server_timing(self, total: float) -> str:
+        # durations only, SQL doesn't leave the server
+        metrics = [
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries"',
+            f"db-slowest;dur={self.slowest_time * 1000:.2f}",
+            *(
+                f"{name};dur={seconds * 1000:.2f}"
+                for name, seconds in self.timings.items()
+            ),
+            f"total;dur={total * 1000:.2f}",
+        ]
+        return ", ".join(metrics)
+
+    def get_log_record(
+        self, request: HttpRequest, response: HttpResponse, total: float
+    ) -> dict:
+        return {
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "total_ms": round(total * 1000, 2),
+            "queries": self.queries,
+            "db_ms": round(self.db_time * 1000, 2),
+            "slowest_query_ms": round(self.slowest_time * 1000, 2),
+            # placeholders only, parameters are never logged
+            "slowest_query": (self.slowest_sql or "")[:500],
+            **{
+                f"{name}_ms": round(seconds * 1000, 2)
+                for name, seconds in self.timings.items()
+            },
+        }
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    if (metrics := _current_metrics.get()) is None:
+        return execute(sql, params, many, context)
+    return metrics.execute(execute, sql, params, many, context)
+
+
+def install_execute_wrapper(sender, connection, **kwargs) -> None:
+    # on every connection, so queries of async views, which run in other
+    # threads, and of every database alias are counted too. First in line,
+    # `connection.execute_wrapper()` blocks pop the last one when they end.
+    if execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, execute_wrapper)
+
+
+@contextmanager
+def timed(name: str):
+    # adds the block's duration to the request's timings, if it is measured
+    if (metrics := _current_metrics.get()) is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_timing(name, time.perf_counter() - started)
+
+
+class PerformanceMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # a sync hook would cost every template response a thread hop
+            self.process_template_response = self.aprocess_template_response
+        connection_created.connect(
+            install_execute_wrapper, dispatch_uid="teashop.performance"
+        )
+        for connection in connections.all(initialized_only=True):
+            install_execute_wrapper(None, connection)
+
+    def start(self) -> Optional[RequestMetrics]:
+        log_sampled = random.random() < settings.PERFORMANCE_LOG_SAMPLE_RATE
+        if not (settings.PERFORMANCE_SERVER_TIMING or log_sampled):
+            return None
+        return RequestMetrics(log_sampled)
+
+    def finish(
+        self, request: HttpRequest, response: HttpResponse, metrics: RequestMetrics
+    ) -> None:
+        total = time.perf_counter() - metrics.started
+        if settings.PERFORMANCE_SERVER_TIMING:
+            response["Server-Timing"] = metrics.get_server_timing(total)
+        if metrics.log_sampled:
+            logger.info(json.dumps(metrics.get_log_record(request, response, total)))
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.async_mode:
+            return self.__acall__(request)
+        if (metrics := self.start()) is None:
+            return self.get_response(request)
+        token = _current_metrics.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        self.finish(request, response, metrics)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        if (metrics := self.start()) is None:
+            return await self.get_response(request)
+        token = _current_metrics.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        self.finish(request, response, metrics)
+        return response
+
+    def process_template_response(
+        self, request: HttpRequest, response: HttpResponse
+    ) -> HttpResponse:
+        # the handler renders template responses right after this
+        if (metrics := _current_metrics.get()) is not None and not response.is_rendered:
+            started = time.perf_counter()
+
+            def rendered(response) -> None:
+                metrics.add_timing("template", time.perf_counter() - started)
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    async def aprocess_template_response(
+        self, request: HttpRequest, response: HttpResponse
+    ) -> HttpResponse:
+        return PerformanceMiddleware.process_template_response(self, request, response)
@@ -0,0 +1,291 @@
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Optional
+
+from cart.models import SESSION_CART_KEY, Cart, StockReservation
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connections
+from django.test import Client, override_settings
+from django.urls import reverse
+from products.models import Category, Product
+
+# scenario: share of the traffic, the default mix is mostly browsing
+DEFAULT_MIX = "all_products=30,products_by_category=25,product_details=30,cart_page=10,add_to_cart=5"
+SCENARIOS = (
+    "all_products",
+    "products_by_category",
+    "product_details",
+    "cart_page",
+    "add_to_cart",
+)
+PERCENTILES = (50, 95, 99)
+
+
+def parse_mix(value: str) -> dict[str, int]:
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise CommandError(
+                f"Unknown scenario {name!r}, pick from {', '.join(SCENARIOS)}."
+            )
+        try:
+            mix[name] = int(weight)
+        except ValueError:
+            raise CommandError(f"Scenario weights must be integers, got {part!r}.")
+    if sum(mix.values()) <= 0 or any(weight < 0 for weight in mix.values()):
+        raise CommandError("Scenario weights must be positive.")
+    return mix
+
+
+def percentile(ordered: list[float], p: int) -> float:
+    # nearest rank
+    if not ordered:
+        return 0.0
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered)) - 1))]
+
+
+class EndpointStats:
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self.errors = 0
+        self.queries = 0
+        self.db_time = 0.0
+
+    def merge(self, other: "EndpointStats") -> None:
+        self.latencies += other.latencies
+        self.errors += other.errors
+        self.queries += other.queries
+        self.db_time += other.db_time
+
+    def summary(self, elapsed: float) -> dict:
+        ordered = sorted(self.latencies)
+        requests = len(ordered)
+        return {
+            "requests": requests,
+            "errors": self.errors,
+            "requests_per_second": round(requests / max(elapsed, 1e-6), 1),
+            **{
+                f"p{p}_ms": round(percentile(ordered, p) * 1000, 2) for p in PERCENTILES
+            },
+            "queries_per_request": round(self.queries / max(requests, 1), 2),
+            "db_ms_per_request": round(self.db_time * 1000 / max(requests, 1), 2),
+        }
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a mix of shopper traffic against the URLconf from worker threads, "
+        "and report latency percentiles, throughput and database work per endpoint"
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--workers", type=int, default=8, help="Shoppers browsing in parallel."
+        )
+        parser.add_argument("--requests", type=int, default=1000)
+        parser.add_argument(
+            "--duration",
+            type=float,
+            default=None,
+            help="Stop after this many seconds, even if --requests isn't reached.",
+        )
+        parser.add_argument(
+            "--mix",
+            default=DEFAULT_MIX,
+            help=f"Comma separated scenario=weight pairs, scenarios are {', '.join(SCENARIOS)}.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument(
+            "--baseline", help="Compare with the results of an earlier --output."
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        workers: int = options["workers"]
+        total: int = options["requests"]
+        if workers < 1 or total < 1:
+            raise CommandError("--workers and --requests must be positive.")
+        mix = parse_mix(options["mix"])
+        baseline = self.load_baseline(options["baseline"])
+        if settings.DEBUG:
+            self.stderr.write("DEBUG is on, expect slow and noisy numbers.")
+
+        self.products = list(
+            Product.published.for_links()
+            .filter(quantity__gt=0)
+            .values_list("slug", "product_type__slug")
+        )
+        self.categories = list(Category.objects.values_list("slug", flat=True))
+        if not self.products or not self.categories:
+            raise CommandError("Nothing to load test, add some products first.")
+
+        self.scenarios, self.weights = zip(*mix.items())
+        self.tickets = itertools.count()
+        self.total = total
+        self.deadline = (
+            time.monotonic() + options["duration"] if options["duration"] else None
+        )
+        self.seed: int = options["seed"]
+        self.session_keys: list[str] = []
+        self.cart_ids: list[int] = []
+        self.lock = threading.Lock()
+
+        # the test client's host, like the test runner allows it
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+            started = time.perf_counter()
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(self.shop, range(workers)))
+                elapsed = time.perf_counter() - started
+            finally:
+                self.clean_up()
+
+        stats = defaultdict(EndpointStats)
+        for worker_stats in results:
+            for scenario, endpoint_stats in worker_stats.items():
+                stats[scenario].merge(endpoint_stats)
+        overall = EndpointStats()
+        for endpoint_stats in stats.values():
+            overall.merge(endpoint_stats)
+        report = {
+            "workers": workers,
+            "mix": mix,
+            "seed": self.seed,
+            "elapsed_seconds": round(elapsed, 3),
+            "total": overall.summary(elapsed),
+            "endpoints": {
+                scenario: stats[scenario].summary(elapsed)
+                for scenario in SCENARIOS
+                if scenario in stats
+            },
+        }
+
+        self.print_report(report, baseline)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+        return (
+            f"{report['total']['requests']} requests, {report['total']['errors']} "
+            f"errors, {report['total']['requests_per_second']} requests/s"
+        )
+
+    def shop(self, worker: int) -> dict[str, EndpointStats]:
+        # one shopper with its own session and cart per worker
+        rng = random.Random(f"{self.seed}:{worker}")
+        client = Client(raise_request_exception=False)
+        stats = defaultdict(EndpointStats)
+        current = {"queries": 0, "db_time": 0.0}
+
+        def count_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                current["queries"] += 1
+                current["db_time"] += time.perf_counter() - started
+
+        try:
+            # every database, catalog reads may go to a replica
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(count_query))
+                while next(self.tickets) < self.total and not (
+                    self.deadline and time.monotonic() > self.deadline
+                ):
+                    scenario = rng.choices(self.scenarios, self.weights)[0]
+                    current.update(queries=0, db_time=0.0)
+                    started = time.perf_counter()
+                    response = self.request(client, scenario, rng)
+                    endpoint_stats = stats[scenario]
+                    endpoint_stats.latencies.append(time.perf_counter() - started)
+                    endpoint_stats.queries += current["queries"]
+                    endpoint_stats.db_time += current["db_time"]
+                    if response.status_code >= 400:
+                        endpoint_stats.errors += 1
+            if session_key := client.cookies.get(settings.SESSION_COOKIE_NAME):
+                session = client.session
+                with self.lock:
+                    self.session_keys.append(session_key.value)
+                    if cart_id := session.get(SESSION_CART_KEY):
+                        self.cart_ids.append(cart_id)
+        finally:
+            connections.close_all()
+        return stats
+
+    def request(self, client: Client, scenario: str, rng: random.Random):
+        if scenario == "all_products":
+            return client.get(reverse("all_products"))
+        if scenario == "products_by_category":
+            return client.get(
+                reverse("products_by_category", args=[rng.choice(self.categories)])
+            )
+        slug, product_type = rng.choice(self.products)
+        if scenario == "product_details":
+            return client.get(reverse("product_details", args=[product_type, slug]))
+        if scenario == "cart_page":
+            return client.get(reverse("cart_page"))
+        return client.post(reverse("cart_page"), {"product_slug": slug})
+
+    def clean_up(self) -> None:
+        # the shoppers' carts hold stock, give it back
+        if self.cart_ids:
+            StockReservation.objects.release(
+                StockReservation.objects.filter(cart__in=self.cart_ids)
+            )
+            Cart.objects.filter(id__in=self.cart_ids).delete()
+        Session.objects.filter(session_key__in=self.session_keys).delete()
+
+    def load_baseline(self, path: Optional[str]) -> Optional[dict]:
+        if not path:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Can't read the baseline: {e}")
+
+    def print_report(self, report: dict, baseline: Optional[dict]) -> None:
+        self.stdout.write(
+            f"{'endpoint':<22}{'requests':>9}{'errors':>7}{'req/s':>9}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'db ms':>8}"
+        )
+        rows = list(report["endpoints"].items()) + [("total", report["total"])]
+        for name, row in rows:
+            self.stdout.write(
+                f"{name:<22}{row['requests']:>9}{row['errors']:>7}"
+                f"{row['requests_per_second']:>9.1f}{row['p50_ms']:>9.2f}"
+                f"{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+                f"{row['queries_per_request']:>9.2f}{row['db_ms_per_request']:>8.2f}"
+            )
+        if not baseline:
+            return
+
+        self.stdout.write("Against the baseline:")
+        baseline_rows = baseline.get("endpoints", {}) | {"total": baseline.get("total")}
+        for name, row in rows:
+            if not (before := baseline_rows.get(name)):
+                continue
+            changes = ", ".join(
+                f"{label} {self.change(before.get(key), row[key])}"
+                for label, key in (
+                    ("req/s", "requests_per_second"),
+                    ("p95", "p95_ms"),
+                    ("queries", "queries_per_request"),
+                )
+            )
+            self.stdout.write(f"{name:<22}{changes}")
+
+    def change(self, before: Optional[float], after: float) -> str:
+        if not before:
+            return "n/a"
+        return f"{(after - before) / before:+.0%}"
@@ -0,0 +1,290 @@
+import random
+import string
+import time
+from datetime import timedelta
+from decimal import Decimal
+from typing import Any
+
+from cart.models import SESSION_CART_KEY, Cart, CartItem, StockReservation
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+from products import cache as catalog_cache
+from products.cards import refresh_cards
+from products.models import Category, Product, ProductType
+
+User = get_user_model()
+
+# name parts for the synthetic catalog
+ADJECTIVES = (
+    "Smoky, Floral, Golden, Mountain, Imperial, Spring, Autumn, Royal, Wild, Aged, "
+    "Roasted, Misty, Honey, Silver, Midnight"
+).split(", ")
+TEAS = (
+    "Oolong, Green, Black, White, Pu-erh, Jasmine, Earl Grey, Sencha, Matcha, "
+    "Darjeeling, Assam, Chai, Rooibos, Genmaicha, Lapsang"
+).split(", ")
+FORMS = "Tea, Leaves, Blend, Reserve, Brew, Pearls, Needles, Buds".split(", ")
+NOTES = (
+    "peach, orchid, toasted rice, cocoa, citrus, chestnut, honey, pine smoke, "
+    "malt, seaweed, vanilla, plum, butter, hay"
+).split(", ")
+PRODUCT_TYPES = "Teas, Teaware, Gift sets, Samplers, Accessories".split(", ")
+SESSION_KEY_CHARS = string.ascii_lowercase + string.digits
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk insert a large synthetic catalog with guest and user carts, "
+        "for benchmarks"
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--products", type=int, default=100_000)
+        parser.add_argument("--categories", type=int, default=200)
+        parser.add_argument("--product-types", type=int, default=20)
+        parser.add_argument(
+            "--max-categories",
+            type=int,
+            default=3,
+            help="Categories per product, from none up to this many.",
+        )
+        parser.add_argument("--guest-carts", type=int, default=10_000)
+        parser.add_argument("--user-carts", type=int, default=10_000)
+        parser.add_argument(
+            "--max-cart-items",
+            type=int,
+            default=5,
+            help="Products per cart, from one up to this many.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=5000,
+            help="Rows per bulk insert, each batch is its own transaction.",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Same seed, same data. Slugs and usernames include it, so "
+            "several seeds can live side by side.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        for name in ("products", "categories", "product_types", "batch_size"):
+            if options[name] < 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be at least 1.")
+        if options["max_cart_items"] < 1:
+            raise CommandError("--max-cart-items must be at least 1.")
+        if (
+            options["max_categories"] < 0
+            or min(options["guest_carts"], options["user_carts"]) < 0
+        ):
+            raise CommandError("--max-categories and cart counts can't be negative.")
+        if not connection.features.can_return_rows_from_bulk_insert:
+            raise CommandError("The database has to return ids from bulk inserts.")
+
+        self.rng = random.Random(options["seed"])
+        self.batch_size: int = options["batch_size"]
+        self.verbosity: int = options["verbosity"]
+        self.prefix = f"seed{options['seed']}"
+        if ProductType.objects.filter(slug__startswith=f"{self.prefix}-").exists():
+            raise CommandError(
+                f"Seed {options['seed']} is in the database already, pick another --seed."
+            )
+
+        started = time.perf_counter()
+        product_types = self.seed_product_types(options["product_types"])
+        categories = self.seed_categories(options["categories"])
+        product_ids, links = self.seed_products(
+            options["products"],
+            product_types,
+            [category.pk for category in categories],
+            options["max_categories"],
+        )
+        # bulk inserts send no signals, the cards are built here
+        refresh_cards(product_ids)
+        catalog_elapsed = time.perf_counter() - started
+
+        guest_carts = self.seed_carts(
+            options["guest_carts"], product_ids, options["max_cart_items"], guest=True
+        )
+        user_carts = self.seed_carts(
+            options["user_carts"], product_ids, options["max_cart_items"], guest=False
+        )
+        elapsed = time.perf_counter() - started
+
+        # nor is the catalog cache told
+        catalog_cache.invalidate(
+            catalog_cache.ALL_PRODUCTS,
+            *(catalog_cache.category_scope(category.slug) for category in categories),
+            *(catalog_cache.product_type_scope(ptype.slug) for ptype in product_types),
+        )
+        return (
+            f"Seeded {len(product_ids)} products with {links} category links, "
+            f"{guest_carts} guest carts and {user_carts} user carts in {elapsed:.1f}s "
+            f"({len(product_ids) / max(catalog_elapsed, 1e-6) * 60:.0f} products/min)."
+        )
+
+    def seed_product_types(self, count: int) -> list[ProductType]:
+        return ProductType.objects.bulk_create(
+            ProductType(
+                name=f"{PRODUCT_TYPES[i % len(PRODUCT_TYPES)]} {i // len(PRODUCT_TYPES) + 1}",
+                description=f"Synthetic product type {i}",
+                slug=f"{self.prefix}-type-{i}",
+            )
+            for i in range(count)
+        )
+
+    def seed_categories(self, count: int) -> list[Category]:
+        categories = []
+        for i in range(count):
+            name = f"{self.rng.choice(ADJECTIVES)} {self.rng.choice(TEAS)}"
+            categories.append(
+                Category(
+                    name=name,
+                    description=f"All sorts of {name.lower()} teas",
+                    slug=f"{self.prefix}-{slugify(name)}-{i}",
+                )
+            )
+        return Category.objects.bulk_create(categories, batch_size=self.batch_size)
+
+    def seed_products(
+        self,
+        count: int,
+        product_types: list[ProductType],
+        category_ids: list[int],
+        max_categories: int,
+    ) -> tuple[list[int], int]:
+        rng = self.rng
+        Link = Product.categories.through
+        product_ids = []
+        links = 0
+        started = time.perf_counter()
+        for offset in range(0, count, self.batch_size):
+            products = []
+            for i in range(offset, min(offset + self.batch_size, count)):
+                adjective, tea, form = (
+                    rng.choice(ADJECTIVES),
+                    rng.choice(TEAS),
+                    rng.choice(FORMS),
+                )
+                name = f"{adjective} {tea} {form}"
+                products.append(
+                    Product(
+                        name=name,
+                        description=(
+                            f"A {adjective.lower()} {tea.lower()} {form.lower()} with "
+                            f"notes of {' and '.join(rng.sample(NOTES, 2))}."
+                        ),
+                        is_published=rng.random() < 0.9,
+                        quantity=rng.randint(0, 500),
+                        price=Decimal(rng.randint(300, 9000)) / 100,
+                        product_type=rng.choice(product_types),
+                        slug=f"{self.prefix}-{slugify(name)}-{i}",
+                    )
+                )
+            with transaction.atomic():
+                Product.objects.bulk_create(products)
+                # straight into the auto-created through table
+                batch_links = Link.objects.bulk_create(
+                    Link(product_id=product.pk, category_id=category_id)
+                    for product in products
+                    for category_id in rng.sample(
+                        category_ids,
+                        rng.randint(0, min(max_categories, len(category_ids))),
+                    )
+                )
+            product_ids += [product.pk for product in products]
+            links += len(batch_links)
+            self.progress("products", len(product_ids), started)
+        return product_ids, links
+
+    def seed_carts(
+        self, count: int, product_ids: list[int], max_items: int, guest: bool
+    ) -> int:
+        rng = self.rng
+        label = "guest carts" if guest else "user carts"
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=settings.CART_RESERVATION_TIMEOUT)
+        # every user gets the same unusable password, hashing each is slow
+        password = make_password(None)
+        store = SessionStore()
+        seeded = 0
+        started = time.perf_counter()
+        for offset in range(0, count, self.batch_size):
+            size = min(self.batch_size, count - offset)
+            with transaction.atomic():
+                if guest:
+                    carts = [
+                        Cart(
+                            session_key="".join(rng.choices(SESSION_KEY_CHARS, k=32)),
+                            last_activity=now
+                            - timedelta(minutes=rng.randint(0, 7 * 24 * 60)),
+                        )
+                        for _ in range(size)
+                    ]
+                else:
+                    users = User.objects.bulk_create(
+                        User(
+                            username=f"{self.prefix}-shopper-{i}",
+                            email=f"{self.prefix}-shopper-{i}@example.com",
+                            password=password,
+                        )
+                        for i in range(offset, offset + size)
+                    )
+                    carts = [Cart(user=user) for user in users]
+                Cart.objects.bulk_create(carts)
+
+                items = []
+                reservations = []
+                for cart in carts:
+                    for product_id in rng.sample(
+                        product_ids, rng.randint(1, min(max_items, len(product_ids)))
+                    ):
+                        quantity = rng.randint(1, 3)
+                        items.append(
+                            CartItem(
+                                cart=cart, product_id=product_id, quantity=quantity
+                            )
+                        )
+                        # stock in carts is held on top of `Product.quantity`
+                        reservations.append(
+                            StockReservation(
+                                cart=cart,
+                                product_id=product_id,
+                                quantity=quantity,
+                                expires_at=expires_at,
+                            )
+                        )
+                CartItem.objects.bulk_create(items)
+                StockReservation.objects.bulk_create(reservations)
+
+                if guest:
+                    # a live session per guest cart, or it counts as orphaned
+                    Session.objects.bulk_create(
+                        Session(
+                            session_key=cart.session_key,
+                            session_data=store.encode({SESSION_CART_KEY: cart.pk}),
+                            expire_date=now
+                            + timedelta(seconds=settings.SESSION_COOKIE_AGE),
+                        )
+                        for cart in carts
+                    )
+            seeded += size
+            self.progress(label, seeded, started)
+        return seeded
+
+    def progress(self, label: str, done: int, started: float) -> None:
+        if self.verbosity >= 2:
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{elapsed:.1f}s: {done} {label} ({done / max(elapsed, 1e-6):.0f}/s)"
+            )
@@ -0,0 +1,110 @@
+from contextvars import ContextVar
+from typing import Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.http import HttpRequest, HttpResponse
+from django.urls import reverse
+
+# Catalog reads of storefront requests go to a read-only replica, everything
+# else to the primary: carts, sessions, users, admin and every write. Once a
+# request writes to the catalog, the rest of it reads from the primary, and
+# so do the visitor's next requests for a few seconds, see
+# `PrimaryPinMiddleware`. A shopper always sees their own changes, eg. the
+# stock they just reserved, however far the replica lags behind.
+REPLICA_DB_ALIAS = "replica"
+REPLICA_APP_LABELS = {"products"}
+PIN_COOKIE_NAME = "primary_pin"
+
+_current_pin: ContextVar[Optional["PrimaryPin"]] = ContextVar(
+    "primary_pin", default=None
+)
+
+
+class PrimaryPin:
+    # mutable, so writes in the threads of async views pin the request too
+    def __init__(self, pinned: bool = False) -> None:
+        self.pinned = pinned
+        self.wrote = False
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        # outside requests, eg. in management commands, nothing is pinned and
+        # the primary is read, a command reads back what it just wrote
+        if model._meta.app_label not in REPLICA_APP_LABELS:
+            return None
+        if (pin := _current_pin.get()) is None or pin.pinned:
+            return None
+        # the replica can't see what a transaction on the primary did yet
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return REPLICA_DB_ALIAS
+
+    def db_for_write(self, model, **hints) -> str:
+        # only catalog writes change what the replica would answer, session
+        # saves and cart touches don't pin
+        pin = _current_pin.get()
+        if pin is not None and model._meta.app_label in REPLICA_APP_LABELS:
+            pin.pinned = pin.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints) -> bool:
+        # same rows on both databases
+        return True
+
+    def allow_migrate(self, db: str, app_label: str, **hints) -> bool:
+        # the replica copies the primary's schema along with the data
+        return db != REPLICA_DB_ALIAS
+
+
+class PrimaryPinMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response) -> None:
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def start(self, request: HttpRequest) -> PrimaryPin:
+        # unsafe methods write, mostly, and read what they are about to change
+        return PrimaryPin(
+            request.method not in ("GET", "HEAD", "OPTIONS")
+            or PIN_COOKIE_NAME in request.COOKIES
+            or request.path.startswith(reverse("admin:index"))
+        )
+
+    def finish(self, response: HttpResponse, pin: PrimaryPin) -> None:
+        if pin.wrote:
+            response.set_cookie(
+                PIN_COOKIE_NAME,
+                "1",
+                max_age=settings.DATABASE_REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.async_mode:
+            return self.__acall__(request)
+        pin = self.start(request)
+        token = _current_pin.set(pin)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_pin.reset(token)
+        self.finish(response, pin)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        pin = self.start(request)
+        token = _current_pin.set(pin)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_pin.reset(token)
+        self.finish(response, pin)
+        return response
@@ -0,0 +1,126 @@
+from contextvars import ContextVar
+from typing import Optional
+
+from django.contrib.sessions.backends import cached_db
+from django.contrib.sessions.backends.base import UpdateError
+from django.contrib.sessions.backends.db import SessionStore as DBStore
+from django.contrib.sessions.middleware import (
+    SessionMiddleware as BaseSessionMiddleware,
+)
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.http import HttpRequest, HttpResponse
+
+# Sessions for cart traffic: read from the cache, the database only when the
+# cache lost them. Saving a session that didn't change, eg. one that was
+# only read or had a key set to the value it held, writes nothing. Changes
+# go to the cache right away and, within requests, to the database once
+# the response was sent, however often the request saved. New sessions are
+# inserted right away, their keys are unique and orphaned cart clean up
+# relies on the row, see remove_orphaned_carts.
+KEY_PREFIX = "teashop.sessions"
+
+# the request's session, while it has a write pending
+_pending_session: ContextVar[Optional["SessionStore"]] = ContextVar(
+    "pending_session", default=None
+)
+
+
+class SessionStore(cached_db.SessionStore):
+    cache_key_prefix = KEY_PREFIX
+
+    def __init__(self, session_key: Optional[str] = None) -> None:
+        super().__init__(session_key)
+        # set by `SessionMiddleware` for the request's session
+        self.write_behind = False
+        self.write_pending = False
+        # the data as serialized in the cache, also how changes are told apart
+        self._stored: Optional[bytes] = None
+
+    def serialize(self, data: dict) -> bytes:
+        # the cache keeps the JSON the change check needs anyway, shorter
+        # than a pickled dict, and unsigned, it never leaves the server
+        return self.serializer().dumps(data)
+
+    def load(self) -> dict:
+        try:
+            stored = self._cache.get(self.cache_key)
+        except Exception:
+            # invalid keys on some cache backends, see cached_db
+            stored = None
+        if stored is not None:
+            self._stored = stored
+            return self.serializer().loads(stored)
+
+        if (session := self._get_session_from_db()) is None:
+            return {}
+        data = self.decode(session.session_data)
+        self._stored = self.serialize(data)
+        self._cache.set(
+            self.cache_key,
+            self._stored,
+            self.get_expiry_age(expiry=session.expire_date),
+        )
+        return data
+
+    def exists(self, session_key: Optional[str]) -> bool:
+        # only asked for new keys, the insert fails on the odd clash with a
+        # session the cache dropped, and `create()` tries another key
+        return bool(session_key) and self.cache_key_prefix + session_key in self._cache
+
+    def save(self, must_create: bool = False) -> None:
+        if self.session_key is None:
+            return self.create()
+        stored = self.serialize(self._get_session(no_load=must_create))
+        if must_create:
+            DBStore.save(self, must_create=True)
+        elif stored == self._stored:
+            return
+        elif self.write_behind:
+            self.write_pending = True
+        else:
+            DBStore.save(self)
+        self._cache.set(self.cache_key, stored, self.get_expiry_age())
+        self._stored = stored
+
+    def save_pending(self) -> None:
+        if not self.write_pending:
+            return
+        self.write_pending = False
+        try:
+            DBStore.save(self)
+        except UpdateError:
+            # deleted meanwhile, eg. logged out in another tab, and so it stays
+            self._cache.delete(self.cache_key)
+
+    def delete(self, session_key: Optional[str] = None) -> None:
+        if session_key is None or session_key == self.session_key:
+            self.write_pending = False
+            self._stored = None
+        super().delete(session_key)
+
+
+class SessionMiddleware(BaseSessionMiddleware):
+    # Django's, plus the write behind when SESSION_ENGINE is this module
+    def process_request(self, request: HttpRequest) -> None:
+        super().process_request(request)
+        request.session.write_behind = True
+        _pending_session.set(None)
+
+    def process_response(
+        self, request: HttpRequest, response: HttpResponse
+    ) -> HttpResponse:
+        response = super().process_response(request, response)
+        if getattr(request.session, "write_pending", False):
+            _pending_session.set(request.session)
+        return response
+
+
+@receiver(request_finished)
+def save_pending_session(sender, **kwargs) -> None:
+    # servers close responses once they are sent, which finishes the request.
+    # Django may have closed the connection just before, a new one is closed
+    # when the next request starts, like any other.
+    if (session := _pending_session.get()) is not None:
+        _pending_session.set(None)
+        session.save_pending()
@@ -52,10 +52,13 @@ INSTALLED_APPS = [
     "django.contrib.messages",
     "django.contrib.staticfiles",
     # local
+    # the project package itself, for the site-wide management commands
+    "TeaShop",
     "accounts.apps.AccountsConfig",
     "pages.apps.PagesConfig",
     "products.apps.ProductsConfig",
     "cart.apps.CartConfig",
+    "orders.apps.OrdersConfig",
     # third party
     "crispy_forms",
 ]
@@ -66,16 +69,19 @@ if DEBUG:
     mimetypes.add_type("application/javascript", ".js", True)
 
 MIDDLEWARE = [
+    # first, so it measures everything below it
+    "TeaShop.instrumentation.PerformanceMiddleware",
     "django.middleware.security.SecurityMiddleware",
-    "django.contrib.sessions.middleware.SessionMiddleware",
+    "TeaShop.sessions.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "cart.middleware.CartMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 if DEBUG:
-    MIDDLEWARE.insert(3, "debug_toolbar.middleware.DebugToolbarMiddleware")
+    MIDDLEWARE.insert(4, "debug_toolbar.middleware.DebugToolbarMiddleware")
 
 ROOT_URLCONF = "TeaShop.urls"
 
@@ -90,6 +96,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "cart.context_processors.cart_badge",
             ],
         },
     },
@@ -103,10 +110,77 @@ WSGI_APPLICATION = "TeaShop.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        # Django's, with a few extra OPTIONS
+        "ENGINE": "TeaShop.sqlite",
+        "NAME": os.environ.get("DJANGO_DB_PATH") or BASE_DIR / "db.sqlite3",
     }
 }
+# "production" tunes SQLite for concurrent writers: WAL, so readers and the
+# writer don't block each other, writers queueing on the busy timeout rather
+# than failing, and persistent connections, see TeaShop/sqlite/base.py.
+# Transactions begin DEFERRED, only the stock writes begin IMMEDIATE, see
+# TeaShop/transactions.py
+DB_PROFILE = os.environ.get("DJANGO_DB_PROFILE", "default")
+READ_PRAGMAS = {
+    # milliseconds a connection waits for a lock
+    "busy_timeout": 20_000,
+    "mmap_size": 256 * 1024 * 1024,
+    # negative is KiB, 64 MiB per connection
+    "cache_size": -64 * 1024,
+    "temp_store": "memory",
+}
+if DB_PROFILE == "production":
+    DATABASES["default"] |= {
+        "CONN_MAX_AGE": int(os.environ.get("DJANGO_CONN_MAX_AGE", 600)),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            "pragmas": {
+                "journal_mode": "wal",
+                # durable at checkpoints, WAL keeps the database consistent
+                "synchronous": "normal",
+                **READ_PRAGMAS,
+            },
+        },
+    }
+# A read-only copy of the database, kept up to date outside Django, eg. by
+# Litestream. Catalog reads of storefront requests go there, see
+# TeaShop/routers.py. In tests it mirrors the primary.
+if replica_path := os.environ.get("DJANGO_DB_REPLICA_PATH"):
+    DATABASES["replica"] = DATABASES["default"] | {
+        "NAME": f"file:{replica_path}?mode=ro",
+        # journal mode and transactions are the primary's business
+        "OPTIONS": {"uri": True}
+        | ({"pragmas": READ_PRAGMAS} if DB_PROFILE == "production" else {}),
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_ROUTERS = ["TeaShop.routers.ReadReplicaRouter"]
+    MIDDLEWARE.insert(1, "TeaShop.routers.PrimaryPinMiddleware")
+# seconds a visitor keeps reading the primary after changing the catalog
+DATABASE_REPLICA_PIN_SECONDS = 10
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    "default": (
+        {
+            "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+            "LOCATION": cache_dir,
+        }
+        if (cache_dir := os.environ.get("DJANGO_CACHE_DIR"))
+        else {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    )
+}
+
+# Sessions: "TeaShop.sessions" reads them from the cache and only writes
+# changes, after the response, see TeaShop/sessions.py. Every server process
+# has to share the cache then, eg. with DJANGO_CACHE_DIR.
+SESSION_ENGINE = os.environ.get(
+    "DJANGO_SESSION_ENGINE", "django.contrib.sessions.backends.db"
+)
+SESSION_CACHE_ALIAS = "default"
 
 AUTH_USER_MODEL = "accounts.CustomUser"
 
@@ -160,3 +234,47 @@ MEDIA_ROOT = BASE_DIR / "media"
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# Catalog listings
+# products are paginated by keyset cursors, `?page_size=` is capped at the max
+
+CATALOG_PAGE_SIZE = 24
+CATALOG_MAX_PAGE_SIZE = 100
+
+# catalog pages, listings and product cards, see products/cache.py
+CATALOG_CACHE_ALIAS = "default"
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# Anonymous carts: "db" keeps them as Cart rows, "signed_cookie" or "cache"
+# keep them out of the database until login or checkout, see cart/guest.py
+CART_GUEST_BACKEND = os.environ.get("CART_GUEST_BACKEND", "db")
+CART_GUEST_COOKIE_NAME = "guest_cart"
+CART_GUEST_CACHE_ALIAS = "default"
+
+# how long stock added to a cart stays reserved for it, in seconds, see
+# `release_expired_reservations`
+CART_RESERVATION_TIMEOUT = 30 * 60
+
+# Route the catalog and cart pages to their async views. Off by default, even
+# under ASGI, until they serve at least as fast as the sync ones, compare
+# with `benchmark_handlers`
+ASYNC_VIEWS = os.environ.get("DJANGO_ASYNC_VIEWS", "") == "1"
+
+# Per request query counts, SQL time and render timings, see
+# TeaShop/instrumentation.py. Server-Timing headers go to every response when
+# on, structured log lines to the given share of requests.
+PERFORMANCE_SERVER_TIMING = os.environ.get("PERFORMANCE_SERVER_TIMING", "") == "1"
+PERFORMANCE_LOG_SAMPLE_RATE = float(os.environ.get("PERFORMANCE_LOG_SAMPLE_RATE", 0))
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "teashop.performance": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}
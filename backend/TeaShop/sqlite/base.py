@@ -0,0 +1,41 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.sqlite3 import base
+
+# Django's SQLite backend with two extra OPTIONS, see the production profile
+# in TeaShop/settings.py:
+# - "pragmas", set on every new connection, eg. {"journal_mode": "wal"}
+# - "transaction_mode", how atomic blocks begin. Django 5.1 has the same
+#   option. Left alone, they begin DEFERRED and only take the write lock
+#   when they first write, so readers never queue behind writers. The units
+#   that read stock and then write it begin IMMEDIATE one by one instead,
+#   see TeaShop/transactions.py.
+TRANSACTION_MODES = ("DEFERRED", "IMMEDIATE", "EXCLUSIVE")
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self) -> dict:
+        params = super().get_connection_params()
+        self.pragmas: dict = params.pop("pragmas", {})
+        self.transaction_mode = params.pop("transaction_mode", None)
+        if self.transaction_mode and self.transaction_mode not in TRANSACTION_MODES:
+            raise ImproperlyConfigured(
+                f"transaction_mode must be one of {', '.join(TRANSACTION_MODES)}."
+            )
+        return params
+
+    def get_new_connection(self, conn_params: dict):
+        conn = super().get_new_connection(conn_params)
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+        return conn
+
+    # how the next transaction begins, whatever "transaction_mode" says
+    next_transaction_mode = None
+
+    def _start_transaction_under_autocommit(self) -> None:
+        mode = self.next_transaction_mode or self.transaction_mode
+        self.next_transaction_mode = None
+        if mode:
+            self.cursor().execute(f"BEGIN {mode}")
+        else:
+            super()._start_transaction_under_autocommit()
@@ -0,0 +1,529 @@
+import json
+import re
+import sqlite3
+import tempfile
+import time
+from contextlib import ExitStack
+from io import StringIO
+from pathlib import Path
+
+from cart.models import (
+    SESSION_CART_KEY,
+    SESSION_USER_CART_KEY,
+    Cart,
+    CartItem,
+    StockReservation,
+)
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from products.models import Category, Product, ProductType
+
+from .instrumentation import RequestMetrics, _current_metrics, timed
+from .routers import PIN_COOKIE_NAME, REPLICA_DB_ALIAS
+from .sqlite.base import DatabaseWrapper
+from .transactions import immediate_atomic
+
+User = get_user_model()
+
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+LOCMEM_CACHE = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+def parse_server_timing(header: str) -> dict[str, float]:
+    return {
+        match["name"]: float(match["duration"])
+        for match in re.finditer(r"(?P<name>[\w-]+);dur=(?P<duration>[\d.]+)", header)
+    }
+
+
+@override_settings(CACHES=NO_CACHE)
+class PerformanceMiddlewareTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        self.url = reverse("cart_page")
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+
+    def test_off_by_default(self):
+        response = self.client.get(self.url)
+        self.assertNotIn("Server-Timing", response)
+        with self.assertNoLogs("teashop.performance"):
+            self.client.get(self.url)
+
+    @override_settings(PERFORMANCE_SERVER_TIMING=True)
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        timings = parse_server_timing(response["Server-Timing"])
+        self.assertEqual(
+            set(timings), {"db", "db-slowest", "cart", "template", "total"}
+        )
+        self.assertIn(
+            f'desc="{len(queries.captured_queries)} queries"', response["Server-Timing"]
+        )
+        self.assertLessEqual(timings["db-slowest"], timings["db"])
+        self.assertLessEqual(timings["template"], timings["total"])
+
+    @override_settings(PERFORMANCE_LOG_SAMPLE_RATE=1.0)
+    def test_sampled_log_lines(self):
+        with self.assertLogs("teashop.performance") as logs:
+            response = self.client.post(self.url, {"product_slug": "best-oolong"})
+        self.assertNotIn("Server-Timing", response)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["method"], "POST")
+        self.assertEqual(record["path"], self.url)
+        self.assertEqual(record["status"], 302)
+        self.assertGreater(record["queries"], 0)
+        self.assertIn("cart_ms", record)
+        # SQL with placeholders only
+        self.assertNotIn("best-oolong", record["slowest_query"])
+
+    @override_settings(PERFORMANCE_SERVER_TIMING=True)
+    async def test_async_requests(self):
+        # the queries run in other threads
+        self.async_client.cookies = self.client.cookies
+        response = await self.async_client.get(self.url)
+        timings = parse_server_timing(response["Server-Timing"])
+        self.assertGreater(timings["db"], 0)
+        self.assertNotIn('desc="0 queries"', response["Server-Timing"])
+        self.assertIn("template", timings)
+
+    def test_timed(self):
+        with timed("nothing"):
+            pass
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        try:
+            with timed("something"):
+                Product.objects.count()
+            with timed("something"):
+                pass
+        finally:
+            _current_metrics.reset(token)
+        self.assertEqual(list(metrics.timings), ["something"])
+        self.assertEqual(metrics.queries, 1)
+
+
+class SQLiteBackendTests(TestCase):
+    def make_connection(self, path: Path, **options) -> DatabaseWrapper:
+        wrapper = DatabaseWrapper(
+            connection.settings_dict
+            | {"ENGINE": "TeaShop.sqlite", "NAME": str(path), "OPTIONS": options}
+        )
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def pragma(self, wrapper: DatabaseWrapper, name: str):
+        with wrapper.cursor() as cursor:
+            cursor.execute(f"PRAGMA {name}")
+            return cursor.fetchone()[0]
+
+    def test_pragmas(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            wrapper = self.make_connection(
+                Path(scratch) / "db.sqlite3",
+                pragmas={"journal_mode": "wal", "busy_timeout": 1234, "synchronous": 1},
+            )
+            self.assertEqual(self.pragma(wrapper, "journal_mode"), "wal")
+            self.assertEqual(self.pragma(wrapper, "busy_timeout"), 1234)
+            self.assertEqual(self.pragma(wrapper, "synchronous"), 1)
+
+    def test_transaction_mode(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            path = Path(scratch) / "db.sqlite3"
+            writer = self.make_connection(path, transaction_mode="IMMEDIATE")
+            other = self.make_connection(path, pragmas={"busy_timeout": 0})
+            with other.cursor() as cursor:
+                cursor.execute("CREATE TABLE t (x)")
+            # how atomic blocks begin on SQLite, the write lock is taken
+            # before anything is written
+            writer.ensure_connection()
+            writer._start_transaction_under_autocommit()
+            try:
+                with self.assertRaisesMessage(OperationalError, "locked"):
+                    with other.cursor() as cursor:
+                        cursor.execute("INSERT INTO t VALUES (1)")
+            finally:
+                writer.connection.rollback()
+
+    def test_unknown_transaction_mode(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            wrapper = self.make_connection(
+                Path(scratch) / "db.sqlite3", transaction_mode="EVENTUALLY"
+            )
+            with self.assertRaises(ImproperlyConfigured):
+                wrapper.ensure_connection()
+
+
+class ImmediateAtomicTests(TransactionTestCase):
+    def begins(self, *blocks) -> list[str]:
+        with CaptureQueriesContext(connection) as queries, ExitStack() as stack:
+            for block in blocks:
+                stack.enter_context(block)
+            Product.objects.exists()
+        return [q["sql"] for q in queries if q["sql"].startswith("BEGIN")]
+
+    def test_only_stock_writes_begin_immediate(self):
+        self.assertEqual(self.begins(transaction.atomic()), ["BEGIN"])
+        self.assertEqual(self.begins(immediate_atomic()), ["BEGIN IMMEDIATE"])
+        # nested, it is a savepoint of the transaction that began already
+        self.assertEqual(
+            self.begins(transaction.atomic(), immediate_atomic()), ["BEGIN"]
+        )
+        self.assertEqual(self.begins(transaction.atomic()), ["BEGIN"])
+
+
+@override_settings(
+    CACHES=NO_CACHE,
+    DATABASE_ROUTERS=["TeaShop.routers.ReadReplicaRouter"],
+    MIDDLEWARE=["TeaShop.routers.PrimaryPinMiddleware", *settings.MIDDLEWARE],
+)
+class ReadReplicaTests(TransactionTestCase):
+    # the in-memory test database is the primary, a file copied from it the
+    # replica, which falls behind as soon as the primary changes
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        self.url = self.product.get_absolute_url()
+        scratch = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch.cleanup)
+        self.replica_path = Path(scratch.name) / "replica.sqlite3"
+        self.catch_up()
+        connections.settings[REPLICA_DB_ALIAS] = connection.settings_dict | {
+            "NAME": f"file:{self.replica_path}?mode=ro",
+            "OPTIONS": {"uri": True},
+        }
+        self.addCleanup(self.remove_replica)
+        Product.objects.filter(pk=self.product.pk).update(name="Oolong, renamed")
+
+    def catch_up(self) -> None:
+        if REPLICA_DB_ALIAS in connections.settings:
+            connections[REPLICA_DB_ALIAS].close()
+        connection.ensure_connection()
+        with sqlite3.connect(self.replica_path) as replica:
+            connection.connection.backup(replica)
+        replica.close()
+
+    def remove_replica(self) -> None:
+        connections[REPLICA_DB_ALIAS].close()
+        del connections[REPLICA_DB_ALIAS]
+        del connections.settings[REPLICA_DB_ALIAS]
+
+    def test_catalog_reads_go_to_the_replica(self):
+        response = self.client.get(self.url)
+        self.assertContains(response, "The best oolong tea")
+        self.assertNotIn(PIN_COOKIE_NAME, response.cookies)
+        # outside requests, and in the primary's transactions
+        self.assertEqual(Product.objects.get().name, "Oolong, renamed")
+
+    def test_read_your_writes(self):
+        response = self.client.post(
+            reverse("cart_page"), {"product_slug": "best-oolong"}
+        )
+        self.assertIn(PIN_COOKIE_NAME, response.cookies)
+        response = self.client.get(self.url)
+        self.assertContains(response, "Oolong, renamed")
+        self.assertNotIn(PIN_COOKIE_NAME, response.cookies)
+
+        # the pin wears off
+        self.client.cookies.pop(PIN_COOKIE_NAME)
+        self.assertContains(self.client.get(self.url), "The best oolong tea")
+
+    async def test_async_read_your_writes(self):
+        response = await self.async_client.post(
+            reverse("cart_page"), {"product_slug": "best-oolong"}
+        )
+        # the reservation was written from another thread
+        self.assertIn(PIN_COOKIE_NAME, response.cookies)
+
+    @override_settings(CACHES=LOCMEM_CACHE, DATABASE_REPLICA_PIN_SECONDS=1)
+    def test_stale_replica_reads_are_cached_briefly(self):
+        self.product.name = "Oolong, renamed"
+        self.product.save()
+        # behind the edit, and cached under the versions it bumped
+        self.client.get(self.url)
+        self.assertContains(self.client.get(self.url), "The best oolong tea")
+        self.catch_up()
+        self.assertContains(self.client.get(self.url), "The best oolong tea")
+
+        time.sleep(1.1)
+        self.assertContains(self.client.get(self.url), "Oolong, renamed")
+
+    def test_cart_reads_go_to_the_primary(self):
+        self.client.post(reverse("cart_page"), {"product_slug": "best-oolong"})
+        self.client.cookies.pop(PIN_COOKIE_NAME)
+        response = self.client.get(reverse("cart_page"))
+        self.assertEqual(response.context["cart"].get_items().count(), 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, SESSION_ENGINE="TeaShop.sessions")
+class SessionStoreTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        caches["default"].clear()
+
+    def shop(self) -> dict[str, int]:
+        # a guest's visit, session reads and writes
+        counts = {"reads": 0, "writes": 0}
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse("cart_page"), {"product_slug": "best-oolong"})
+            self.client.get(reverse("cart_page"))
+            self.client.get(self.product.get_absolute_url())
+            self.client.post(reverse("cart_page"), {"product_slug": "best-oolong"})
+            self.client.get(reverse("cart_page"))
+        for query in queries.captured_queries:
+            if "django_session" in query["sql"]:
+                kind = "reads" if query["sql"].startswith("SELECT") else "writes"
+                counts[kind] += 1
+        return counts
+
+    def get_stored_session(self) -> dict:
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        return Session.objects.get(session_key=session_key).get_decoded()
+
+    def test_fewer_session_queries(self):
+        with self.settings(SESSION_ENGINE="django.contrib.sessions.backends.db"):
+            # the product page reads it too, for the cart badge
+            self.assertEqual(self.shop(), {"reads": 5, "writes": 2})
+        self.client = self.client_class()
+        # the insert and the cart id, after the response
+        self.assertEqual(self.shop(), {"reads": 0, "writes": 2})
+        self.assertIn(SESSION_CART_KEY, self.get_stored_session())
+
+    @override_settings(SESSION_SAVE_EVERY_REQUEST=True)
+    def test_unchanged_sessions_are_not_written(self):
+        self.client.post(reverse("cart_page"), {"product_slug": "best-oolong"})
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("cart_page"))
+        self.assertFalse(
+            [query for query in queries if "django_session" in query["sql"]]
+        )
+
+    def test_read_from_the_database_when_not_cached(self):
+        self.client.post(reverse("cart_page"), {"product_slug": "best-oolong"})
+        caches["default"].clear()
+        response = self.client.get(reverse("cart_page"))
+        self.assertEqual(response.context["cart"].get_items().count(), 1)
+
+    def test_deleted_meanwhile(self):
+        self.client.post(reverse("cart_page"), {"product_slug": "best-oolong"})
+        session = self.client.session
+        session["something"] = "else"
+        session.write_behind = True
+        session.save()
+        Session.objects.all().delete()
+        session.save_pending()
+        self.assertFalse(Session.objects.exists())
+        self.assertNotIn("something", self.client.session)
+
+    def test_logout(self):
+        user = User.objects.create_user(username="shopper", password="secret")
+        self.client.force_login(user)
+        self.client.post(reverse("cart_page"), {"product_slug": "best-oolong"})
+        self.assertIn(SESSION_USER_CART_KEY, self.get_stored_session())
+        self.client.logout()
+        self.assertFalse(Session.objects.exists())
+        self.assertNotIn(SESSION_USER_CART_KEY, self.client.session)
+
+
+class SeedShopCommandTests(TestCase):
+    def seed(self, *args) -> str:
+        return call_command(
+            "seed_shop",
+            "--products=50",
+            "--categories=5",
+            "--product-types=2",
+            "--guest-carts=7",
+            "--user-carts=4",
+            "--batch-size=20",
+            *args,
+            stdout=StringIO(),
+        )
+
+    def test_seed_shop(self):
+        output = self.seed()
+        self.assertIn("Seeded 50 products", output)
+        self.assertEqual(Product.objects.count(), 50)
+        self.assertEqual(Category.objects.count(), 5)
+        self.assertEqual(ProductType.objects.count(), 2)
+        self.assertIn(
+            f"with {Product.categories.through.objects.count()} category links", output
+        )
+        # bulk inserts send no signals, the command builds the cards itself
+        self.assertEqual(
+            Product.objects.filter(card__isnull=False).count(), Product.objects.count()
+        )
+
+        guest_carts = Cart.objects.filter(user__isnull=True)
+        self.assertEqual(guest_carts.count(), 7)
+        self.assertEqual(Cart.objects.filter(user__isnull=False).count(), 4)
+        for cart in guest_carts:
+            session = SessionStore(cart.session_key)
+            self.assertEqual(session[SESSION_CART_KEY], cart.id)
+        self.assertFalse(Cart.objects.filter(cartitem__isnull=True).exists())
+        self.assertEqual(
+            sorted(CartItem.objects.values_list("cart", "product", "quantity")),
+            sorted(StockReservation.objects.values_list("cart", "product", "quantity")),
+        )
+
+        # nothing left behind for the orphan cleanup
+        self.assertIn(
+            "Removed 0 carts with expired sessions! Removed 0 completely orphaned",
+            call_command("remove_orphaned_carts", stdout=StringIO()),
+        )
+
+    def test_seeds_live_side_by_side(self):
+        self.seed()
+        first = list(Product.objects.order_by("slug").values_list("slug", "name"))
+        with self.assertRaises(CommandError):
+            self.seed()
+        self.seed("--seed=1")
+        self.assertEqual(Product.objects.count(), 100)
+        self.assertEqual(
+            list(
+                Product.objects.filter(slug__startswith="seed0-")
+                .order_by("slug")
+                .values_list("slug", "name")
+            ),
+            first,
+        )
+
+
+class LoadTestCommandTests(TransactionTestCase):
+    # shoppers run in threads, the catalog has to be committed
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        category = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        for i in range(3):
+            product = Product.objects.create(
+                name=f"Oolong tea {i}",
+                description="Sooo fragrant",
+                is_published=True,
+                quantity=42,
+                product_type=ptype,
+                slug=f"oolong-{i}",
+            )
+            product.categories.add(category)
+
+    def loadtest(self, *args) -> str:
+        output = StringIO()
+        call_command(
+            "loadtest",
+            "--workers=1",
+            "--requests=30",
+            *args,
+            stdout=output,
+            stderr=StringIO(),
+        )
+        return output.getvalue()
+
+    def test_report_and_baseline(self):
+        with tempfile.NamedTemporaryFile(suffix=".json") as baseline:
+            self.loadtest(
+                "--mix=add_to_cart=1,cart_page=1", f"--output={baseline.name}"
+            )
+            with open(baseline.name) as f:
+                report = json.load(f)
+            self.assertEqual(report["total"]["requests"], 30)
+            self.assertEqual(report["total"]["errors"], 0)
+            self.assertEqual(set(report["endpoints"]), {"add_to_cart", "cart_page"})
+            self.assertGreater(
+                report["endpoints"]["add_to_cart"]["queries_per_request"], 0
+            )
+            for key in ("p50_ms", "p95_ms", "p99_ms", "db_ms_per_request"):
+                self.assertIn(key, report["endpoints"]["cart_page"])
+
+            output = self.loadtest(f"--baseline={baseline.name}")
+            self.assertIn("Against the baseline:", output)
+            self.assertRegex(output, r"cart_page +req/s [+-]\d+%")
+
+        # the shoppers' carts and sessions are gone, and so are their holds
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertFalse(Session.objects.exists())
+        self.assertEqual(
+            list(Product.objects.values_list("quantity", flat=True)), [42] * 3
+        )
+
+    def product_page_queries(self) -> float:
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            self.loadtest("--mix=product_details=1", f"--output={output.name}")
+            with open(output.name) as f:
+                report = json.load(f)
+        return report["endpoints"]["product_details"]["queries_per_request"]
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+    )
+    def test_queries_on_every_database(self):
+        on_primary = self.product_page_queries()
+
+        # catalog reads go to a replica, a copy of the test database
+        scratch = tempfile.TemporaryDirectory()
+        self.addCleanup(scratch.cleanup)
+        path = f"{scratch.name}/replica.sqlite3"
+        connection.ensure_connection()
+        with sqlite3.connect(path) as replica:
+            connection.connection.backup(replica)
+        replica.close()
+        connections.settings[REPLICA_DB_ALIAS] = connection.settings_dict | {
+            "NAME": f"file:{path}?mode=ro",
+            "OPTIONS": {"uri": True},
+        }
+        try:
+            with override_settings(
+                DATABASE_ROUTERS=["TeaShop.routers.ReadReplicaRouter"],
+                MIDDLEWARE=["TeaShop.routers.PrimaryPinMiddleware"]
+                + settings.MIDDLEWARE,
+            ):
+                self.assertEqual(self.product_page_queries(), on_primary)
+        finally:
+            connections[REPLICA_DB_ALIAS].close()
+            del connections[REPLICA_DB_ALIAS]
+            del connections.settings[REPLICA_DB_ALIAS]
+
+    def test_invalid_mix(self):
+        for mix in ("checkout=1", "cart_page=x", "cart_page=0"):
+            with self.subTest(mix), self.assertRaises(CommandError):
+                self.loadtest(f"--mix={mix}")
@@ -0,0 +1,21 @@
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from django.db import transaction
+
+
+@contextmanager
+def immediate_atomic(using: Optional[str] = None) -> Iterator[None]:
+    # `transaction.atomic()` for the units that read stock and then write it.
+    # On SQLite the transaction takes the write lock when it begins, so it
+    # queues behind other writers on `busy_timeout` rather than failing with
+    # "database is locked" when its read lock can't be upgraded. Nested
+    # blocks are savepoints of a transaction that already began
+    connection = transaction.get_connection(using)
+    if connection.vendor == "sqlite" and not connection.in_atomic_block:
+        connection.next_transaction_mode = "IMMEDIATE"
+    try:
+        with transaction.atomic(using=using):
+            yield
+    finally:
+        connection.next_transaction_mode = None
@@ -18,14 +18,24 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
-from products.views import FeaturedProductsView
+from products.views import AsyncFeaturedProductsView, FeaturedProductsView
+
+# when served by ASGI with `settings.ASYNC_VIEWS` on
+featured_products_view = (
+    AsyncFeaturedProductsView if settings.ASYNC_VIEWS else FeaturedProductsView
+)
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("", include("pages.urls")),
     path("shop/cart/", include("cart.urls")),
+    path("shop/orders/", include("orders.urls")),
     path("shop/", include("products.urls")),
-    path("tea-of-the-month/", FeaturedProductsView.as_view(), name="featured_products"),
+    path(
+        "tea-of-the-month/",
+        featured_products_view.as_view(),
+        name="featured_products",
+    ),
 ]
 
 if settings.DEBUG:
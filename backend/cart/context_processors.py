@@ -0,0 +1,12 @@
+from django.http import HttpRequest
+from django.utils.functional import SimpleLazyObject
+
+
+def cart_badge(request: HttpRequest) -> dict:
+    # Item count and subtotals for the header of every page. Served from the
+    # cart summaries the cache keeps up to date whenever a cart changes, so a
+    # page render resolves no cart and runs no cart queries. Lazy, pages that
+    # don't show it don't look it up.
+    if not hasattr(request, "cart"):
+        return {}
+    return {"cart_badge": SimpleLazyObject(request.cart.get_summary)}
@@ -0,0 +1,201 @@
+import secrets
+from typing import Optional
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpRequest, HttpResponse
+from products.models import Product
+
+from .models import Cart, CartItem, OutOfStock, StockReservation
+
+# Anonymous carts can be kept out of the database entirely, as a compact
+# {product id: quantity} map in a signed cookie or in the cache. They only
+# become `Cart` rows once the visitor logs in or checks out.
+GUEST_CART_SALT = "cart.guest"
+
+
+class GuestCart:
+    # the parts of the `Cart` API the cart page uses
+    def __init__(self, items: Optional[dict[int, int]] = None) -> None:
+        self.items: dict[int, int] = dict(items or {})
+        self.modified = False
+
+    def add_product(
+        self, product: Product, quantity: int = 1, set_quantity: bool = False
+    ) -> None:
+        if not set_quantity:
+            quantity += self.items.get(product.pk, 0)
+        # nothing is reserved before the cart is in the database, only checked
+        if quantity > product.quantity:
+            raise OutOfStock(product, quantity)
+        self.items[product.pk] = quantity
+        self.modified = True
+
+    async def aadd_product(
+        self, product: Product, quantity: int = 1, set_quantity: bool = False
+    ) -> None:
+        self.add_product(product, quantity, set_quantity)
+
+    def remove_product(self, product: Product) -> None:
+        if self.items.pop(product.pk, None) is not None:
+            self.modified = True
+
+    async def aremove_product(self, product: Product) -> None:
+        self.remove_product(product)
+
+    def get_items(self) -> list[CartItem]:
+        # unsaved items, products that are gone since are left out
+        return self._make_items(Product.objects.for_links().in_bulk(self.items))
+
+    async def aget_items(self) -> list[CartItem]:
+        return self._make_items(await Product.objects.for_links().ain_bulk(self.items))
+
+    def _make_items(self, products: dict[int, Product]) -> list[CartItem]:
+        return [
+            CartItem(product=products[product_id], quantity=quantity)
+            for product_id, quantity in self.items.items()
+            if product_id in products
+        ]
+
+    def materialize(
+        self, user=None, session_key: Optional[str] = None
+    ) -> Optional[Cart]:
+        products = Product.objects.in_bulk(self.items)
+        if not products:
+            return None
+        cart = Cart.objects.create(user=user, session_key=session_key)
+        CartItem.objects.bulk_create(
+            CartItem(cart=cart, product=product, quantity=self.items[product_id])
+            for product_id, product in products.items()
+        )
+        for product_id, product in products.items():
+            try:
+                StockReservation.objects.reserve(cart, product, self.items[product_id])
+            except OutOfStock:
+                # sold out since it was checked, checkout checks it again
+                pass
+        cart.changed()
+        return cart
+
+    def dump(self) -> list[list[int]]:
+        return [[product_id, quantity] for product_id, quantity in self.items.items()]
+
+    @classmethod
+    def load(cls, data) -> Optional["GuestCart"]:
+        try:
+            items = {int(product_id): int(quantity) for product_id, quantity in data}
+        except (TypeError, ValueError):
+            return None
+        if any(quantity < 1 for quantity in items.values()):
+            return None
+        return cls(items)
+
+
+class SignedCookieGuestCartStore:
+    # the whole cart travels with the request, nothing is stored server side
+    def load(self, request: HttpRequest) -> Optional[GuestCart]:
+        value = request.COOKIES.get(settings.CART_GUEST_COOKIE_NAME)
+        if not value:
+            return None
+        try:
+            data = signing.loads(
+                value, salt=GUEST_CART_SALT, max_age=settings.SESSION_COOKIE_AGE
+            )
+        except signing.BadSignature:
+            return None
+        return GuestCart.load(data)
+
+    async def aload(self, request: HttpRequest) -> Optional[GuestCart]:
+        return self.load(request)
+
+    def save(
+        self, request: HttpRequest, response: HttpResponse, guest_cart: GuestCart
+    ) -> None:
+        value = signing.dumps(guest_cart.dump(), salt=GUEST_CART_SALT, compress=True)
+        set_cookie(response, value)
+
+    def delete(self, request: HttpRequest, response: HttpResponse) -> None:
+        delete_cookie(response)
+
+
+class CacheGuestCartStore:
+    # the cookie only holds a random token, the cart is kept in the cache
+    def get_cache_key(self, token: str) -> str:
+        return f"cart:guest:{token}"
+
+    def get_token(self, request: HttpRequest) -> Optional[str]:
+        value = request.COOKIES.get(settings.CART_GUEST_COOKIE_NAME)
+        if not value:
+            return None
+        try:
+            return signing.loads(value, salt=GUEST_CART_SALT)
+        except signing.BadSignature:
+            return None
+
+    def load(self, request: HttpRequest) -> Optional[GuestCart]:
+        if not (token := self.get_token(request)):
+            return None
+        data = caches[settings.CART_GUEST_CACHE_ALIAS].get(self.get_cache_key(token))
+        return GuestCart.load(data) if data else None
+
+    async def aload(self, request: HttpRequest) -> Optional[GuestCart]:
+        if not (token := self.get_token(request)):
+            return None
+        data = await caches[settings.CART_GUEST_CACHE_ALIAS].aget(
+            self.get_cache_key(token)
+        )
+        return GuestCart.load(data) if data else None
+
+    def save(
+        self, request: HttpRequest, response: HttpResponse, guest_cart: GuestCart
+    ) -> None:
+        token = self.get_token(request) or secrets.token_urlsafe(24)
+        caches[settings.CART_GUEST_CACHE_ALIAS].set(
+            self.get_cache_key(token),
+            guest_cart.dump(),
+            timeout=settings.SESSION_COOKIE_AGE,
+        )
+        set_cookie(response, signing.dumps(token, salt=GUEST_CART_SALT))
+
+    def delete(self, request: HttpRequest, response: HttpResponse) -> None:
+        if token := self.get_token(request):
+            caches[settings.CART_GUEST_CACHE_ALIAS].delete(self.get_cache_key(token))
+        delete_cookie(response)
+
+
+def set_cookie(response: HttpResponse, value: str) -> None:
+    response.set_cookie(
+        settings.CART_GUEST_COOKIE_NAME,
+        value,
+        max_age=settings.SESSION_COOKIE_AGE,
+        secure=settings.SESSION_COOKIE_SECURE,
+        httponly=True,
+        samesite=settings.SESSION_COOKIE_SAMESITE,
+    )
+
+
+def delete_cookie(response: HttpResponse) -> None:
+    response.delete_cookie(
+        settings.CART_GUEST_COOKIE_NAME, samesite=settings.SESSION_COOKIE_SAMESITE
+    )
+
+
+GUEST_CART_STORES = {
+    "signed_cookie": SignedCookieGuestCartStore,
+    "cache": CacheGuestCartStore,
+}
+
+
+def get_guest_cart_store():
+    # None keeps guest carts in the database, like every other cart
+    backend = settings.CART_GUEST_BACKEND
+    if backend == "db":
+        return None
+    try:
+        return GUEST_CART_STORES[backend]()
+    except KeyError:
+        raise ImproperlyConfigured(
+            f"CART_GUEST_BACKEND must be one of 'db', {', '.join(map(repr, GUEST_CART_STORES))}."
+        )
@@ -0,0 +1,173 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any
+
+from cart.models import Cart, OutOfStock, StockReservation
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connections
+from django.db.models import Sum
+from products.models import Product, ProductType
+
+DB_PROFILES = ("default", "production")
+
+
+class Command(BaseCommand):
+    help = (
+        "Have concurrent carts race for the same products and check nothing is "
+        "oversold"
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument(
+            "--products",
+            type=int,
+            default=1,
+            help="Contested products, the threads take turns adding each.",
+        )
+        parser.add_argument(
+            "--stock", type=int, default=500, help="Stock of each contested product."
+        )
+        parser.add_argument(
+            "--attempts",
+            type=int,
+            default=100,
+            help="Reservations of one unit each thread tries to make.",
+        )
+        parser.add_argument(
+            "--compare-db-profiles",
+            action="store_true",
+            help=f"Run once per database profile ({', '.join(DB_PROFILES)}), each "
+            "in its own process on a scratch database, see DJANGO_DB_PROFILE.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        threads: int = options["threads"]
+        stock: int = options["stock"]
+        attempts: int = options["attempts"]
+        if threads < 1 or stock < 0 or attempts < 1 or options["products"] < 1:
+            raise CommandError("--threads, --products and --attempts must be positive.")
+        if options["compare_db_profiles"]:
+            return self.compare(options)
+
+        # throwaway catalog rows, removed again afterwards
+        slug = f"benchmark-{uuid.uuid4().hex[:12]}"
+        product_type = ProductType.objects.create(
+            name="Benchmark", slug=slug, description="benchmark_reservations"
+        )
+        products = [
+            Product.objects.create(
+                name="Benchmark tea",
+                description="benchmark_reservations",
+                quantity=stock,
+                product_type=product_type,
+                slug=f"{slug}-{i}",
+            )
+            for i in range(options["products"])
+        ]
+        carts = Cart.objects.bulk_create(Cart() for _ in range(threads))
+        start = threading.Barrier(threads)
+        reserved = [0] * threads
+        refused = [0] * threads
+        errors = []
+
+        def reserve(i: int) -> None:
+            try:
+                start.wait()
+                for n in range(attempts):
+                    try:
+                        carts[i].add_product(products[(i + n) % len(products)])
+                        reserved[i] += 1
+                    except OutOfStock:
+                        refused[i] += 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        try:
+            workers = [
+                threading.Thread(target=reserve, args=(i,)) for i in range(threads)
+            ]
+            started = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - started
+
+            held = (
+                StockReservation.objects.filter(product__in=products).aggregate(
+                    total=Sum("quantity")
+                )["total"]
+                or 0
+            )
+            left = sum(
+                Product.objects.filter(
+                    pk__in=[product.pk for product in products]
+                ).values_list("quantity", flat=True)
+            )
+        finally:
+            Cart.objects.filter(pk__in=[cart.pk for cart in carts]).delete()
+            StockReservation.objects.filter(product__in=products).delete()
+            Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+            product_type.delete()
+
+        total = sum(reserved)
+        stock *= len(products)
+        oversold = max(0, total - stock)
+        self.stdout.write(
+            f"{settings.DB_PROFILE} database profile: {threads} threads, "
+            f"{threads * attempts} attempts on {stock} in stock"
+        )
+        self.stdout.write(
+            f"{total} reserved, {sum(refused)} refused, {len(errors)} errors "
+            f"in {elapsed:.2f}s ({total / max(elapsed, 1e-6):.0f} reservations/s)"
+        )
+        for error in errors[:5]:
+            self.stderr.write(repr(error))
+        if held + left != stock:
+            self.stderr.write(
+                f"Stock doesn't add up: {held} held + {left} left != {stock}"
+            )
+        return f"Oversold: {oversold}"
+
+    def compare(self, options: dict) -> str:
+        # the profile is picked when settings load, and WAL sticks to a
+        # database file, so every profile gets a process and database of its own
+        results = []
+        with tempfile.TemporaryDirectory() as scratch:
+            for profile in DB_PROFILES:
+                env = os.environ | {
+                    "DJANGO_DB_PROFILE": profile,
+                    "DJANGO_DB_PATH": str(Path(scratch) / f"{profile}.sqlite3"),
+                }
+                command = [sys.executable, "-m", "django"]
+                for args in (
+                    ["migrate", "--verbosity=0"],
+                    [
+                        "benchmark_reservations",
+                        f"--threads={options['threads']}",
+                        f"--products={options['products']}",
+                        f"--stock={options['stock']}",
+                        f"--attempts={options['attempts']}",
+                    ],
+                ):
+                    process = subprocess.run(
+                        command + args,
+                        cwd=settings.BASE_DIR,
+                        env=env,
+                        capture_output=True,
+                        text=True,
+                    )
+                    if process.returncode:
+                        raise CommandError(f"{profile} run failed:\n{process.stderr}")
+                results.append(process.stdout.strip())
+        return "\n".join(results)
@@ -0,0 +1,32 @@
+from typing import Any
+
+from cart.models import StockReservation
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+
+class Command(BaseCommand):
+    help = (
+        "Put the stock of expired reservations, or of carts that are gone, back on sale"
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Reservations released per batch, each batch is its own transaction.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        batch_size: int = options["batch_size"]
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+
+        released = 0
+        while True:
+            batch = StockReservation.objects.expired().order_by("id")[:batch_size]
+            count = StockReservation.objects.release(batch)
+            released += count
+            if count < batch_size:
+                break
+        return f"Released {released} expired reservations."
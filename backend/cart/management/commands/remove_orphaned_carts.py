@@ -1,38 +1,128 @@
-from typing import Any, Optional
+import time
+from datetime import timedelta
+from typing import Any
 
 from cart.models import Cart
 from django.contrib.sessions.models import Session
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import transaction
+from django.db.models import Q, QuerySet
 from django.utils import timezone
 
 
+class TimeBudgetExhausted(Exception):
+    pass
+
+
 class Command(BaseCommand):
     help = "Remove carts that were tied to expired or deleted sessions and are no longer used"
 
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Carts deleted per batch, each batch is its own transaction.",
+        )
+        parser.add_argument(
+            "--inactive-days",
+            type=int,
+            default=None,
+            help="Also remove guest carts untouched for this many days, even if their session is still alive or was never recorded.",
+        )
+        parser.add_argument(
+            "--time-budget",
+            type=float,
+            default=None,
+            help="Stop after this many seconds, whatever was deleted so far stays deleted.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the carts that would be removed.",
+        )
+
     def handle(self, *args: Any, **options: Any) -> str | None:
-        expired_sessions = Session.objects.filter(expire_date__lt=timezone.now())
-        expired_cart_ids = [
-            cart_id
-            for session in expired_sessions
-            if (cart_id := session.get_decoded().get("cart_id"))
+        self.batch_size: int = options["batch_size"]
+        if self.batch_size < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        self.dry_run: bool = options["dry_run"]
+        self.verbosity: int = options["verbosity"]
+        self.deadline = (
+            time.monotonic() + options["time_budget"]
+            if options["time_budget"]
+            else None
+        )
+        self.last_progress = time.monotonic()
+
+        # carts know their session, every set below is one indexed query and
+        # the sets don't overlap
+        now = timezone.now()
+        guest_carts = Cart.objects.filter(user__isnull=True)
+        live_sessions = Session.objects.filter(expire_date__gte=now).values(
+            "session_key"
+        )
+        expired_sessions = Session.objects.filter(expire_date__lt=now).values(
+            "session_key"
+        )
+        phases = [
+            ("expired", guest_carts.filter(session_key__in=expired_sessions)),
+            (
+                "orphaned",
+                guest_carts.filter(session_key__isnull=False).exclude(
+                    session_key__in=Session.objects.values("session_key")
+                ),
+            ),
         ]
+        # carts without a recorded session can't be told apart from live ones,
+        # only their age can retire them
+        if options["inactive_days"] is not None:
+            cutoff = now - timedelta(days=options["inactive_days"])
+            phases.append(
+                (
+                    "inactive",
+                    guest_carts.filter(
+                        Q(session_key__in=live_sessions) | Q(session_key__isnull=True),
+                        last_activity__lt=cutoff,
+                    ),
+                )
+            )
 
-        expired_carts = Cart.objects.filter(id__in=expired_cart_ids)
-        expired_cart_count = expired_carts.count()
-        expired_carts.delete()
+        removed = dict.fromkeys((label for label, _ in phases), 0)
+        try:
+            for label, carts in phases:
+                removed[label] = self.remove_carts(label, carts)
+        except TimeBudgetExhausted as e:
+            label, count = e.args
+            removed[label] = count
+            self.stderr.write("Time budget exhausted, stopping early.")
 
-        # remove carts that are orphaned altogether
-        session_carts_ids = set(
-            Cart.objects.filter(user__isnull=True).values_list("id", flat=True)
-        )
+        verb = "Would remove" if self.dry_run else "Removed"
+        message = f"{verb} {removed['expired']} carts with expired sessions! {verb} {removed['orphaned']} completely orphaned carts!"
+        if "inactive" in removed:
+            message += f" {verb} {removed['inactive']} inactive carts!"
+        return f"{message} Feel free to clear expired sessions."
 
-        for session in Session.objects.filter(expire_date__gt=timezone.now()):
-            cart_id = session.get_decoded().get("cart_id")
-            if cart_id in session_carts_ids:
-                session_carts_ids.remove(cart_id)
+    def remove_carts(self, label: str, carts: QuerySet) -> int:
+        if self.dry_run:
+            return carts.count()
 
-        orphaned_carts = Cart.objects.filter(id__in=session_carts_ids)
-        orphaned_cart_count = orphaned_carts.count()
-        orphaned_carts.delete()
+        started = time.monotonic()
+        removed = 0
+        while cart_ids := list(carts.values_list("id", flat=True)[: self.batch_size]):
+            with transaction.atomic():
+                _, deleted = carts.filter(id__in=cart_ids).delete()
+            removed += deleted.get(Cart._meta.label, 0)
+            self.progress(label, removed, started)
+        return removed
 
-        return f"Removed {expired_cart_count} carts with expired sessions! Removed {orphaned_cart_count} completely orphaned carts! Feel free to clear expired sessions."
+    def progress(self, label: str, removed: int, started: float) -> None:
+        now = time.monotonic()
+        if self.verbosity >= 1 and now - self.last_progress >= 1:
+            self.last_progress = now
+            elapsed = now - started
+            self.stdout.write(
+                f"{elapsed:.1f}s: {removed} {label} carts removed ({removed / max(elapsed, 1e-6):.0f}/s)"
+            )
+        if self.deadline and now > self.deadline:
+            raise TimeBudgetExhausted(label, removed)
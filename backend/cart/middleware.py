@@ -0,0 +1,207 @@
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.http import HttpRequest, HttpResponse
+from django.utils.deprecation import MiddlewareMixin
+from TeaShop.instrumentation import timed
+
+from . import pricing
+from .guest import GuestCart, get_guest_cart_store
+from .models import SESSION_CART_KEY, SESSION_USER_CART_KEY, Cart
+
+
+class RequestCart:
+    # the request's cart, resolved lazily and at most once per request
+    def __init__(self, request: HttpRequest) -> None:
+        self.request = request
+        self._cart: Optional[Cart] = None
+        self._resolved = False
+        self.guest_store = get_guest_cart_store()
+        self._guest_cart: Optional[GuestCart] = None
+        self._guest_loaded = False
+        self._guest_discarded = False
+        self._summary: Optional[pricing.CartSummary] = None
+        self._loaded = False
+
+    def has_cart(self) -> bool:
+        # session and cookie lookups only, never touches the cart tables
+        if self._resolved:
+            return self._cart is not None
+        if self.get_guest_cart() is not None:
+            return True
+        session = self.request.session
+        return SESSION_CART_KEY in session or SESSION_USER_CART_KEY in session
+
+    def get(self, create: bool = False) -> Optional[Cart | GuestCart]:
+        if self.uses_guest_cart():
+            guest_cart = self.get_guest_cart()
+            if guest_cart is None and create:
+                guest_cart = self._guest_cart = GuestCart()
+            return guest_cart if guest_cart and (guest_cart.items or create) else None
+
+        if self._needs_resolving(create):
+            with timed("cart"):
+                self._cart = Cart.get_request_cart(self.request, create_cart=create)
+                self._resolved = True
+                if self.get_guest_cart() is not None:
+                    self._cart = self._adopt_guest_cart(self._cart)
+        return self._cart
+
+    async def aget(self, create: bool = False) -> Optional[Cart | GuestCart]:
+        await self.aload()
+        if self.uses_guest_cart() or not self._needs_resolving(create):
+            return self.get(create)
+
+        with timed("cart"):
+            self._cart = await Cart.aget_request_cart(self.request, create_cart=create)
+            self._resolved = True
+            if self.get_guest_cart() is not None:
+                # turning it into a database cart is one transaction
+                self._cart = await sync_to_async(self._adopt_guest_cart)(self._cart)
+        return self._cart
+
+    def _needs_resolving(self, create: bool) -> bool:
+        return not self._resolved or (create and self._cart is None)
+
+    async def aload(self) -> None:
+        # sessions and auth have no async API yet, so both are loaded in one
+        # thread hop up front, and only when there is a session to load.
+        # Without a cookie the session is empty and the user anonymous, which
+        # takes no queries.
+        if self._loaded:
+            return
+        if self.request.session.session_key is not None:
+            await sync_to_async(lambda: self.request.user.is_authenticated)()
+        self._loaded = True
+        if self.guest_store and not self._guest_loaded:
+            self._guest_cart = await self.guest_store.aload(self.request)
+            self._guest_loaded = True
+
+    def get_summary(self) -> pricing.CartSummary:
+        # for the header's cart badge, from the session's cart ids and cached
+        # summaries, the cart isn't resolved, see context_processors.py
+        if self._summary is None:
+            self._summary = pricing.get_badge_summary(
+                self._get_cart_ids(), self.get_guest_cart()
+            )
+        return self._summary
+
+    async def aload_summary(self) -> None:
+        # needs `aload()` first. Async views render in the event loop, where
+        # a cache miss couldn't query, so the summary is there up front.
+        if self._summary is None:
+            self._summary = await pricing.aget_badge_summary(
+                self._get_cart_ids(), self.get_guest_cart()
+            )
+
+    def _get_cart_ids(self) -> list[int]:
+        session = self.request.session
+        return [
+            cart_id
+            for key in (SESSION_CART_KEY, SESSION_USER_CART_KEY)
+            if (cart_id := session.get(key))
+        ]
+
+    def persist(self) -> Optional[Cart]:
+        # a database cart even for anonymous visitors, eg. to check out
+        if self.get_guest_cart() is None:
+            return self.get()
+        self._cart = self._adopt_guest_cart(Cart.get_request_cart(self.request))
+        self._resolved = True
+        return self._cart
+
+    def uses_guest_cart(self) -> bool:
+        return (
+            self.guest_store is not None
+            and not self._guest_discarded
+            and not self.request.user.is_authenticated
+        )
+
+    def get_guest_cart(self) -> Optional[GuestCart]:
+        if not self.guest_store or self._guest_discarded:
+            return None
+        if not self._guest_loaded:
+            self._guest_cart = self.guest_store.load(self.request)
+            self._guest_loaded = True
+        return self._guest_cart
+
+    def _adopt_guest_cart(self, cart: Optional[Cart]) -> Optional[Cart]:
+        # the guest cart becomes a database cart and goes through the usual
+        # session to user merge
+        request = self.request
+        if request.session.session_key is None:
+            request.session.save()
+        guest_db_cart = self._guest_cart.materialize(
+            session_key=request.session.session_key
+        )
+        self._guest_cart = None
+        self._guest_discarded = True
+        if guest_db_cart is None:
+            return cart
+        if cart:
+            return cart.merge_another(guest_db_cart)
+        request.session[SESSION_CART_KEY] = guest_db_cart.id
+        return Cart.get_request_cart(request)
+
+    def save(self, response: HttpResponse) -> None:
+        guest_change = self._get_guest_change()
+        if guest_change == "delete":
+            self.guest_store.delete(self.request, response)
+        elif guest_change == "save":
+            self.guest_store.save(self.request, response, self._guest_cart)
+
+    async def asave(self, response: HttpResponse) -> None:
+        if self._get_guest_change():
+            await sync_to_async(self.save)(response)
+
+    def _get_guest_change(self) -> Optional[str]:
+        if not self.guest_store:
+            return None
+        if self._guest_discarded or (self._guest_cart and not self._guest_cart.items):
+            return "delete"
+        if self._guest_cart and self._guest_cart.modified:
+            return "save"
+        return None
+
+    def discard(self, cart: Cart) -> None:
+        # an empty cart made for this request, and the session's pointer to it
+        self._unlink(cart)
+        cart.delete()
+        self.forget()
+
+    async def adiscard(self, cart: Cart) -> None:
+        self._unlink(cart)
+        await cart.adelete()
+        self.forget()
+
+    def _unlink(self, cart: Cart) -> None:
+        session = self.request.session
+        for key in (SESSION_CART_KEY, SESSION_USER_CART_KEY):
+            if session.get(key) == cart.pk:
+                del session[key]
+
+    def forget(self) -> None:
+        # the cart may have been deleted, eg. by removing its last item
+        self._cart = None
+        self._resolved = False
+
+
+class CartMiddleware(MiddlewareMixin):
+    # natively async too, so ASGI requests don't hop threads here
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        request.cart = RequestCart(request)
+        await request.cart.aload()
+        await request.cart.aload_summary()
+        response = await self.get_response(request)
+        await request.cart.asave(response)
+        return response
+
+    def process_request(self, request: HttpRequest) -> None:
+        request.cart = RequestCart(request)
+
+    def process_response(
+        self, request: HttpRequest, response: HttpResponse
+    ) -> HttpResponse:
+        if hasattr(request, "cart"):
+            request.cart.save(response)
+        return response
@@ -0,0 +1,71 @@
+# Generated by Django 4.2.5 on 2026-10-18 19:57
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def backfill_cart_sessions(apps, schema_editor):
+    # the one last time sessions have to be decoded to find their carts
+    Cart = apps.get_model("cart", "Cart")
+    Session = apps.get_model("sessions", "Session")
+    db_alias = schema_editor.connection.alias
+    store = SessionStore()
+    cookie_age = timedelta(seconds=settings.SESSION_COOKIE_AGE)
+
+    carts = []
+    sessions = Session.objects.using(db_alias).values_list(
+        "session_key", "session_data", "expire_date"
+    )
+    for session_key, session_data, expire_date in sessions.iterator(chunk_size=1000):
+        if cart_id := store.decode(session_data).get("cart_id"):
+            carts.append(
+                Cart(
+                    id=cart_id,
+                    session_key=session_key,
+                    last_activity=expire_date - cookie_age,
+                )
+            )
+        if len(carts) >= 1000:
+            Cart.objects.using(db_alias).bulk_update(
+                carts, ["session_key", "last_activity"]
+            )
+            carts = []
+    Cart.objects.using(db_alias).bulk_update(carts, ["session_key", "last_activity"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cart", "0003_cartitem_quantity_can_t_be_0"),
+        ("sessions", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="cart",
+            name="last_activity",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="cart",
+            name="session_key",
+            field=models.CharField(blank=True, max_length=40, null=True),
+        ),
+        migrations.AddIndex(
+            model_name="cart",
+            index=models.Index(fields=["session_key"], name="cart_session_key_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="cart",
+            index=models.Index(
+                condition=models.Q(("user__isnull", True)),
+                fields=["last_activity"],
+                name="guest_cart_activity_idx",
+            ),
+        ),
+        migrations.RunPython(backfill_cart_sessions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.5 on 2026-10-18 20:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0002_product_listing_indexes"),
+        ("cart", "0004_cart_session_key_last_activity"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StockReservation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("quantity", models.PositiveIntegerField()),
+                ("expires_at", models.DateTimeField()),
+                (
+                    "cart",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="cart.cart",
+                    ),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to="products.product",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["expires_at"], name="reservation_expires_at_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="stockreservation",
+            constraint=models.UniqueConstraint(
+                fields=("cart", "product"), name="one_reservation_per_cart_product"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="stockreservation",
+            constraint=models.CheckConstraint(
+                check=models.Q(("quantity__gt", 0)), name="reservation_quantity_gt_0"
+            ),
+        ),
+    ]
@@ -1,52 +1,161 @@
+from collections import Counter
+from datetime import timedelta
 from typing import Optional, Self
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models, transaction
+from django.core.exceptions import EmptyResultSet
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Case, F, OuterRef, QuerySet, Subquery, Value, When
+from django.dispatch import Signal
 from django.http import HttpRequest
+from django.utils import timezone
+from products import cache as catalog_cache
 from products.models import Product
+from TeaShop.transactions import immediate_atomic
 
 User = get_user_model()
 
+# guest carts live in the session, a logged in user's cart id is only kept
+# there as a hint so that `RequestCart.has_cart` never has to query for it
+SESSION_CART_KEY = "cart_id"
+SESSION_USER_CART_KEY = "user_cart_id"
+
+# sent with `cart_id` once a change to the cart's items is committed
+cart_changed = Signal()
+
+# how stale `Cart.last_activity` may get before a request writes it again
+ACTIVITY_UPDATE_INTERVAL = timedelta(minutes=10)
+
+
+def cart_scope(cart_id: int) -> str:
+    # versions the cart's cached summary, see pricing.py
+    return f"cart:{cart_id}"
+
+
+class OutOfStock(Exception):
+    def __init__(self, product: Product, quantity: int) -> None:
+        super().__init__(f"Not enough {product} in stock for {quantity} more.")
+        self.product = product
+        self.quantity = quantity
+
 
 class Cart(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, null=True, blank=True)
+    # the guest session that owns the cart, so orphans can be found without
+    # decoding sessions
+    session_key = models.CharField(max_length=40, null=True, blank=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["session_key"], name="cart_session_key_idx"),
+            models.Index(
+                fields=["last_activity"],
+                condition=models.Q(user__isnull=True),
+                name="guest_cart_activity_idx",
+            ),
+        ]
 
     def add_product(
         self, product: Product, quantity: int = 1, set_quantity: bool = False
     ) -> None:
-        # TODO: add quantity availability checks
-        existing_cart_item: CartItem = self.cartitem_set.filter(product=product).first()
-        if existing_cart_item:
-            existing_cart_item.quantity = (
-                quantity if set_quantity else existing_cart_item.quantity + quantity
+        self._add_product(product, quantity, set_quantity)
+        self.touch()
+
+    async def aadd_product(
+        self, product: Product, quantity: int = 1, set_quantity: bool = False
+    ) -> None:
+        # transactions have no async API yet, only the stock write takes a
+        # thread hop
+        await sync_to_async(self._add_product)(product, quantity, set_quantity)
+        await self.atouch()
+
+    def _add_product(self, product: Product, quantity: int, set_quantity: bool):
+        # raises OutOfStock, the cart is left as it was
+        with immediate_atomic():
+            if set_quantity:
+                StockReservation.objects.set_quantity(self, product, quantity)
+            else:
+                StockReservation.objects.reserve(self, product, quantity)
+            CartItem.objects.upsert(
+                cart=self, product=product, quantity=quantity, set_quantity=set_quantity
             )
-            existing_cart_item.save()
-        else:
-            CartItem.objects.create(cart=self, product=product, quantity=quantity)
+        self.changed()
+
+    def changed(self) -> None:
+        # items or quantities, cached summaries of the cart are stale
+        catalog_cache.invalidate(cart_scope(self.pk))
+        cart_id = self.pk
+        transaction.on_commit(lambda: cart_changed.send(sender=Cart, cart_id=cart_id))
 
+    def touch(self, session_key: Optional[str] = None) -> None:
+        if fields := self._touched_fields(session_key):
+            Cart.objects.filter(pk=self.pk).update(**fields)
+
+    async def atouch(self, session_key: Optional[str] = None) -> None:
+        if fields := self._touched_fields(session_key):
+            await Cart.objects.filter(pk=self.pk).aupdate(**fields)
+
+    def _touched_fields(self, session_key: Optional[str]) -> dict:
+        # throttled, most requests find the cart recently active already
+        now = timezone.now()
+        fields = {}
+        if now - self.last_activity >= ACTIVITY_UPDATE_INTERVAL:
+            fields["last_activity"] = self.last_activity = now
+        if session_key and not self.user_id and session_key != self.session_key:
+            fields["session_key"] = self.session_key = session_key
+        return fields
+
+    def get_items(self) -> models.QuerySet:
+        return self.cartitem_set.select_related("product")
+
+    async def aget_items(self) -> list["CartItem"]:
+        return [item async for item in self.get_items()]
+
+    @immediate_atomic()
     def remove_product(self, product: Product):
+        StockReservation.objects.release(
+            StockReservation.objects.filter(cart=self, product=product)
+        )
         existing_cart_item = self.cartitem_set.filter(product=product).first()
         if existing_cart_item:
             existing_cart_item.delete()
 
-    @transaction.atomic
+    async def aremove_product(self, product: Product) -> None:
+        # one transaction, see `aadd_product`
+        await sync_to_async(self.remove_product)(product)
+
+    @immediate_atomic()
     def merge_another(self, another_cart) -> Self:
         if not another_cart:
             return self
 
-        for another_cart_item in another_cart.cartitem_set.all():
-            if user_cart_item := self.cartitem_set.filter(
-                product=another_cart_item.product
-            ).first():
-                user_cart_item.quantity += another_cart_item.quantity
-                user_cart_item.save()
-            else:
-                another_cart_item.cart = self
-                another_cart_item.save()
-
+        # a fixed number of statements, however big either cart is
+        for model in (CartItem, StockReservation):
+            theirs = model.objects.filter(cart=another_cart)
+            ours = model.objects.filter(cart=self)
+            ours.filter(product__in=theirs.values("product")).update(
+                quantity=F("quantity")
+                + Subquery(
+                    theirs.filter(product=OuterRef("product")).values("quantity")
+                )
+            )
+            theirs.exclude(product__in=ours.values("product")).update(cart=self)
+        # their stock was added to our reservations, it must not be returned
+        StockReservation.objects.filter(cart=another_cart).delete()
+        another_cart.changed()
         another_cart.delete()
+        self.changed()
         return self
 
+    async def amerge_another(self, another_cart) -> Self:
+        # one transaction, see `aadd_product`
+        if not another_cart:
+            return self
+        return await sync_to_async(self.merge_another)(another_cart)
+
     def __str__(self) -> str:
         return f"{self.user or 'Session'+self.id} Cart"
 
@@ -54,15 +163,22 @@ class Cart(models.Model):
     def get_request_cart(request: HttpRequest, create_cart=False) -> Optional[Self]:
         # session/cart items are added/created on POST
         # user may or may not have session or be logged in
-        session_cart_id = request.session.get("cart_id")
         session_cart = None
-        if session_cart_id:
+        if session_cart_id := request.session.get(SESSION_CART_KEY):
             session_cart = Cart.objects.filter(pk=session_cart_id).first()
+            _found_session_cart(request, session_cart)
 
         if not request.user.is_authenticated:
-            if not session_cart and create_cart:
-                session_cart = Cart.objects.create()
-                request.session["cart_id"] = session_cart.id
+            if session_cart:
+                session_cart.touch(session_key=request.session.session_key)
+            elif create_cart:
+                if request.session.session_key is None:
+                    # the cart needs its owner's key now, not at response time
+                    request.session.save()
+                session_cart = Cart.objects.create(
+                    session_key=request.session.session_key
+                )
+                request.session[SESSION_CART_KEY] = session_cart.id
 
             return session_cart
 
@@ -80,19 +196,155 @@ class Cart(models.Model):
                 user_cart.user = request.user
                 user_cart.save()
 
-            request.session.pop("cart_id", None)
+            request.session.pop(SESSION_CART_KEY, None)
 
         if not user_cart and create_cart:
             user_cart = Cart.objects.create(user=request.user)
 
+        if user_cart:
+            user_cart.touch()
+        _remember_user_cart(request, user_cart)
         return user_cart
 
+    @staticmethod
+    async def aget_request_cart(
+        request: HttpRequest, create_cart=False
+    ) -> Optional[Self]:
+        # `get_request_cart` on the async ORM, the session and user have to be
+        # loaded already, see `RequestCart.aload`
+        session_cart = None
+        if session_cart_id := request.session.get(SESSION_CART_KEY):
+            session_cart = await Cart.objects.filter(pk=session_cart_id).afirst()
+            _found_session_cart(request, session_cart)
+
+        if not request.user.is_authenticated:
+            if session_cart:
+                await session_cart.atouch(session_key=request.session.session_key)
+            elif create_cart:
+                if request.session.session_key is None:
+                    # sessions have no async API yet
+                    await sync_to_async(request.session.save)()
+                session_cart = await Cart.objects.acreate(
+                    session_key=request.session.session_key
+                )
+                request.session[SESSION_CART_KEY] = session_cart.id
+
+            return session_cart
+
+        user_cart: Optional[Cart] = await Cart.objects.filter(
+            user=request.user
+        ).afirst()
+
+        if session_cart:
+            if user_cart:
+                await user_cart.amerge_another(session_cart)
+            else:
+                user_cart = session_cart
+                user_cart.user = request.user
+                await user_cart.asave()
+
+            request.session.pop(SESSION_CART_KEY, None)
+
+        if not user_cart and create_cart:
+            user_cart = await Cart.objects.acreate(user=request.user)
+
+        if user_cart:
+            await user_cart.atouch()
+        _remember_user_cart(request, user_cart)
+        return user_cart
+
+
+# the session bookkeeping of `Cart.get_request_cart` and its async twin
+def _found_session_cart(request: HttpRequest, cart: Optional[Cart]) -> None:
+    if not cart:
+        # emptied or cleaned up since
+        request.session.pop(SESSION_CART_KEY, None)
+
+
+def _remember_user_cart(request: HttpRequest, cart: Optional[Cart]) -> None:
+    # only a hint, see `RequestCart.has_cart`
+    if not cart:
+        request.session.pop(SESSION_USER_CART_KEY, None)
+    elif request.session.get(SESSION_USER_CART_KEY) != cart.id:
+        request.session[SESSION_USER_CART_KEY] = cart.id
+
+
+class CartQuantityManager(models.Manager):
+    def upsert(
+        self,
+        cart: Cart,
+        product: Product,
+        quantity: int,
+        set_quantity: bool = False,
+        **defaults,
+    ) -> None:
+        # add or set the quantity of a (cart, product) row in a single
+        # statement, so concurrent "add to cart" clicks can't lose increments,
+        # other `defaults` are overwritten
+        connection = connections[self.db]
+        if not connection.features.supports_update_conflicts_with_target:
+            return self._update_or_create(
+                cart, product, quantity, set_quantity, defaults
+            )
+
+        # the ORM can't express an F() increment in ON CONFLICT DO UPDATE
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        cart_column = qn(opts.get_field("cart").column)
+        product_column = qn(opts.get_field("product").column)
+        quantity_column = qn(opts.get_field("quantity").column)
+        new_quantity = f"excluded.{quantity_column}"
+        if not set_quantity:
+            new_quantity = f"{table}.{quantity_column} + {new_quantity}"
+        fields = [opts.get_field(name) for name in defaults]
+        columns = [cart_column, product_column, quantity_column] + [
+            qn(field.column) for field in fields
+        ]
+        updates = [f"{quantity_column} = {new_quantity}"] + [
+            f"{qn(field.column)} = excluded.{qn(field.column)}" for field in fields
+        ]
+        params = [cart.pk, product.pk, quantity] + [
+            field.get_db_prep_save(value, connection)
+            for field, value in zip(fields, defaults.values())
+        ]
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join(['%s'] * len(columns))}) "
+                f"ON CONFLICT ({cart_column}, {product_column}) "
+                f"DO UPDATE SET {', '.join(updates)}",
+                params,
+            )
+
+    def _update_or_create(
+        self,
+        cart: Cart,
+        product: Product,
+        quantity: int,
+        set_quantity: bool,
+        defaults: dict,
+    ) -> None:
+        items = self.filter(cart=cart, product=product)
+        new_quantity = quantity if set_quantity else F("quantity") + quantity
+        if items.update(quantity=new_quantity, **defaults):
+            return
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(cart=cart, product=product, quantity=quantity, **defaults)
+        except IntegrityError:
+            # somebody else created it in the meantime
+            items.update(quantity=new_quantity, **defaults)
+
 
 class CartItem(models.Model):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
 
+    objects = CartQuantityManager()
+
     class Meta:
         constraints = [
             models.UniqueConstraint(
@@ -111,9 +363,130 @@ class CartItem(models.Model):
         cart_item_id = self.id
         cart = self.cart
         delete_results = super().delete(*args, **kwargs)
+        cart.changed()
         if not cart.cartitem_set.exclude(id=cart_item_id).exists():
             cart.delete()
         return delete_results
 
     def __str__(self) -> str:
         return f"{self.cart} Item: {self.product}, {self.quantity}"
+
+
+class StockReservationManager(CartQuantityManager):
+    # `Product.quantity` is the stock nobody has reserved yet. It is only
+    # ever changed by conditional UPDATEs, never read, modified and written
+    # back, so concurrent carts can't oversell it.
+    def get_expiry(self):
+        return timezone.now() + timedelta(seconds=settings.CART_RESERVATION_TIMEOUT)
+
+    def reserve(self, cart: Cart, product: Product, quantity: int) -> None:
+        self._take(product, quantity)
+        self.upsert(cart, product, quantity, expires_at=self.get_expiry())
+
+    def set_quantity(self, cart: Cart, product: Product, quantity: int) -> None:
+        # the old reservation is used up by the statement that reads it, so a
+        # concurrent update is never counted twice. Adding the new one back
+        # keeps whatever was reserved in the meantime, the stock stays exact
+        with transaction.atomic(using=self.db):
+            reserved = sum(
+                reserved
+                for _, reserved in self._delete_returning(
+                    self.filter(cart=cart, product=product)
+                )
+            )
+            difference = quantity - reserved
+            if difference > 0:
+                self._take(product, difference)
+            elif difference < 0:
+                Product.objects.filter(pk=product.pk).update(
+                    quantity=F("quantity") - difference
+                )
+            if quantity > 0:
+                self.upsert(cart, product, quantity, expires_at=self.get_expiry())
+
+    def _take(self, product: Product, quantity: int) -> None:
+        taken = Product.objects.filter(pk=product.pk, quantity__gte=quantity).update(
+            quantity=F("quantity") - quantity
+        )
+        if not taken:
+            raise OutOfStock(product, quantity)
+
+    def release(self, reservations: QuerySet) -> int:
+        # deletes the reservations and puts their stock back, a reservation
+        # deleted concurrently is only ever returned once
+        with transaction.atomic(using=self.db):
+            released = self._delete_returning(reservations)
+            returned = Counter()
+            for product_id, quantity in released:
+                returned[product_id] += quantity
+            if returned:
+                Product.objects.filter(pk__in=returned).update(
+                    quantity=F("quantity")
+                    + Case(
+                        *(
+                            When(pk=product_id, then=Value(quantity))
+                            for product_id, quantity in returned.items()
+                        )
+                    )
+                )
+        return len(released)
+
+    def _delete_returning(self, reservations: QuerySet) -> list[tuple[int, int]]:
+        connection = connections[self.db]
+        if connection.vendor not in ("sqlite", "postgresql") or not (
+            connection.features.can_return_columns_from_insert
+        ):
+            rows = list(
+                reservations.select_for_update().values_list(
+                    "id", "product_id", "quantity"
+                )
+            )
+            self.filter(id__in=[row[0] for row in rows]).delete()
+            return [row[1:] for row in rows]
+
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        try:
+            subquery, params = reservations.values("id").query.sql_with_params()
+        except EmptyResultSet:
+            # eg. `cart__in=[]`, nothing to release
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {qn(opts.db_table)} WHERE {qn(opts.pk.column)} IN ({subquery}) "
+                f"RETURNING {qn(opts.get_field('product').column)}, "
+                f"{qn(opts.get_field('quantity').column)}",
+                params,
+            )
+            return cursor.fetchall()
+
+    def expired(self) -> QuerySet:
+        # carts that are gone leave their reservations behind
+        return self.filter(
+            models.Q(expires_at__lt=timezone.now()) | models.Q(cart__isnull=True)
+        )
+
+
+class StockReservation(models.Model):
+    cart = models.ForeignKey(Cart, on_delete=models.SET_NULL, null=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    objects = StockReservationManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cart", "product"], name="one_reservation_per_cart_product"
+            ),
+            models.CheckConstraint(
+                check=models.Q(quantity__gt=0), name="reservation_quantity_gt_0"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["expires_at"], name="reservation_expires_at_idx"),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.cart} Reservation: {self.product}, {self.quantity}"
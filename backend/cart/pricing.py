@@ -0,0 +1,222 @@
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Optional
+
+from django.db.models import DecimalField, ExpressionWrapper, F, QuerySet, Sum, Window
+from products import cache as catalog_cache
+
+from .guest import GuestCart
+from .models import Cart, CartItem, cart_scope
+
+# Cart totals are summed by the database, prices are Decimals all the way.
+# A cart holding products priced in several currencies has a subtotal per
+# currency, they don't add up without exchange rates.
+MONEY = DecimalField(max_digits=12, decimal_places=2)
+CENT = Decimal("0.01")
+LINE_TOTAL = ExpressionWrapper(F("quantity") * F("product__price"), output_field=MONEY)
+
+
+@dataclass
+class CartSummary:
+    item_count: int = 0
+    # currency: subtotal
+    subtotals: dict[str, Decimal] = field(default_factory=dict)
+
+
+def to_money(value) -> Decimal:
+    # SQLite does the arithmetic in floats, exact to the cent at these sizes
+    return Decimal(value).quantize(CENT)
+
+
+def _summary_scopes(cart_id: int) -> list[str]:
+    return [cart_scope(cart_id), catalog_cache.PRICES]
+
+
+def get_lines(cart: Cart) -> QuerySet:
+    # the cart page's one query: the items with their line totals, every row
+    # also carries its currency's subtotal and the cart's item count
+    return cart.get_items().annotate(
+        line_total=LINE_TOTAL,
+        currency_subtotal=Window(Sum(LINE_TOTAL), partition_by=F("product__currency")),
+        cart_item_count=Window(Sum("quantity")),
+    )
+
+
+def _guest_summary_key(guest_cart: GuestCart) -> str:
+    # guest carts are just their items, so are the keys
+    return catalog_cache.make_key(
+        "guest_cart_summary", [catalog_cache.PRICES], sorted(guest_cart.dump())
+    )
+
+
+async def _aguest_summary_key(guest_cart: GuestCart) -> str:
+    return await catalog_cache.amake_key(
+        "guest_cart_summary", [catalog_cache.PRICES], sorted(guest_cart.dump())
+    )
+
+
+def _summarize_lines(lines: list[CartItem]) -> CartSummary:
+    summary = CartSummary()
+    for line in lines:
+        line.line_total = to_money(line.line_total)
+        summary.item_count = line.cart_item_count
+        summary.subtotals[line.product.currency] = to_money(line.currency_subtotal)
+    return summary
+
+
+def _combine(summaries: list[CartSummary]) -> CartSummary:
+    combined = CartSummary()
+    for summary in summaries:
+        combined.item_count += summary.item_count
+        for currency, subtotal in summary.subtotals.items():
+            combined.subtotals[currency] = (
+                combined.subtotals.get(currency, Decimal("0.00")) + subtotal
+            )
+    return combined
+
+
+def _price_guest_items(items: list[CartItem]) -> CartSummary:
+    # a handful of unsaved items with their products loaded already
+    summary = CartSummary()
+    for item in items:
+        item.line_total = item.quantity * item.product.price
+        currency = item.product.currency
+        summary.subtotals[currency] = (
+            summary.subtotals.get(currency, Decimal("0.00")) + item.line_total
+        )
+        summary.item_count += item.quantity
+    return summary
+
+
+def get_cart_lines(
+    cart: Optional[Cart | GuestCart],
+) -> tuple[list[CartItem], CartSummary]:
+    if cart is None:
+        return [], CartSummary()
+    if isinstance(cart, GuestCart):
+        items = cart.get_items()
+        summary = _price_guest_items(items)
+        catalog_cache.set_entry(_guest_summary_key(cart), summary)
+        return items, summary
+    lines = list(get_lines(cart))
+    summary = _summarize_lines(lines)
+    # for the header summaries of the next pages
+    catalog_cache.set_entry(
+        catalog_cache.make_key("cart_summary", _summary_scopes(cart.pk)), summary
+    )
+    return lines, summary
+
+
+async def aget_cart_lines(
+    cart: Optional[Cart | GuestCart],
+) -> tuple[list[CartItem], CartSummary]:
+    if cart is None:
+        return [], CartSummary()
+    if isinstance(cart, GuestCart):
+        items = await cart.aget_items()
+        summary = _price_guest_items(items)
+        await catalog_cache.aset_entry(await _aguest_summary_key(cart), summary)
+        return items, summary
+    lines = [line async for line in get_lines(cart)]
+    summary = _summarize_lines(lines)
+    await catalog_cache.aset_entry(
+        await catalog_cache.amake_key("cart_summary", _summary_scopes(cart.pk)), summary
+    )
+    return lines, summary
+
+
+def _aggregate_summary(cart_id: int) -> QuerySet:
+    # one row per currency, one query
+    return (
+        CartItem.objects.filter(cart_id=cart_id)
+        .values_list("product__currency")
+        .annotate(subtotal=Sum(LINE_TOTAL), item_count=Sum("quantity"))
+        .order_by()
+    )
+
+
+def _summary_from_rows(rows) -> CartSummary:
+    return CartSummary(
+        item_count=sum(item_count for _, _, item_count in rows),
+        subtotals={currency: to_money(subtotal) for currency, subtotal, _ in rows},
+    )
+
+
+def _cart_summary(cart_id: int) -> CartSummary:
+    key = catalog_cache.make_key("cart_summary", _summary_scopes(cart_id))
+    if (summary := catalog_cache.get_entry(key)) is None:
+        summary = _summary_from_rows(list(_aggregate_summary(cart_id)))
+        catalog_cache.set_entry(key, summary)
+    return summary
+
+
+async def _acart_summary(cart_id: int) -> CartSummary:
+    key = await catalog_cache.amake_key("cart_summary", _summary_scopes(cart_id))
+    if (summary := await catalog_cache.aget_entry(key)) is None:
+        summary = _summary_from_rows([row async for row in _aggregate_summary(cart_id)])
+        await catalog_cache.aset_entry(key, summary)
+    return summary
+
+
+def _guest_summary(guest_cart: GuestCart) -> CartSummary:
+    key = _guest_summary_key(guest_cart)
+    if (summary := catalog_cache.get_entry(key)) is None:
+        summary = _price_guest_items(guest_cart.get_items())
+        catalog_cache.set_entry(key, summary)
+    return summary
+
+
+async def _aguest_summary(guest_cart: GuestCart) -> CartSummary:
+    key = await _aguest_summary_key(guest_cart)
+    if (summary := await catalog_cache.aget_entry(key)) is None:
+        summary = _price_guest_items(await guest_cart.aget_items())
+        await catalog_cache.aset_entry(key, summary)
+    return summary
+
+
+def refresh_summary(cart_id: int) -> None:
+    # after a committed change, so pages read it from the cache rather than
+    # the first one after the change summing the cart
+    catalog_cache.set_entry(
+        catalog_cache.make_key("cart_summary", _summary_scopes(cart_id)),
+        _summary_from_rows(list(_aggregate_summary(cart_id))),
+    )
+
+
+def get_summary(cart: Optional[Cart | GuestCart]) -> CartSummary:
+    # item count and subtotals without the items, eg. for a header, cached
+    # until the cart or a price changes
+    if cart is None:
+        return CartSummary()
+    if isinstance(cart, GuestCart):
+        return _guest_summary(cart)
+    return _cart_summary(cart.pk)
+
+
+async def aget_summary(cart: Optional[Cart | GuestCart]) -> CartSummary:
+    if cart is None:
+        return CartSummary()
+    if isinstance(cart, GuestCart):
+        return await _aguest_summary(cart)
+    return await _acart_summary(cart.pk)
+
+
+def get_badge_summary(
+    cart_ids: list[int], guest_cart: Optional[GuestCart]
+) -> CartSummary:
+    # the header's cart badge, over every cart the session points at, which
+    # are merged into one the next time the cart is resolved. The carts
+    # themselves aren't looked up, their cached summaries are enough.
+    summaries = [_cart_summary(cart_id) for cart_id in cart_ids]
+    if guest_cart is not None:
+        summaries.append(_guest_summary(guest_cart))
+    return _combine(summaries)
+
+
+async def aget_badge_summary(
+    cart_ids: list[int], guest_cart: Optional[GuestCart]
+) -> CartSummary:
+    summaries = [await _acart_summary(cart_id) for cart_id in cart_ids]
+    if guest_cart is not None:
+        summaries.append(await _aguest_summary(guest_cart))
+    return _combine(summaries)
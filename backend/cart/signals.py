@@ -0,0 +1,35 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db import DatabaseError
+from django.dispatch import receiver
+
+from . import pricing
+from .models import SESSION_CART_KEY, SESSION_USER_CART_KEY, Cart, cart_changed
+
+
+@receiver(user_logged_in)
+def remember_user_cart(sender, request, user, **kwargs):
+    if request is None or not hasattr(request, "session"):
+        return
+    if guest_cart_id := request.session.get(SESSION_CART_KEY):
+        # login cycles the session key, a guest cart still waiting to be
+        # merged must not look orphaned in the meantime
+        Cart.objects.filter(pk=guest_cart_id, user__isnull=True).update(
+            session_key=request.session.session_key
+        )
+    if (
+        user_cart_id := Cart.objects.filter(user=user)
+        .values_list("id", flat=True)
+        .first()
+    ):
+        request.session[SESSION_USER_CART_KEY] = user_cart_id
+
+
+@receiver(cart_changed)
+def refresh_cart_summary(sender, cart_id: int, **kwargs):
+    # the next page's cart badge finds it cached, see context_processors.py
+    try:
+        pricing.refresh_summary(cart_id)
+    except DatabaseError:
+        # eg. the database is busy, the change is committed all the same and
+        # the next page sums the cart itself
+        pass
@@ -1,10 +1,49 @@
-from django.contrib.auth import get_user_model
-from django.test import TestCase
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user, get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage import default_storage
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import OperationalError, connection, connections
+from django.test import (
+    AsyncRequestFactory,
+    Client,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import resolve, reverse
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from django.utils.text import slugify
 from products.models import Category, Product, ProductType
 
-from .models import Cart, CartItem
-from .views import CartPageView
+from . import pricing
+from .guest import GuestCart
+from .middleware import CartMiddleware, RequestCart
+from .models import (
+    SESSION_CART_KEY,
+    SESSION_USER_CART_KEY,
+    Cart,
+    CartItem,
+    OutOfStock,
+    StockReservation,
+    StockReservationManager,
+)
+from .views import AsyncCartPageView, CartPageView
 
 User = get_user_model()
 UNAME = "doggoteamaster"
@@ -306,5 +345,1066 @@ class CartPageTests(TestCase):
 
         self.assertEqual(Cart.objects.count(), 1)
 
+    def test_failed_add_makes_no_cart(self):
+        data = {"product_slug": "best-oolong", "quantity": 50}
+        self.client.post(self.url, data)
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+        # stock that went between the check and the add
+        out_of_stock = OutOfStock(self.product1, 1)
+        with mock.patch.object(Cart, "_add_product", side_effect=out_of_stock):
+            self.client.post(self.url, {"product_slug": "best-oolong"})
+        self.assertFalse(Cart.objects.exists())
+        self.assertNotIn(SESSION_CART_KEY, self.client.session)
+
     def test_out_of_stock(self):
-        raise NotImplementedError
+        self.client.post(
+            self.url,
+            {"product_slug": "best-oolong", "set_quantity": True, "quantity": 50},
+        )
+        response = self.client.get(self.url)
+        self.assertContains(response, "there isn&#x27;t enough The best oolong tea")
+        self.assertContains(response, "No items in cart 🛒")
+        self.product1.refresh_from_db()
+        self.assertEqual(self.product1.quantity, 42)
+
+        self.client.post(
+            self.url,
+            {"product_slug": "best-oolong", "set_quantity": True, "quantity": 42},
+        )
+        self.product1.refresh_from_db()
+        self.assertEqual(self.product1.quantity, 0)
+
+        # somebody else can't have any of it anymore
+        other_client = Client()
+        other_client.login(username=UNAME, password=UPWORD)
+        other_client.post(self.url, {"product_slug": "best-oolong"})
+        self.assertFalse(CartItem.objects.filter(cart__user=self.user).exists())
+
+        # lowering the quantity and removing the item put the stock back
+        self.client.post(
+            self.url,
+            {"product_slug": "best-oolong", "set_quantity": True, "quantity": 40},
+        )
+        self.product1.refresh_from_db()
+        self.assertEqual(self.product1.quantity, 2)
+        self.client.post(
+            self.url, {"product_slug": "best-oolong", "remove_from_cart": True}
+        )
+        self.product1.refresh_from_db()
+        self.assertEqual(self.product1.quantity, 42)
+        self.assertFalse(StockReservation.objects.exists())
+
+
+class CartAddProductTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        self.cart = Cart.objects.create()
+
+    def test_add_product_never_reads_before_writing(self):
+        for quantity in (1, 2):
+            with CaptureQueriesContext(connection) as queries:
+                self.cart.add_product(self.product, quantity=quantity)
+            statements = [
+                q["sql"].split()[0]
+                for q in queries.captured_queries
+                if "SAVEPOINT" not in q["sql"]
+            ]
+            # reserve the stock, then upsert the reservation and the item
+            self.assertEqual(statements, ["UPDATE", "INSERT", "INSERT"])
+        self.assertEqual(self.cart.cartitem_set.get().quantity, 3)
+
+    def test_set_quantity(self):
+        self.cart.add_product(self.product, quantity=5, set_quantity=True)
+        self.assertEqual(self.cart.cartitem_set.get().quantity, 5)
+        self.cart.add_product(self.product, quantity=2, set_quantity=True)
+        self.assertEqual(self.cart.cartitem_set.get().quantity, 2)
+        self.cart.add_product(self.product, quantity=4)
+        self.assertEqual(self.cart.cartitem_set.get().quantity, 6)
+        self.assertEqual(StockReservation.objects.get().quantity, 6)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 42 - 6)
+
+    def test_interleaved_set_quantity(self):
+        self.cart.add_product(self.product, quantity=5, set_quantity=True)
+        delete_returning = StockReservationManager._delete_returning
+        interleaved = []
+
+        def update_first(manager, reservations):
+            # another request sets the quantity while this one is on its way
+            if not interleaved:
+                interleaved.append(True)
+                self.cart.add_product(self.product, quantity=3, set_quantity=True)
+            return delete_returning(manager, reservations)
+
+        with mock.patch.object(
+            StockReservationManager,
+            "_delete_returning",
+            autospec=True,
+            side_effect=update_first,
+        ):
+            self.cart.add_product(self.product, quantity=2, set_quantity=True)
+        # the last update wins, and only the stock it holds is gone
+        self.assertEqual(self.cart.cartitem_set.get().quantity, 2)
+        self.assertEqual(StockReservation.objects.get().quantity, 2)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 42 - 2)
+
+
+class CartMergeTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.products = Product.objects.bulk_create(
+            Product(
+                name=f"Tea {i}",
+                description="Very tea",
+                is_published=True,
+                quantity=1000,
+                product_type=ptype,
+                slug=f"tea-{i}",
+            )
+            for i in range(60)
+        )
+        self.user = User.objects.create_user(
+            username=UNAME, email=UEMAIL, password=UPWORD
+        )
+
+    def make_carts(self, guest_items: int) -> tuple[Cart, Cart]:
+        user_cart = Cart.objects.create(user=self.user)
+        guest_cart = Cart.objects.create()
+        # every other guest product is already in the user cart
+        for i, product in enumerate(self.products[:guest_items]):
+            guest_cart.add_product(product, quantity=i + 1)
+            if i % 2 == 0:
+                user_cart.add_product(product, quantity=100)
+        return user_cart, guest_cart
+
+    def test_merge(self):
+        user_cart, guest_cart = self.make_carts(6)
+        user_cart.add_product(self.products[59], quantity=7)
+
+        self.assertEqual(user_cart.merge_another(guest_cart), user_cart)
+
+        self.assertFalse(Cart.objects.filter(pk=guest_cart.pk).exists())
+        self.assertEqual(
+            dict(user_cart.cartitem_set.values_list("product__slug", "quantity")),
+            {
+                "tea-0": 101,
+                "tea-1": 2,
+                "tea-2": 103,
+                "tea-3": 4,
+                "tea-4": 105,
+                "tea-5": 6,
+                "tea-59": 7,
+            },
+        )
+        # reservations follow the items, no stock is returned or lost
+        self.assertEqual(
+            dict(StockReservation.objects.values_list("product__slug", "quantity")),
+            dict(user_cart.cartitem_set.values_list("product__slug", "quantity")),
+        )
+        self.assertEqual(Product.objects.get(slug="tea-0").quantity, 1000 - 101)
+
+    def test_merge_cost_does_not_grow_with_cart_size(self):
+        query_counts = []
+        for guest_items in (2, 50):
+            user_cart, guest_cart = self.make_carts(guest_items)
+            with CaptureQueriesContext(connection) as queries:
+                user_cart.merge_another(guest_cart)
+            query_counts.append(len(queries))
+            self.assertEqual(user_cart.cartitem_set.count(), guest_items)
+            user_cart.delete()
+        self.assertEqual(query_counts[0], query_counts[1])
+
+
+class RequestCartTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        self.user = User.objects.create_user(
+            username=UNAME, email=UEMAIL, password=UPWORD
+        )
+        self.url = reverse("cart_page")
+
+    def make_request(self, user=None, **session):
+        request = RequestFactory().get(self.url)
+        request.user = user or AnonymousUser()
+        request.session = SessionStore()
+        request.session.update(session)
+        return request
+
+    def test_anonymous_visitors_without_cart_cost_nothing(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertContains(response, "No items in cart 🛒")
+
+        request = self.make_request()
+        with self.assertNumQueries(0):
+            self.assertFalse(RequestCart(request).has_cart())
+            self.assertIsNone(RequestCart(request).get())
+
+    def test_cart_is_resolved_once(self):
+        cart = Cart.objects.create()
+        request = self.make_request(cart_id=cart.id)
+        request_cart = RequestCart(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(request_cart.get(), cart)
+            self.assertEqual(request_cart.get(), cart)
+            self.assertTrue(request_cart.has_cart())
+
+    def test_create_after_empty_resolution(self):
+        request_cart = RequestCart(self.make_request())
+        self.assertIsNone(request_cart.get())
+        cart = request_cart.get(create=True)
+        self.assertIsNotNone(cart)
+        self.assertEqual(request_cart.get(), cart)
+
+    def test_has_cart_never_queries_cart_tables(self):
+        cart = Cart.objects.create(user=self.user)
+        self.client.login(username=UNAME, password=UPWORD)
+        self.assertEqual(self.client.session[SESSION_USER_CART_KEY], cart.id)
+
+        request = self.make_request(user=self.user, **self.client.session)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(RequestCart(request).has_cart())
+        self.assertFalse(any("cart_" in q["sql"] for q in queries.captured_queries))
+
+        self.assertFalse(RequestCart(self.make_request(user=self.user)).has_cart())
+
+    def test_stale_cart_hint_is_dropped(self):
+        cart = Cart.objects.create()
+        request = self.make_request(cart_id=cart.id)
+        cart.delete()
+        request_cart = RequestCart(request)
+        self.assertTrue(request_cart.has_cart())
+        self.assertIsNone(request_cart.get())
+        self.assertFalse(request_cart.has_cart())
+        self.assertFalse(RequestCart(request).has_cart())
+
+
+class RemoveOrphanedCartsTests(TestCase):
+    def setUp(self) -> None:
+        now = timezone.now()
+        self.live_carts = [
+            Cart.objects.create(session_key=f"live{i}") for i in range(7)
+        ]
+        self.expired_carts = [
+            Cart.objects.create(session_key=f"expired{i}") for i in range(5)
+        ]
+        # sessions deleted since
+        self.orphaned_carts = [
+            Cart.objects.create(session_key=f"gone{i}") for i in range(3)
+        ]
+        # never had a session recorded, only their age tells
+        self.keyless_cart = Cart.objects.create()
+        self.user_cart = Cart.objects.create(
+            user=User.objects.create_user(
+                username=UNAME, email=UEMAIL, password=UPWORD
+            ),
+            session_key="expired0",
+        )
+        Session.objects.bulk_create(
+            Session(
+                session_key=cart.session_key,
+                session_data="",
+                expire_date=now + timedelta(days=-1 if expired else 1),
+            )
+            for carts, expired in ((self.live_carts, False), (self.expired_carts, True))
+            for cart in carts
+        )
+
+    def remove_orphaned_carts(self, *args) -> str:
+        stdout = StringIO()
+        call_command("remove_orphaned_carts", *args, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue()
+
+    def assertRemaining(self, carts: list[Cart]) -> None:
+        self.assertQuerySetEqual(
+            Cart.objects.order_by("id"), sorted(carts, key=lambda cart: cart.id)
+        )
+
+    def test_remove_orphaned_carts(self):
+        output = self.remove_orphaned_carts("--batch-size", "3")
+        self.assertRemaining([*self.live_carts, self.keyless_cart, self.user_cart])
+        self.assertIn(
+            "Removed 5 carts with expired sessions! Removed 3 completely orphaned carts!",
+            output,
+        )
+
+    def test_carts_are_found_without_decoding_sessions(self):
+        # a few queries per batch, none per session
+        with self.assertNumQueries(16):
+            self.remove_orphaned_carts("--batch-size", "1000")
+
+    def test_inactive_carts(self):
+        Cart.objects.filter(pk=self.live_carts[0].pk).update(
+            last_activity=timezone.now() - timedelta(days=30)
+        )
+        output = self.remove_orphaned_carts("--inactive-days", "14")
+        self.assertRemaining([*self.live_carts[1:], self.keyless_cart, self.user_cart])
+        self.assertIn("Removed 1 inactive carts!", output)
+
+    def test_carts_without_session_are_removed_by_age(self):
+        Cart.objects.filter(pk=self.keyless_cart.pk).update(
+            last_activity=timezone.now() - timedelta(days=30)
+        )
+        output = self.remove_orphaned_carts()
+        self.assertIn("Removed 3 completely orphaned carts!", output)
+        self.assertTrue(Cart.objects.filter(pk=self.keyless_cart.pk).exists())
+
+        output = self.remove_orphaned_carts("--inactive-days", "14")
+        self.assertRemaining([*self.live_carts, self.user_cart])
+        self.assertIn("Removed 1 inactive carts!", output)
+
+    def test_dry_run(self):
+        output = self.remove_orphaned_carts("--dry-run")
+        self.assertIn(
+            "Would remove 5 carts with expired sessions! Would remove 3 completely orphaned carts!",
+            output,
+        )
+        self.assertEqual(Cart.objects.count(), 17)
+
+    def test_time_budget(self):
+        output = self.remove_orphaned_carts(
+            "--batch-size", "1", "--time-budget", "0.000001"
+        )
+        # only the first batch is processed
+        self.assertIn("Removed 1 carts with expired sessions!", output)
+        self.assertEqual(Cart.objects.count(), 16)
+
+
+class CartSessionTrackingTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        self.user = User.objects.create_user(
+            username=UNAME, email=UEMAIL, password=UPWORD
+        )
+        self.url = reverse("cart_page")
+
+    def test_guest_cart_records_its_session(self):
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        cart = Cart.objects.get()
+        self.assertEqual(cart.session_key, self.client.session.session_key)
+        self.assertTrue(Session.objects.filter(session_key=cart.session_key).exists())
+
+    def test_login_moves_guest_cart_to_the_new_session_key(self):
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        old_key = self.client.session.session_key
+        self.client.login(username=UNAME, password=UPWORD)
+        new_key = self.client.session.session_key
+        self.assertNotEqual(old_key, new_key)
+        self.assertEqual(Cart.objects.get().session_key, new_key)
+
+    def test_last_activity_is_throttled(self):
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        cart = Cart.objects.get()
+        long_ago = timezone.now() - timedelta(days=2)
+        Cart.objects.filter(pk=cart.pk).update(last_activity=long_ago)
+
+        self.client.get(self.url)
+        cart.refresh_from_db()
+        self.assertGreater(cart.last_activity, long_ago)
+        last_activity = cart.last_activity
+
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        cart.refresh_from_db()
+        self.assertEqual(cart.last_activity, last_activity)
+
+
+class StockReservationTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=10,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+
+    def assertStock(self, quantity: int) -> None:
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, quantity)
+
+    def test_out_of_stock_leaves_cart_untouched(self):
+        cart = Cart.objects.create()
+        cart.add_product(self.product, quantity=8)
+        with self.assertRaises(OutOfStock):
+            cart.add_product(self.product, quantity=3)
+        self.assertEqual(cart.cartitem_set.get().quantity, 8)
+        self.assertEqual(StockReservation.objects.get().quantity, 8)
+        self.assertStock(2)
+
+    def test_expired_reservations_are_released(self):
+        expired_cart, live_cart, deleted_cart = Cart.objects.bulk_create(
+            Cart() for _ in range(3)
+        )
+        for cart in (expired_cart, live_cart, deleted_cart):
+            cart.add_product(self.product, quantity=2)
+        StockReservation.objects.filter(cart=expired_cart).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        deleted_cart.delete()
+        self.assertStock(4)
+
+        output = StringIO()
+        call_command("release_expired_reservations", "--batch-size", "1", stdout=output)
+        self.assertIn("Released 2 expired reservations.", output.getvalue())
+        self.assertStock(8)
+        self.assertEqual(StockReservation.objects.get().cart, live_cart)
+
+    def test_release_returns_stock_once(self):
+        cart = Cart.objects.create()
+        cart.add_product(self.product, quantity=4)
+        reservations = StockReservation.objects.filter(cart=cart)
+        self.assertEqual(StockReservation.objects.release(reservations), 1)
+        self.assertEqual(StockReservation.objects.release(reservations), 0)
+        self.assertStock(10)
+        nothing = StockReservation.objects.filter(cart__in=[])
+        self.assertEqual(StockReservation.objects.release(nothing), 0)
+
+
+class GuestCartTestsMixin:
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product1 = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        self.product2 = Product.objects.create(
+            name="Inferior oolong tea",
+            description="Only so fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="not-best-oolong",
+        )
+        self.user = User.objects.create_user(
+            username=UNAME, email=UEMAIL, password=UPWORD
+        )
+        self.url = reverse("cart_page")
+
+    def test_guest_carts_never_write_to_the_database(self):
+        # the product lookup is the only query
+        with self.assertNumQueries(1):
+            self.client.post(self.url, {"product_slug": "best-oolong"})
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        self.client.post(
+            self.url,
+            {"product_slug": "not-best-oolong", "set_quantity": True, "quantity": 9},
+        )
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(Session.objects.exists())
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertContains(response, "The best oolong tea")
+        self.assertContains(response, 'value=2 min="1"')
+        self.assertContains(response, "Inferior oolong tea")
+        self.assertContains(response, 'value=9 min="1"')
+
+        self.client.post(
+            self.url, {"product_slug": "best-oolong", "remove_from_cart": True}
+        )
+        self.client.post(
+            self.url, {"product_slug": "not-best-oolong", "remove_from_cart": True}
+        )
+        self.assertContains(self.client.get(self.url), "No items in cart 🛒")
+        self.assertFalse(self.client.cookies[settings.CART_GUEST_COOKIE_NAME].value)
+
+    def test_login_merges_guest_cart(self):
+        user_cart = Cart.objects.create(user=self.user)
+        user_cart.add_product(self.product1, quantity=3)
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        self.client.post(self.url, {"product_slug": "not-best-oolong"})
+
+        self.client.login(username=UNAME, password=UPWORD)
+        response = self.client.get(self.url)
+        self.assertContains(response, 'value=4 min="1"')
+        self.assertEqual(Cart.objects.get(), user_cart)
+        self.assertEqual(user_cart.cartitem_set.count(), 2)
+        self.assertFalse(response.cookies[settings.CART_GUEST_COOKIE_NAME].value)
+
+    def test_login_adopts_guest_cart(self):
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        self.client.login(username=UNAME, password=UPWORD)
+        self.client.get(self.url)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.cart.cartitem_set.get().product, self.product1)
+
+    def test_persist_for_checkout(self):
+        self.client.post(self.url, {"product_slug": "best-oolong"})
+        request = RequestFactory().get(self.url)
+        request.COOKIES = {
+            key: morsel.value for key, morsel in self.client.cookies.items()
+        }
+        request.user = AnonymousUser()
+        request.session = SessionStore()
+        request_cart = RequestCart(request)
+
+        cart = request_cart.persist()
+        self.assertIsInstance(cart, Cart)
+        self.assertEqual(cart.session_key, request.session.session_key)
+        self.assertEqual(cart.cartitem_set.get().product, self.product1)
+        self.assertEqual(request_cart.get(), cart)
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies[settings.CART_GUEST_COOKIE_NAME] = "bogus"
+        self.assertContains(self.client.get(self.url), "No items in cart 🛒")
+
+    def test_guest_cart_round_trip(self):
+        guest_cart = GuestCart()
+        guest_cart.add_product(self.product1, quantity=2)
+        guest_cart.add_product(self.product1)
+        self.assertEqual(GuestCart.load(guest_cart.dump()).items, {self.product1.pk: 3})
+        self.assertIsNone(GuestCart.load([[self.product1.pk, 0]]))
+
+
+@override_settings(CART_GUEST_BACKEND="signed_cookie")
+class SignedCookieGuestCartTests(GuestCartTestsMixin, TestCase):
+    pass
+
+
+@override_settings(CART_GUEST_BACKEND="cache")
+class CacheGuestCartTests(GuestCartTestsMixin, TestCase):
+    pass
+
+
+def retry_locked(func):
+    # the shared in-memory test database reports a locked table right away,
+    # instead of waiting for it like a database file does
+    while True:
+        try:
+            return func()
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            time.sleep(0.001)
+
+
+class CartPricingTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.oolong, self.sencha, self.matcha = Product.objects.bulk_create(
+            Product(
+                name=name,
+                description="Very tea",
+                is_published=True,
+                quantity=10,
+                product_type=ptype,
+                slug=slugify(name),
+                price=Decimal(price),
+                currency=currency,
+            )
+            for name, price, currency in (
+                ("Oolong", "12.50", "EUR"),
+                ("Sencha", "4.20", "EUR"),
+                ("Matcha", "0.10", "USD"),
+            )
+        )
+        self.url = reverse("cart_page")
+
+    def add(self, product: Product, quantity: int = 1):
+        return self.client.post(
+            self.url, {"product_slug": product.slug, "quantity": quantity}
+        )
+
+    def test_cart_page(self):
+        self.add(self.oolong, 3)
+        self.add(self.sencha)
+        self.add(self.matcha, 3)
+        cart = Cart.objects.get()
+        with self.assertNumQueries(1):
+            lines, summary = pricing.get_cart_lines(cart)
+        self.assertEqual(
+            {line.product.name: line.line_total for line in lines},
+            {
+                "Oolong": Decimal("37.50"),
+                "Sencha": Decimal("4.20"),
+                "Matcha": Decimal("0.30"),
+            },
+        )
+        self.assertEqual(summary.item_count, 7)
+        self.assertEqual(
+            summary.subtotals, {"EUR": Decimal("41.70"), "USD": Decimal("0.30")}
+        )
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["cart_summary"], summary)
+        self.assertContains(response, "37.50 EUR in total")
+        self.assertContains(response, "7 items, subtotal")
+        self.assertContains(response, "41.70 EUR + 0.30 USD")
+
+    def test_summary_is_cached_per_cart_version(self):
+        self.add(self.oolong, 2)
+        cart = Cart.objects.get()
+        with self.assertNumQueries(1):
+            summary = pricing.get_summary(cart)
+        self.assertEqual(summary.item_count, 2)
+        self.assertEqual(summary.subtotals, {"EUR": Decimal("25.00")})
+        with self.assertNumQueries(0):
+            self.assertEqual(pricing.get_summary(cart), summary)
+
+        cart.add_product(self.sencha)
+        self.assertEqual(pricing.get_summary(cart).subtotals, {"EUR": Decimal("29.20")})
+        self.oolong.price = Decimal("10.00")
+        self.oolong.save()
+        self.assertEqual(pricing.get_summary(cart).subtotals, {"EUR": Decimal("24.20")})
+        cart.remove_product(self.sencha)
+        self.assertEqual(pricing.get_summary(cart).item_count, 2)
+
+    def test_cart_page_warms_the_summary(self):
+        self.add(self.oolong)
+        self.client.get(self.url)
+        cart = Cart.objects.get()
+        with self.assertNumQueries(0):
+            self.assertEqual(pricing.get_summary(cart).item_count, 1)
+
+    def test_empty(self):
+        self.assertEqual(pricing.get_summary(None), pricing.CartSummary())
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["cart_summary"].item_count, 0)
+        self.assertNotContains(response, "subtotal")
+
+    @override_settings(CART_GUEST_BACKEND="signed_cookie")
+    def test_guest_cart(self):
+        self.add(self.oolong, 2)
+        self.add(self.matcha)
+        response = self.client.get(self.url)
+        summary = response.context["cart_summary"]
+        self.assertEqual(summary.item_count, 3)
+        self.assertEqual(
+            summary.subtotals, {"EUR": Decimal("25.00"), "USD": Decimal("0.10")}
+        )
+        self.assertContains(response, "25.00 EUR in total")
+
+    async def test_async(self):
+        await sync_to_async(self.add)(self.oolong, 2)
+        cart = await Cart.objects.aget()
+        lines, summary = await pricing.aget_cart_lines(cart)
+        self.assertEqual([line.line_total for line in lines], [Decimal("25.00")])
+        self.assertEqual(await pricing.aget_summary(cart), summary)
+
+        request = AsyncRequestFactory().get(self.url)
+        request.cart = SimpleNamespace(
+            aget=lambda create: Cart.objects.aget(), get_summary=pricing.CartSummary
+        )
+        response = await AsyncCartPageView.as_view()(request)
+        self.assertContains(response, "25.00 EUR in total")
+
+
+class CartBadgeTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.oolong, self.sencha = Product.objects.bulk_create(
+            Product(
+                name=name,
+                description="Very tea",
+                is_published=True,
+                quantity=10,
+                product_type=ptype,
+                slug=slugify(name),
+                price=Decimal(price),
+            )
+            for name, price in (("Oolong", "12.50"), ("Sencha", "4.20"))
+        )
+        self.url = reverse("cart_page")
+        self.user = User.objects.create_user(
+            username=UNAME, email=UEMAIL, password=UPWORD
+        )
+        # cart ids come round again from test to test
+        caches["default"].clear()
+
+    def post(self, product: Product, **data):
+        # the summaries are refreshed once the change is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(self.url, {"product_slug": product.slug, **data})
+
+    def get_page(self, **headers):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.oolong.get_absolute_url(), **headers)
+        self.assertEqual([query for query in queries if '"cart_' in query["sql"]], [])
+        return response
+
+    def assertBadge(self, response, text: str):
+        self.assertContains(response, f'class="cart-badge">{text}</a>')
+
+    def test_add_and_remove(self):
+        self.assertBadge(self.get_page(), "Cart")
+        self.post(self.oolong, quantity=2)
+        response = self.get_page()
+        self.assertBadge(response, "Cart: 2 items, 25.00 EUR")
+
+        # the badge is part of the page's ETag
+        self.post(self.sencha)
+        response = self.get_page(HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertBadge(response, "Cart: 3 items, 29.20 EUR")
+
+        self.post(self.oolong, remove_from_cart=True)
+        self.assertBadge(self.get_page(), "Cart: 1 item, 4.20 EUR")
+        self.post(self.sencha, remove_from_cart=True)
+        self.assertFalse(Cart.objects.exists())
+        self.assertBadge(self.get_page(), "Cart")
+
+    def test_no_last_modified_with_a_cart(self):
+        # a date can't tell that the cart changed
+        last_modified = self.get_page()["Last-Modified"]
+        self.post(self.oolong)
+        response = self.get_page(HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertBadge(response, "Cart: 1 item, 12.50 EUR")
+        self.assertNotIn("Last-Modified", response)
+
+    def test_merge(self):
+        user_cart = Cart.objects.create(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            user_cart.add_product(self.oolong)
+        self.post(self.sencha, quantity=2)
+        self.client.login(username=UNAME, password=UPWORD)
+
+        # both carts until the cart is resolved and they are merged
+        self.assertBadge(self.get_page(), "Cart: 3 items, 20.90 EUR")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(self.url)
+        self.assertEqual(Cart.objects.get(), user_cart)
+        self.assertBadge(self.get_page(), "Cart: 3 items, 20.90 EUR")
+
+    def test_checkout(self):
+        self.post(self.oolong)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse("checkout"), {"idempotency_key": "a" * 32})
+        self.assertFalse(Cart.objects.exists())
+        self.assertBadge(self.get_page(), "Cart")
+
+    def test_price_change(self):
+        self.post(self.oolong, quantity=2)
+        self.oolong.price = Decimal("10.00")
+        self.oolong.save()
+        self.assertBadge(self.client.get(self.url), "Cart: 2 items, 20.00 EUR")
+
+    @override_settings(CART_GUEST_BACKEND="signed_cookie")
+    def test_guest_cart(self):
+        # anonymous pages are cached, but not for visitors with a guest cart
+        self.assertBadge(self.get_page(), "Cart")
+        self.post(self.oolong, quantity=2)
+        self.assertFalse(Cart.objects.exists())
+        self.assertBadge(self.get_page(), "Cart: 2 items, 25.00 EUR")
+
+        # the cart page leaves the summary for the next page
+        self.client.get(self.url)
+        with self.assertNumQueries(0):
+            self.assertBadge(
+                self.client.get(reverse("about")), "Cart: 2 items, 25.00 EUR"
+            )
+
+
+class CartAddProductConcurrencyTests(TransactionTestCase):
+    THREADS = 8
+    ADDS_PER_THREAD = 25
+
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=self.THREADS * self.ADDS_PER_THREAD,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+
+    def run_threads(self, target) -> list[Exception]:
+        start = threading.Barrier(self.THREADS)
+        errors = []
+
+        def run(i: int):
+            try:
+                start.wait()
+                target(i)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_concurrent_adds_lose_no_increments(self):
+        product = self.product
+        cart = Cart.objects.create()
+
+        def add_to_cart(i: int):
+            for _ in range(self.ADDS_PER_THREAD):
+                retry_locked(lambda: Cart.objects.get(pk=cart.pk).add_product(product))
+
+        self.assertEqual(self.run_threads(add_to_cart), [])
+        self.assertEqual(
+            CartItem.objects.get(cart=cart, product=product).quantity,
+            self.THREADS * self.ADDS_PER_THREAD,
+        )
+
+    def test_concurrent_carts_never_oversell(self):
+        stock = self.THREADS * self.ADDS_PER_THREAD // 3
+        Product.objects.filter(pk=self.product.pk).update(quantity=stock)
+        carts = Cart.objects.bulk_create(Cart() for _ in range(self.THREADS))
+        reserved = [0] * self.THREADS
+
+        def add_to_cart(i: int):
+            for _ in range(self.ADDS_PER_THREAD):
+                try:
+                    retry_locked(lambda: carts[i].add_product(self.product))
+                    reserved[i] += 1
+                except OutOfStock:
+                    pass
+
+        self.assertEqual(self.run_threads(add_to_cart), [])
+        self.assertEqual(sum(reserved), stock)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 0)
+        self.assertEqual(
+            sum(StockReservation.objects.values_list("quantity", flat=True)), stock
+        )
+        self.assertEqual(
+            sum(CartItem.objects.values_list("quantity", flat=True)), stock
+        )
+
+    def test_benchmark(self):
+        output = StringIO()
+        call_command(
+            "benchmark_reservations",
+            "--threads",
+            "1",
+            "--stock",
+            "5",
+            "--attempts",
+            "8",
+            stdout=output,
+        )
+        self.assertIn("5 reserved, 3 refused, 0 errors", output.getvalue())
+        self.assertIn("Oversold: 0", output.getvalue())
+        self.assertEqual(Product.objects.count(), 1)
+
+    def test_benchmark_products(self):
+        output = StringIO()
+        call_command(
+            "benchmark_reservations",
+            "--threads",
+            "1",
+            "--products",
+            "3",
+            "--stock",
+            "2",
+            "--attempts",
+            "8",
+            stdout=output,
+        )
+        self.assertIn("8 attempts on 6 in stock", output.getvalue())
+        self.assertIn("6 reserved, 2 refused, 0 errors", output.getvalue())
+        self.assertNotIn("doesn't add up", output.getvalue())
+        self.assertEqual(Product.objects.count(), 1)
+
+
+class AsyncCartTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+        self.user = User.objects.create_user(
+            username=UNAME, email=UEMAIL, password=UPWORD
+        )
+        self.url = reverse("cart_page")
+
+    def make_request(self, method="get", data=None, session_key=None, user=None):
+        # like the middleware leaves it, the session and user are lazy
+        request = getattr(AsyncRequestFactory(), method)(self.url, data)
+        request.session = SessionStore(session_key)
+        request.user = user or SimpleLazyObject(lambda: get_user(request))
+        request._messages = default_storage(request)
+        return request
+
+    async def call_middleware(self, request, view=None):
+        middleware = CartMiddleware(view or AsyncCartPageView.as_view())
+        self.assertTrue(iscoroutinefunction(middleware))
+        return await middleware(request)
+
+    async def test_add_and_remove_product(self):
+        cart = await Cart.objects.acreate()
+        await cart.aadd_product(self.product, 2)
+        await cart.aadd_product(self.product, 5, set_quantity=True)
+        items = await cart.aget_items()
+        self.assertEqual(
+            [(item.product, item.quantity) for item in items], [(self.product, 5)]
+        )
+        await self.product.arefresh_from_db()
+        self.assertEqual(self.product.quantity, 37)
+
+        await cart.aremove_product(self.product)
+        await self.product.arefresh_from_db()
+        self.assertEqual(self.product.quantity, 42)
+        self.assertFalse(await Cart.objects.filter(pk=cart.pk).aexists())
+
+    async def test_request_cart_is_created_for_the_session(self):
+        request = self.make_request(user=AnonymousUser())
+        self.assertIsNone(await Cart.aget_request_cart(request))
+        cart = await Cart.aget_request_cart(request, create_cart=True)
+        self.assertIsNotNone(request.session.session_key)
+        self.assertEqual(cart.session_key, request.session.session_key)
+        self.assertEqual(request.session[SESSION_CART_KEY], cart.id)
+
+    async def test_request_cart_merges_into_user_cart(self):
+        user_cart = await Cart.objects.acreate(user=self.user)
+        session_cart = await Cart.objects.acreate()
+        await session_cart.aadd_product(self.product, 2)
+        request = self.make_request(user=self.user)
+        request.session[SESSION_CART_KEY] = session_cart.id
+
+        self.assertEqual(await Cart.aget_request_cart(request), user_cart)
+        self.assertEqual((await user_cart.cartitem_set.aget()).quantity, 2)
+        self.assertFalse(await Cart.objects.filter(pk=session_cart.pk).aexists())
+        self.assertNotIn(SESSION_CART_KEY, request.session)
+        self.assertEqual(request.session[SESSION_USER_CART_KEY], user_cart.id)
+
+    async def test_request_cart_is_taken_over_by_the_user(self):
+        session_cart = await Cart.objects.acreate()
+        request = self.make_request(user=self.user)
+        request.session[SESSION_CART_KEY] = session_cart.id
+
+        self.assertEqual(await Cart.aget_request_cart(request), session_cart)
+        self.assertEqual((await Cart.objects.aget(user=self.user)).pk, session_cart.pk)
+        self.assertNotIn(SESSION_CART_KEY, request.session)
+        self.assertEqual(request.session[SESSION_USER_CART_KEY], session_cart.id)
+
+    async def test_failed_add_makes_no_cart(self):
+        request = self.make_request(
+            "post", {"product_slug": "best-oolong", "quantity": 50}
+        )
+        await self.call_middleware(request)
+        self.assertFalse(await Cart.objects.aexists())
+
+        # stock that went between the check and the add
+        out_of_stock = OutOfStock(self.product, 1)
+        request = self.make_request("post", {"product_slug": "best-oolong"})
+        with mock.patch.object(Cart, "_add_product", side_effect=out_of_stock):
+            await self.call_middleware(request)
+        self.assertFalse(await Cart.objects.aexists())
+        self.assertNotIn(SESSION_CART_KEY, request.session)
+
+    async def test_cart_page(self):
+        await sync_to_async(self.client.login)(username=UNAME, password=UPWORD)
+        session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+
+        # the middleware loads the session and user, nothing in the view may
+        # touch the database synchronously
+        response = await self.call_middleware(
+            self.make_request("post", {"product_slug": "best-oolong"}, session_key)
+        )
+        self.assertRedirects(response, self.url, fetch_redirect_response=False)
+        cart = await Cart.objects.aget(user=self.user)
+        self.assertEqual((await cart.cartitem_set.aget()).quantity, 1)
+
+        request = self.make_request(
+            "post", {"product_slug": "best-oolong", "quantity": 100}, session_key
+        )
+        await self.call_middleware(request)
+        self.assertEqual(
+            [str(message) for message in request._messages],
+            ["Sorry, there isn't enough The best oolong tea left."],
+        )
+
+        response = await self.call_middleware(
+            self.make_request(session_key=session_key)
+        )
+        self.assertContains(response, "The best oolong tea")
+
+        response = await self.call_middleware(
+            self.make_request(
+                "post",
+                {"product_slug": "best-oolong", "remove_from_cart": True},
+                session_key,
+            )
+        )
+        self.assertFalse(await Cart.objects.filter(pk=cart.pk).aexists())
+        response = await self.call_middleware(
+            self.make_request(session_key=session_key)
+        )
+        self.assertContains(response, "No items in cart 🛒")
+
+    async def test_cart_badge(self):
+        cart = await Cart.objects.acreate(user=self.user)
+        await cart.aadd_product(self.product, 2)
+        request = self.make_request(user=self.user)
+        request.session[SESSION_USER_CART_KEY] = cart.id
+        # summed up front, the page renders in the event loop
+        response = await self.call_middleware(request)
+        self.assertContains(response, 'class="cart-badge">Cart: 2 items, 0.00 EUR</a>')
+
+    @override_settings(CART_GUEST_BACKEND="signed_cookie")
+    async def test_guest_cart(self):
+        response = await self.call_middleware(
+            self.make_request("post", {"product_slug": "best-oolong", "quantity": 3})
+        )
+        cookie = response.cookies[settings.CART_GUEST_COOKIE_NAME].value
+        self.assertFalse(await Cart.objects.aexists())
+
+        request = self.make_request()
+        request.COOKIES[settings.CART_GUEST_COOKIE_NAME] = cookie
+        response = await self.call_middleware(request)
+        self.assertContains(response, "value=3")
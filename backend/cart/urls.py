@@ -1,7 +1,11 @@
+from django.conf import settings
 from django.urls import path
 
-from .views import CartPageView
+from .views import AsyncCartPageView, CartPageView
+
+# when served by ASGI with `settings.ASYNC_VIEWS` on
+cart_page_view = AsyncCartPageView if settings.ASYNC_VIEWS else CartPageView
 
 urlpatterns = [
-    path("", CartPageView.as_view(), name="cart_page"),
+    path("", cart_page_view.as_view(), name="cart_page"),
 ]
@@ -1,41 +1,139 @@
-from django.http import HttpRequest, HttpResponseRedirect
+import uuid
+from typing import Optional
+
+from django.contrib import messages
+from django.db.models import QuerySet
+from django.http import Http404, HttpRequest, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.views.generic import TemplateView
 from products.models import Product
+from products.views import render_now
 
+from . import pricing
 from .forms import CartItemForm
-from .models import Cart
+from .guest import GuestCart
+from .models import Cart, OutOfStock
 
 
 class CartPageView(TemplateView):
     template_name = "cart/cart_page.html"
 
     def get_context_data(self, **kwargs):
+        cart = self.request.cart.get(create=kwargs.get("create_cart", False))
+        return self.get_cart_context(cart, *pricing.get_cart_lines(cart), **kwargs)
+
+    def get_cart_context(self, cart, cart_items, cart_summary, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["cart"] = Cart.get_request_cart(
-            self.request, create_cart=kwargs.get("create_cart", False)
-        )
+        context["cart"] = cart
+        context["cart_items"] = cart_items
+        context["cart_summary"] = cart_summary
+        # a double submitted checkout form places one order
+        context["checkout_key"] = uuid.uuid4().hex
         return context
 
     def post(self, request: HttpRequest, *args, **kwargs):
         form = CartItemForm(request.POST)
         if form.is_valid():
+            remove_from_cart = form.cleaned_data.get("remove_from_cart")
             product: Product = get_object_or_404(
-                Product, slug=form.cleaned_data["product_slug"]
+                self.get_products(remove_from_cart),
+                slug=form.cleaned_data["product_slug"],
             )
-            remove_from_cart = form.cleaned_data.get("remove_from_cart")
 
-            cart: Cart = Cart.get_request_cart(
-                request, create_cart=not remove_from_cart
-            )
             if not remove_from_cart:
-                cart.add_product(
-                    product=product,
-                    quantity=form.cleaned_data.get("quantity") or 1,
-                    set_quantity=form.cleaned_data.get("set_quantity"),
-                )
-            elif cart:
+                self.add_to_cart(request, product, form.cleaned_data)
+            elif cart := request.cart.get():
                 cart.remove_product(product=product)
+                request.cart.forget()
 
         return HttpResponseRedirect(reverse("cart_page"))
+
+    def get_products(self, remove_from_cart: bool) -> QuerySet:
+        # unpublished products can still leave the cart
+        return Product.objects.all() if remove_from_cart else Product.published.all()
+
+    def add_to_cart(self, request: HttpRequest, product: Product, data: dict) -> None:
+        quantity = data.get("quantity") or 1
+        new_cart = not request.cart.has_cart()
+        cart: Optional[Cart | GuestCart] = None
+        try:
+            self.check_new_cart_stock(new_cart, product, quantity)
+            cart = request.cart.get(create=True)
+            cart.add_product(
+                product=product,
+                quantity=quantity,
+                set_quantity=data.get("set_quantity"),
+            )
+        except OutOfStock:
+            self.out_of_stock(request, product)
+            if self.made_for_nothing(new_cart, cart) and not cart.cartitem_set.exists():
+                request.cart.discard(cart)
+
+    # the decisions `add_to_cart` and its async twin share
+    def check_new_cart_stock(
+        self, new_cart: bool, product: Product, quantity: int
+    ) -> None:
+        # no cart is made for an add that can't succeed
+        if new_cart and product.quantity < quantity:
+            raise OutOfStock(product, quantity)
+
+    def out_of_stock(self, request: HttpRequest, product: Product) -> None:
+        messages.error(request, f"Sorry, there isn't enough {product.name} left.")
+
+    def made_for_nothing(self, new_cart: bool, cart) -> bool:
+        # the stock went meanwhile, the cart made for this add may be empty
+        return new_cart and isinstance(cart, Cart)
+
+
+class AsyncCartPageView(CartPageView):
+    # when served by ASGI with `settings.ASYNC_VIEWS` on
+    async def get(self, request: HttpRequest, *args, **kwargs):
+        cart = await request.cart.aget(create=kwargs.get("create_cart", False))
+        context = self.get_cart_context(
+            cart, *await pricing.aget_cart_lines(cart), **kwargs
+        )
+        return render_now(self.render_to_response(context))
+
+    async def post(self, request: HttpRequest, *args, **kwargs):
+        # done by the middleware already when the whole stack is async
+        await request.cart.aload()
+        form = CartItemForm(request.POST)
+        if form.is_valid():
+            remove_from_cart = form.cleaned_data.get("remove_from_cart")
+            try:
+                product: Product = await self.get_products(remove_from_cart).aget(
+                    slug=form.cleaned_data["product_slug"]
+                )
+            except Product.DoesNotExist:
+                raise Http404("No product found.")
+
+            if not remove_from_cart:
+                await self.aadd_to_cart(request, product, form.cleaned_data)
+            elif cart := await request.cart.aget():
+                await cart.aremove_product(product=product)
+                request.cart.forget()
+
+        return HttpResponseRedirect(reverse("cart_page"))
+
+    async def aadd_to_cart(
+        self, request: HttpRequest, product: Product, data: dict
+    ) -> None:
+        quantity = data.get("quantity") or 1
+        new_cart = not request.cart.has_cart()
+        cart: Optional[Cart | GuestCart] = None
+        try:
+            self.check_new_cart_stock(new_cart, product, quantity)
+            cart = await request.cart.aget(create=True)
+            await cart.aadd_product(
+                product=product,
+                quantity=quantity,
+                set_quantity=data.get("set_quantity"),
+            )
+        except OutOfStock:
+            self.out_of_stock(request, product)
+            if (
+                self.made_for_nothing(new_cart, cart)
+                and not await cart.cartitem_set.aexists()
+            ):
+                await request.cart.adiscard(cart)
@@ -0,0 +1,8 @@
+from django import forms
+
+
+class CheckoutForm(forms.Form):
+    # generated with the cart page, see `CartPageView`
+    idempotency_key = forms.CharField(
+        min_length=16, max_length=64, widget=forms.HiddenInput()
+    )
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.5 on 2026-10-18 21:12
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0001_initial"),
+    ]
+
+    # lines ordered before products had prices were free
+    operations = [
+        migrations.AddField(
+            model_name="orderline",
+            name="unit_price",
+            field=models.DecimalField(
+                decimal_places=2, default=Decimal("0.00"), max_digits=10
+            ),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="orderline",
+            name="currency",
+            field=models.CharField(default="EUR", max_length=3),
+            preserve_default=False,
+        ),
+    ]
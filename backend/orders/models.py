@@ -1,3 +1,46 @@
+from decimal import Decimal
+
+from django.conf import settings
 from django.db import models
+from products.models import Product
+
+
+class Order(models.Model):
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    # sent along with every checkout attempt, a retried or double submitted
+    # checkout finds the order it already placed
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self) -> str:
+        return f"Order #{self.pk}"
+
+
+class OrderLine(models.Model):
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="lines")
+    product = models.ForeignKey(Product, on_delete=models.PROTECT)
+    # what the product was called when it was ordered
+    product_name = models.CharField(max_length=150)
+    quantity = models.PositiveIntegerField()
+    # and what it cost
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["order", "product"], name="one_line_per_order_product"
+            ),
+            models.CheckConstraint(
+                check=models.Q(quantity__gt=0), name="order_line_quantity_gt_0"
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.order} Line: {self.product_name}, {self.quantity}"
 
-# Create your models here.
+    @property
+    def total(self) -> Decimal:
+        return self.unit_price * self.quantity
@@ -0,0 +1,101 @@
+from collections import Counter
+from typing import Optional
+
+from cart.models import Cart, StockReservation
+from django.db import IntegrityError
+from django.db.models import Case, F, Value, When
+from products.models import Product
+from TeaShop.transactions import immediate_atomic
+
+from .models import Order, OrderLine
+
+
+class CheckoutError(Exception):
+    pass
+
+
+class EmptyCart(CheckoutError):
+    pass
+
+
+class InsufficientStock(CheckoutError):
+    pass
+
+
+def checkout(cart: Optional[Cart], idempotency_key: str, user=None) -> Order:
+    """
+    Turn `cart` into an order and delete it, all in one short transaction.
+
+    Checking out again with the same key returns the order placed the first
+    time, without touching the stock again.
+    """
+    if order := _existing_order(idempotency_key, user):
+        return order
+    if cart is None:
+        raise EmptyCart("The cart is empty.")
+    try:
+        with immediate_atomic():
+            # the unique key makes a concurrent duplicate fail right here
+            order = Order.objects.create(user=user, idempotency_key=idempotency_key)
+            items = list(cart.cartitem_set.select_related("product"))
+            if not items:
+                raise EmptyCart("The cart is empty.")
+            _take_stock(cart, {item.product_id: item.quantity for item in items})
+            OrderLine.objects.bulk_create(
+                OrderLine(
+                    order=order,
+                    product=item.product,
+                    product_name=item.product.name,
+                    quantity=item.quantity,
+                    unit_price=item.product.price,
+                    currency=item.product.currency,
+                )
+                for item in items
+            )
+            cart.changed()
+            cart.delete()
+    except IntegrityError:
+        if order := _existing_order(idempotency_key, user):
+            return order
+        raise
+    return order
+
+
+def _existing_order(idempotency_key: str, user) -> Optional[Order]:
+    order = Order.objects.filter(idempotency_key=idempotency_key).first()
+    if order and order.user_id != getattr(user, "pk", None):
+        raise CheckoutError("This checkout key belongs to another order.")
+    return order
+
+
+def _take_stock(cart: Cart, quantities: dict[int, int]) -> None:
+    # reserved stock is already off `Product.quantity`, the reservations are
+    # used up in the same statement that reads them, so a concurrent release
+    # can't return them as well. Only the difference is taken, or given back,
+    # in one conditional UPDATE for all products
+    reserved = Counter()
+    for product_id, quantity in StockReservation.objects._delete_returning(
+        StockReservation.objects.filter(cart=cart)
+    ):
+        reserved[product_id] += quantity
+    missing = {
+        product_id: quantities.get(product_id, 0) - reserved.get(product_id, 0)
+        for product_id in quantities.keys() | reserved.keys()
+    }
+    missing = {
+        product_id: quantity for product_id, quantity in missing.items() if quantity
+    }
+    if not missing:
+        return
+
+    missing_quantity = Case(
+        *(
+            When(pk=product_id, then=Value(quantity))
+            for product_id, quantity in missing.items()
+        )
+    )
+    taken = Product.objects.filter(
+        pk__in=missing, quantity__gte=missing_quantity
+    ).update(quantity=F("quantity") - missing_quantity)
+    if taken != len(missing):
+        raise InsufficientStock("Some products sold out in the meantime.")
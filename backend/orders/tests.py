@@ -1,3 +1,218 @@
-from django.test import TestCase
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from cart.models import Cart, CartItem, StockReservation, StockReservationManager
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from products.models import Product, ProductType
+
+from .models import Order, OrderLine
+from .services import CheckoutError, EmptyCart, InsufficientStock, checkout
+
+User = get_user_model()
+UNAME = "doggoteamaster"
+UEMAIL = "dtm@alldoggos.com"
+UPWORD = "randomPw@rd12!"
+KEY = "a" * 32
+
+
+class CheckoutServiceTests(TestCase):
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.products = Product.objects.bulk_create(
+            Product(
+                name=f"Tea {i}",
+                description="Very tea",
+                is_published=True,
+                quantity=10,
+                product_type=ptype,
+                slug=f"tea-{i}",
+                price=Decimal(f"{i}.50"),
+            )
+            for i in range(30)
+        )
+        self.user = User.objects.create_user(
+            username=UNAME, email=UEMAIL, password=UPWORD
+        )
+        self.cart = Cart.objects.create(user=self.user)
+        self.cart.add_product(self.products[0], quantity=3)
+        self.cart.add_product(self.products[1], quantity=1)
+
+    def stock(self, product: Product) -> int:
+        product.refresh_from_db()
+        return product.quantity
+
+    def test_checkout(self):
+        order = checkout(self.cart, KEY, user=self.user)
+        self.assertEqual(order.user, self.user)
+        self.assertEqual(
+            list(
+                order.lines.order_by("product_name").values_list(
+                    "product_name", "quantity", "unit_price", "currency"
+                )
+            ),
+            [
+                ("Tea 0", 3, Decimal("0.50"), "EUR"),
+                ("Tea 1", 1, Decimal("1.50"), "EUR"),
+            ],
+        )
+        # the reserved stock was taken when it was added to the cart
+        self.assertEqual(self.stock(self.products[0]), 7)
+        self.assertEqual(self.stock(self.products[1]), 9)
+        self.assertFalse(Cart.objects.exists())
+        self.assertFalse(CartItem.objects.exists())
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_unreserved_items_take_stock(self):
+        StockReservation.objects.release(
+            StockReservation.objects.filter(product=self.products[0])
+        )
+        self.assertEqual(self.stock(self.products[0]), 10)
+        checkout(self.cart, KEY, user=self.user)
+        self.assertEqual(self.stock(self.products[0]), 7)
+        self.assertEqual(self.stock(self.products[1]), 9)
+
+    def test_reservations_released_meanwhile_are_not_counted(self):
+        delete_returning = StockReservationManager._delete_returning
+        released = []
+
+        def expire_first(manager, reservations):
+            # the expiry job gets to the reservations first
+            if not released:
+                released.append(0)
+                released[0] = StockReservation.objects.release(
+                    StockReservation.objects.filter(cart=self.cart)
+                )
+            return delete_returning(manager, reservations)
+
+        with mock.patch.object(
+            StockReservationManager,
+            "_delete_returning",
+            autospec=True,
+            side_effect=expire_first,
+        ):
+            checkout(self.cart, KEY, user=self.user)
+        self.assertEqual(released, [2])
+        # given back once, taken again in full
+        self.assertEqual(self.stock(self.products[0]), 7)
+        self.assertEqual(self.stock(self.products[1]), 9)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_sold_out_leaves_everything_as_it_was(self):
+        StockReservation.objects.release(
+            StockReservation.objects.filter(product=self.products[0])
+        )
+        Product.objects.filter(pk=self.products[0].pk).update(quantity=2)
+        with self.assertRaises(InsufficientStock):
+            checkout(self.cart, KEY, user=self.user)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.cartitem_set.count(), 2)
+        self.assertEqual(self.stock(self.products[0]), 2)
+        self.assertEqual(self.stock(self.products[1]), 9)
+
+    def test_same_key_places_one_order(self):
+        order = checkout(self.cart, KEY, user=self.user)
+        self.assertEqual(checkout(None, KEY, user=self.user), order)
+
+        another_cart = Cart.objects.create(user=self.user)
+        another_cart.add_product(self.products[0], quantity=2)
+        self.assertEqual(checkout(another_cart, KEY, user=self.user), order)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(another_cart.cartitem_set.count(), 1)
+        self.assertEqual(self.stock(self.products[0]), 5)
+
+    def test_key_of_another_order(self):
+        checkout(self.cart, KEY, user=self.user)
+        guest_cart = Cart.objects.create()
+        guest_cart.add_product(self.products[2])
+        with self.assertRaises(CheckoutError):
+            checkout(guest_cart, KEY)
+
+    def test_empty_cart(self):
+        with self.assertRaises(EmptyCart):
+            checkout(None, KEY)
+        with self.assertRaises(EmptyCart):
+            checkout(Cart.objects.create(), KEY)
+        self.assertFalse(Order.objects.exists())
+
+    def test_query_count_does_not_grow_with_cart_size(self):
+        query_counts = []
+        for i, cart_size in enumerate((2, 30)):
+            cart = Cart.objects.create()
+            for product in self.products[:cart_size]:
+                cart.add_product(product)
+            # half the items aren't reserved anymore
+            StockReservation.objects.release(
+                StockReservation.objects.filter(
+                    cart=cart, product__in=self.products[::2]
+                )
+            )
+            with CaptureQueriesContext(connection) as queries:
+                checkout(cart, f"{KEY}{i}")
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(
+            OrderLine.objects.filter(order__idempotency_key=f"{KEY}1").count(), 30
+        )
+
+
+class CheckoutViewTestsMixin:
+    def setUp(self) -> None:
+        ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.product = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=ptype,
+            slug="best-oolong",
+        )
+
+    def test_double_submitted_checkout(self):
+        cart_url = reverse("cart_page")
+        self.client.post(
+            cart_url,
+            {"product_slug": "best-oolong", "set_quantity": True, "quantity": 2},
+        )
+        checkout_key = self.client.get(cart_url).context["checkout_key"]
+
+        responses = [
+            self.client.post(reverse("checkout"), {"idempotency_key": checkout_key})
+            for _ in range(2)
+        ]
+        order = Order.objects.get()
+        for response in responses:
+            self.assertRedirects(
+                response, reverse("order_detail", kwargs={"pk": order.pk})
+            )
+        self.assertEqual(order.lines.get().quantity, 2)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity, 40)
+
+        response = self.client.get(reverse("order_detail", kwargs={"pk": order.pk}))
+        self.assertContains(response, "The best oolong tea")
+        self.assertContains(self.client.get(cart_url), "No items in cart 🛒")
+        # only the session that placed it can see it
+        other_response = Client().get(reverse("order_detail", kwargs={"pk": order.pk}))
+        self.assertEqual(other_response.status_code, 404)
+
+    def test_empty_cart_checkout(self):
+        response = self.client.post(reverse("checkout"), {"idempotency_key": KEY})
+        self.assertRedirects(response, reverse("cart_page"))
+        self.assertFalse(Order.objects.exists())
+
+
+class CheckoutViewTests(CheckoutViewTestsMixin, TestCase):
+    pass
+
+
+@override_settings(CART_GUEST_BACKEND="signed_cookie")
+class GuestCartCheckoutViewTests(CheckoutViewTestsMixin, TestCase):
+    pass
@@ -0,0 +1,8 @@
+from django.urls import path
+
+from .views import CheckoutView, OrderDetailView
+
+urlpatterns = [
+    path("checkout/", CheckoutView.as_view(), name="checkout"),
+    path("<int:pk>/", OrderDetailView.as_view(), name="order_detail"),
+]
@@ -1,3 +1,51 @@
-from django.shortcuts import render
+from typing import Optional
 
-# Create your views here.
+from cart.models import Cart
+from django.contrib import messages
+from django.http import HttpRequest, HttpResponseRedirect
+from django.urls import reverse
+from django.views import View
+from django.views.generic import DetailView
+
+from .forms import CheckoutForm
+from .models import Order
+from .services import CheckoutError, checkout
+
+# orders placed without an account can be seen from the same session
+SESSION_ORDERS_KEY = "order_ids"
+
+
+class CheckoutView(View):
+    def post(self, request: HttpRequest, *args, **kwargs):
+        form = CheckoutForm(request.POST)
+        if not form.is_valid():
+            return HttpResponseRedirect(reverse("cart_page"))
+        # guest carts kept out of the database are stored now
+        cart: Optional[Cart] = request.cart.persist()
+
+        user = request.user if request.user.is_authenticated else None
+        try:
+            order = checkout(cart, form.cleaned_data["idempotency_key"], user=user)
+        except CheckoutError as e:
+            messages.error(request, str(e))
+            return HttpResponseRedirect(reverse("cart_page"))
+        request.cart.forget()
+
+        if not user:
+            order_ids = request.session.get(SESSION_ORDERS_KEY, [])
+            if order.pk not in order_ids:
+                request.session[SESSION_ORDERS_KEY] = order_ids + [order.pk]
+        return HttpResponseRedirect(reverse("order_detail", kwargs={"pk": order.pk}))
+
+
+class OrderDetailView(DetailView):
+    template_name = "orders/order_detail.html"
+    context_object_name = "order"
+
+    def get_queryset(self):
+        orders = Order.objects.prefetch_related("lines")
+        if self.request.user.is_authenticated:
+            return orders.filter(user=self.request.user)
+        return orders.filter(
+            user__isnull=True, pk__in=self.request.session.get(SESSION_ORDERS_KEY, [])
+        )
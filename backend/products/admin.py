@@ -17,5 +17,5 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ("name", "is_published", "quantity")
+    list_display = ("name", "is_published", "quantity", "price", "currency")
     prepopulated_fields = {"slug": ["name"]}
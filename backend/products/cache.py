@@ -0,0 +1,173 @@
+import hashlib
+import math
+import time
+from typing import Iterable
+
+from django.conf import settings
+from django.core.cache import BaseCache, caches
+from django.db import connections, transaction
+from django.http import HttpRequest
+from TeaShop.routers import REPLICA_DB_ALIAS
+
+# Catalog cache entries are keyed by the current version of every scope they
+# were built from, eg. a category page by "category:<slug>". Edits bump only
+# the affected scopes, entries built from older versions are never read again
+# and simply expire.
+#
+# With a read replica, an entry built right after a bump may still hold the
+# rows the replica hadn't caught up with. Such entries only live until the
+# replica has, as far as `DATABASE_REPLICA_PIN_SECONDS` allows for, and are
+# built again from then on, see `entry_timeout()`.
+ALL_PRODUCTS = "products"
+# every cart summary, bumped when any product's price changes, see cart/pricing.py
+PRICES = "prices"
+
+
+def product_scope(slug: str) -> str:
+    return f"product:{slug}"
+
+
+def category_scope(slug: str) -> str:
+    return f"category:{slug}"
+
+
+def product_type_scope(slug: str) -> str:
+    return f"ptype:{slug}"
+
+
+def get_cache() -> BaseCache:
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+def _version_key(scope: str) -> str:
+    return f"catalog:version:{scope}"
+
+
+def _new_version() -> int:
+    # never reuses a previous value, even if a version key gets evicted
+    return time.time_ns()
+
+
+def get_versions(scopes: Iterable[str]) -> dict[str, int]:
+    cache = get_cache()
+    keys = {_version_key(scope): scope for scope in scopes}
+    found = cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        for key in missing:
+            cache.add(key, _new_version(), timeout=None)
+        found |= cache.get_many(missing)
+    # a dummy cache keeps nothing, unknown versions never match an entry
+    return {scope: found.get(key) or _new_version() for key, scope in keys.items()}
+
+
+async def aget_versions(scopes: Iterable[str]) -> dict[str, int]:
+    cache = get_cache()
+    keys = {_version_key(scope): scope for scope in scopes}
+    found = await cache.aget_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        for key in missing:
+            await cache.aadd(key, _new_version(), timeout=None)
+        found |= await cache.aget_many(missing)
+    return {scope: found.get(key) or _new_version() for key, scope in keys.items()}
+
+
+def _bump_versions(scopes: set[str]) -> None:
+    version = _new_version()
+    get_cache().set_many(
+        {_version_key(scope): version for scope in scopes}, timeout=None
+    )
+
+
+def invalidate(*scopes: str) -> None:
+    scopes = set(scopes)
+    if not scopes:
+        return
+    _bump_versions(scopes)
+    # readers inside the edit's transaction window may still cache old rows
+    # under the new versions, bump again once the edit is visible to everyone
+    transaction.on_commit(lambda: _bump_versions(scopes))
+
+
+def entry_timeout(versions: Iterable[int]) -> int:
+    # seconds an entry built from these versions is kept
+    timeout = settings.CATALOG_CACHE_TIMEOUT
+    if REPLICA_DB_ALIAS not in connections.settings:
+        return timeout
+    # versions are the times of their bumps
+    age = (time.time_ns() - max(versions, default=0)) / 1e9
+    replica_lag = settings.DATABASE_REPLICA_PIN_SECONDS
+    if age < replica_lag:
+        return max(1, min(timeout, math.ceil(replica_lag - age)))
+    return timeout
+
+
+class EntryKey(str):
+    # a key, and how long its entry may be kept, see `entry_timeout()`
+    timeout: int
+
+
+def make_key(kind: str, scopes: Iterable[str], *parts: object) -> EntryKey:
+    return _key_for_versions(kind, get_versions(scopes), parts)
+
+
+async def amake_key(kind: str, scopes: Iterable[str], *parts: object) -> EntryKey:
+    return _key_for_versions(kind, await aget_versions(scopes), parts)
+
+
+def _key_for_versions(kind: str, versions: dict[str, int], parts) -> EntryKey:
+    raw = "|".join(
+        [f"{scope}={version}" for scope, version in sorted(versions.items())]
+        + [str(part) for part in parts]
+    )
+    key = EntryKey(f"catalog:{kind}:{hashlib.sha1(raw.encode()).hexdigest()}")
+    key.timeout = entry_timeout(versions.values())
+    return key
+
+
+def _timeout(key: str) -> int:
+    return getattr(key, "timeout", settings.CATALOG_CACHE_TIMEOUT)
+
+
+def get_entry(key: str):
+    return get_cache().get(key)
+
+
+def set_entry(key: str, value) -> None:
+    get_cache().set(key, value, timeout=_timeout(key))
+
+
+async def aget_entry(key: str):
+    return await get_cache().aget(key)
+
+
+async def aset_entry(key: str, value) -> None:
+    await get_cache().aset(key, value, timeout=_timeout(key))
+
+
+def annotate_card_versions(products) -> None:
+    # product cards are template fragments keyed by the product version
+    versions = get_versions(product_scope(product.slug) for product in products)
+    _annotate_cards(products, versions)
+
+
+async def aannotate_card_versions(products) -> None:
+    versions = await aget_versions(product_scope(product.slug) for product in products)
+    _annotate_cards(products, versions)
+
+
+def _annotate_cards(products, versions: dict[str, int]) -> None:
+    for product in products:
+        product.card_version = versions[product_scope(product.slug)]
+        product.card_timeout = entry_timeout([product.card_version])
+
+
+def is_page_cacheable(request: HttpRequest) -> bool:
+    # whole pages are shared between anonymous visitors only, a session or
+    # guest cart cookie means there may be a cart or a user on the page
+    return (
+        request.method in ("GET", "HEAD")
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+        and settings.CART_GUEST_COOKIE_NAME not in request.COOKIES
+    )
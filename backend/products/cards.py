@@ -0,0 +1,71 @@
+from typing import Iterable
+
+from django.urls import reverse
+
+from .models import Product, ProductCard
+
+# Product cards are written in batches, one upsert per batch.
+BATCH_SIZE = 1000
+CARD_FIELDS = [
+    field.name for field in ProductCard._meta.concrete_fields if not field.primary_key
+]
+
+
+def make_card(product: Product) -> ProductCard:
+    # `product` needs its product type and categories loaded, see `for_listing()`
+    return ProductCard(
+        product_id=product.pk,
+        name=product.name,
+        slug=product.slug,
+        description=product.description,
+        is_published=product.is_published,
+        url=reverse(
+            "product_details",
+            kwargs={"product_type": product.product_type.slug, "slug": product.slug},
+        ),
+        product_type_id=product.product_type_id,
+        product_type_name=product.product_type.name,
+        product_type_slug=product.product_type.slug,
+        category_names=sorted(category.name for category in product.categories.all()),
+    )
+
+
+def _save_cards(products: Iterable[Product]) -> int:
+    cards = [make_card(product) for product in products]
+    ProductCard.objects.bulk_create(
+        cards,
+        update_conflicts=True,
+        unique_fields=["product"],
+        update_fields=CARD_FIELDS,
+    )
+    return len(cards)
+
+
+def refresh_cards(product_ids: Iterable[int]) -> int:
+    # cards of deleted products go with them, see `ProductCard.product`
+    product_ids = list(product_ids)
+    refreshed = 0
+    for offset in range(0, len(product_ids), BATCH_SIZE):
+        refreshed += _save_cards(
+            Product.objects.for_listing().filter(
+                pk__in=product_ids[offset : offset + BATCH_SIZE]
+            )
+        )
+    return refreshed
+
+
+def rebuild_cards() -> int:
+    # run in a transaction, listings are empty in between otherwise
+    ProductCard.objects.all().delete()
+    rebuilt = 0
+    last_pk = 0
+    while True:
+        products = list(
+            Product.objects.for_listing()
+            .filter(pk__gt=last_pk)
+            .order_by("pk")[:BATCH_SIZE]
+        )
+        if not products:
+            return rebuilt
+        rebuilt += _save_cards(products)
+        last_pk = products[-1].pk
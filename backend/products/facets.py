@@ -0,0 +1,116 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from django.db.models import Count, Q, QuerySet, Value
+from django.http import HttpRequest
+
+from . import cache as catalog_cache
+from .models import Category, Product, ProductType
+
+# Facets are OR-ed within and AND-ed across, eg. (oolong OR green) AND teaware.
+# A facet's counts ignore its own selection, so they tell how many products
+# picking one more of its values would add.
+CATEGORY = "category"
+PRODUCT_TYPE = "type"
+FACETS = (CATEGORY, PRODUCT_TYPE)
+
+
+@dataclass(frozen=True)
+class FacetCount:
+    slug: str
+    name: str
+    count: int
+
+
+@dataclass(frozen=True)
+class FacetFilter:
+    categories: tuple[str, ...] = ()
+    product_types: tuple[str, ...] = ()
+
+    @classmethod
+    def from_request(cls, request: HttpRequest) -> "FacetFilter":
+        return cls(
+            categories=tuple(sorted(set(request.GET.getlist(CATEGORY)))),
+            product_types=tuple(sorted(set(request.GET.getlist(PRODUCT_TYPE)))),
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self.categories or self.product_types)
+
+    def get_selected(self, facet: str) -> tuple[str, ...]:
+        return self.categories if facet == CATEGORY else self.product_types
+
+    @property
+    def signature(self) -> str:
+        return f"{','.join(self.categories)}|{','.join(self.product_types)}"
+
+    def apply(self, products: QuerySet, exclude: Optional[str] = None) -> QuerySet:
+        # subqueries rather than joins, a product in two selected categories
+        # is still one row. Works for products and their cards alike.
+        if self.categories and exclude != CATEGORY:
+            products = products.filter(
+                pk__in=Product.categories.through.objects.filter(
+                    category__slug__in=self.categories
+                ).values("product_id")
+            )
+        if self.product_types and exclude != PRODUCT_TYPE:
+            products = products.filter(
+                product_type__in=ProductType.objects.filter(
+                    slug__in=self.product_types
+                ).values("pk")
+            )
+        return products
+
+
+def _count_filter(facet_filter: FacetFilter, facet: str) -> Q:
+    condition = Q(product__is_published=True)
+    # only the other facet's selection narrows the counts
+    other_facet = CATEGORY if facet == PRODUCT_TYPE else PRODUCT_TYPE
+    if facet_filter.get_selected(other_facet):
+        products = facet_filter.apply(Product.published.all(), exclude=facet)
+        condition &= Q(product__in=products.values("pk"))
+    return condition
+
+
+def count_facets(facet_filter: FacetFilter) -> dict[str, list[FacetCount]]:
+    key = catalog_cache.make_key(
+        "facets", [catalog_cache.ALL_PRODUCTS], facet_filter.signature
+    )
+    if (facets := catalog_cache.get_entry(key)) is not None:
+        return facets
+    facets = _group_counts(list(_counts_query(facet_filter)))
+    catalog_cache.set_entry(key, facets)
+    return facets
+
+
+async def acount_facets(facet_filter: FacetFilter) -> dict[str, list[FacetCount]]:
+    key = await catalog_cache.amake_key(
+        "facets", [catalog_cache.ALL_PRODUCTS], facet_filter.signature
+    )
+    if (facets := await catalog_cache.aget_entry(key)) is not None:
+        return facets
+    facets = _group_counts([row async for row in _counts_query(facet_filter)])
+    await catalog_cache.aset_entry(key, facets)
+    return facets
+
+
+def _counts_query(facet_filter: FacetFilter) -> QuerySet:
+    # every count of every facet in a single grouped UNION ALL query
+    by_category = Category.objects.annotate(
+        facet=Value(CATEGORY),
+        count=Count("product", filter=_count_filter(facet_filter, CATEGORY)),
+    ).values_list("facet", "slug", "name", "count")
+    by_product_type = ProductType.objects.annotate(
+        facet=Value(PRODUCT_TYPE),
+        count=Count("product", filter=_count_filter(facet_filter, PRODUCT_TYPE)),
+    ).values_list("facet", "slug", "name", "count")
+    return by_category.union(by_product_type, all=True)
+
+
+def _group_counts(rows: list[tuple]) -> dict[str, list[FacetCount]]:
+    facets = {facet: [] for facet in FACETS}
+    for facet, slug, name, count in rows:
+        facets[facet].append(FacetCount(slug=slug, name=name, count=count))
+    for counts in facets.values():
+        counts.sort(key=lambda facet_count: (facet_count.name, facet_count.slug))
+    return facets
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connections
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+from products.models import Category, Product, ProductType
+
+HANDLERS = ("wsgi", "asgi")
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve the same catalog and cart requests through the WSGI and the ASGI "
+        "handler, in process, and compare requests/s"
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "--handler",
+            choices=HANDLERS + ("both",),
+            default="both",
+            help="'both' runs each handler in its own process, with the views it "
+            "would be routed to.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=8,
+            help="Threads for WSGI, tasks for ASGI.",
+        )
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument(
+            "--session",
+            action="store_true",
+            help="Send a session cookie, so pages are built rather than served "
+            "from the page cache.",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        concurrency: int = options["concurrency"]
+        total: int = options["requests"]
+        if concurrency < 1 or total < 1:
+            raise CommandError("--concurrency and --requests must be positive.")
+        if settings.DEBUG:
+            self.stderr.write("DEBUG is on, expect slow and noisy numbers.")
+
+        if options["handler"] == "both":
+            return self.compare(options)
+
+        paths = self.get_paths()
+        cookies = (
+            {settings.SESSION_COOKIE_NAME: "benchmark"} if options["session"] else {}
+        )
+        # every worker gets an even share of the requests, going round the paths
+        shares = [
+            [paths[n % len(paths)] for n in range(i, total, concurrency)]
+            for i in range(concurrency)
+        ]
+
+        # the test clients' host, like the test runner allows it
+        with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]):
+            started = time.perf_counter()
+            if options["handler"] == "wsgi":
+                statuses = self.run_wsgi(shares, cookies)
+            else:
+                statuses = async_to_sync(self.run_asgi)(shares, cookies)
+            elapsed = time.perf_counter() - started
+
+        errors = sum(status != 200 for status in statuses)
+        return (
+            f"{options['handler']}: {len(statuses)} requests, {errors} errors "
+            f"in {elapsed:.2f}s ({len(statuses) / max(elapsed, 1e-6):.0f} requests/s)"
+        )
+
+    def get_paths(self) -> list[str]:
+        product = Product.published.for_links().first()
+        category = Category.objects.first()
+        product_type = ProductType.objects.first()
+        if not (product and category and product_type):
+            raise CommandError("Nothing to benchmark, add some products first.")
+        return [
+            reverse("all_products"),
+            reverse("products_by_category", args=[category.slug]),
+            reverse("products_by_type", args=[product_type.slug]),
+            product.get_absolute_url(),
+            f"{reverse('product_search')}?q={product.name.split()[0]}",
+            reverse("cart_page"),
+        ]
+
+    def run_wsgi(self, shares: list[list[str]], cookies: dict) -> list:
+        def work(paths: list[str]) -> list[int]:
+            client = Client(raise_request_exception=False)
+            client.cookies.load(cookies)
+            try:
+                return [client.get(path).status_code for path in paths]
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=len(shares)) as executor:
+            return [
+                status for result in executor.map(work, shares) for status in result
+            ]
+
+    async def run_asgi(self, shares: list[list[str]], cookies: dict) -> list:
+        async def work(paths: list[str]) -> list[int]:
+            client = AsyncClient(raise_request_exception=False)
+            client.cookies.load(cookies)
+            return [(await client.get(path)).status_code for path in paths]
+
+        results = await asyncio.gather(*(work(paths) for paths in shares))
+        return [status for result in results for status in result]
+
+    def compare(self, options: dict) -> str:
+        # the URLconf picks sync or async views at import, see ASYNC_VIEWS
+        results = []
+        for handler in HANDLERS:
+            command = [
+                sys.executable,
+                "-m",
+                "django",
+                "benchmark_handlers",
+                f"--handler={handler}",
+                f"--concurrency={options['concurrency']}",
+                f"--requests={options['requests']}",
+            ]
+            if options["session"]:
+                command.append("--session")
+            env = os.environ | {"DJANGO_ASYNC_VIEWS": "1" if handler == "asgi" else ""}
+            process = subprocess.run(
+                command, cwd=settings.BASE_DIR, env=env, capture_output=True, text=True
+            )
+            if process.returncode:
+                raise CommandError(f"{handler} run failed:\n{process.stderr}")
+            results.append(process.stdout.strip())
+        return "\n".join(results)
@@ -0,0 +1,28 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from products import cache as catalog_cache
+from products.cards import rebuild_cards
+from products.models import Category, ProductType
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product cards of the listing pages from scratch"
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        # signals keep the cards up to date, this is for bulk writes and recovery
+        with transaction.atomic():
+            rebuilt = rebuild_cards()
+        catalog_cache.invalidate(
+            catalog_cache.ALL_PRODUCTS,
+            *map(
+                catalog_cache.category_scope,
+                Category.objects.values_list("slug", flat=True),
+            ),
+            *map(
+                catalog_cache.product_type_scope,
+                ProductType.objects.values_list("slug", flat=True),
+            ),
+        )
+        return f"Rebuilt {rebuilt} product cards."
@@ -0,0 +1,17 @@
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from products.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the product full-text search index from scratch"
+
+    def handle(self, *args: Any, **options: Any) -> str | None:
+        if connection.vendor != "sqlite":
+            raise CommandError("The search index needs SQLite's FTS5.")
+        # triggers keep the index up to date, this is for recovering it
+        with transaction.atomic():
+            indexed = rebuild_index()
+        return f"Indexed {indexed} products."
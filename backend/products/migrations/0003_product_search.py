@@ -0,0 +1,118 @@
+from django.db import migrations
+
+# An FTS5 table over products, see products/search.py. Triggers keep it in
+# sync with every write to products, their categories and product types,
+# including bulk_create() and update().
+
+INDEX_COLUMNS = "rowid, name, description, categories, product_type"
+INDEX_SELECT = """
+SELECT p.id, p.name, p.description,
+    coalesce((
+        SELECT group_concat(c.name, ' ')
+        FROM products_category c
+        JOIN products_product_categories pc ON pc.category_id = c.id
+        WHERE pc.product_id = p.id
+    ), ''),
+    coalesce((
+        SELECT t.name FROM products_producttype t WHERE t.id = p.product_type_id
+    ), '')
+FROM products_product p
+"""
+
+
+def reindex(products: str) -> str:
+    # statements re-indexing the products whose ids `products` selects
+    return f"""
+        DELETE FROM products_search WHERE rowid IN ({products});
+        INSERT INTO products_search ({INDEX_COLUMNS})
+        {INDEX_SELECT} WHERE p.id IN ({products});
+    """
+
+
+FORWARDS = [
+    """
+    CREATE VIRTUAL TABLE products_search USING fts5(
+        name, description, categories, product_type,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    """,
+    f"INSERT INTO products_search ({INDEX_COLUMNS}) {INDEX_SELECT}",
+    f"""
+    CREATE TRIGGER products_search_product_insert
+    AFTER INSERT ON products_product BEGIN
+        {reindex("NEW.id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER products_search_product_update
+    AFTER UPDATE OF id, name, description, product_type_id ON products_product
+    BEGIN
+        DELETE FROM products_search WHERE rowid = OLD.id;
+        {reindex("NEW.id")}
+    END
+    """,
+    """
+    CREATE TRIGGER products_search_product_delete
+    AFTER DELETE ON products_product BEGIN
+        DELETE FROM products_search WHERE rowid = OLD.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER products_search_categories_insert
+    AFTER INSERT ON products_product_categories BEGIN
+        {reindex("NEW.product_id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER products_search_categories_delete
+    AFTER DELETE ON products_product_categories BEGIN
+        {reindex("OLD.product_id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER products_search_category_update
+    AFTER UPDATE OF name ON products_category BEGIN
+        {reindex("SELECT product_id FROM products_product_categories WHERE category_id = NEW.id")}
+    END
+    """,
+    f"""
+    CREATE TRIGGER products_search_producttype_update
+    AFTER UPDATE OF name ON products_producttype BEGIN
+        {reindex("SELECT id FROM products_product WHERE product_type_id = NEW.id")}
+    END
+    """,
+]
+
+BACKWARDS = [
+    "DROP TRIGGER IF EXISTS products_search_producttype_update",
+    "DROP TRIGGER IF EXISTS products_search_category_update",
+    "DROP TRIGGER IF EXISTS products_search_categories_delete",
+    "DROP TRIGGER IF EXISTS products_search_categories_insert",
+    "DROP TRIGGER IF EXISTS products_search_product_delete",
+    "DROP TRIGGER IF EXISTS products_search_product_update",
+    "DROP TRIGGER IF EXISTS products_search_product_insert",
+    "DROP TABLE IF EXISTS products_search",
+]
+
+
+def run_on_sqlite(statements):
+    def run(apps, schema_editor):
+        # FTS5 is SQLite's, other databases search without the index
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for statement in statements:
+            schema_editor.execute(statement)
+
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0002_product_listing_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(run_on_sqlite(FORWARDS), run_on_sqlite(BACKWARDS)),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.5 on 2026-10-18 20:29
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# SQLite adds the columns by remaking the tables, which the search triggers
+# of 0003 don't survive, they are dropped and created again around it.
+search = import_module("products.migrations.0003_product_search")
+TRIGGERS = search.FORWARDS[2:]
+DROP_TRIGGERS = [
+    statement for statement in search.BACKWARDS if "DROP TRIGGER" in statement
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0003_product_search"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            search.run_on_sqlite(DROP_TRIGGERS), search.run_on_sqlite(TRIGGERS)
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="producttype",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                fields=["product_type", "updated_at"], name="product_type_updated_idx"
+            ),
+        ),
+        migrations.RunPython(
+            search.run_on_sqlite(TRIGGERS), search.run_on_sqlite(DROP_TRIGGERS)
+        ),
+    ]
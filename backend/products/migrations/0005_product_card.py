@@ -0,0 +1,91 @@
+# Generated by Django 4.2.5 on 2026-10-18 20:36
+
+from django.db import migrations, models
+from django.urls import reverse
+import django.db.models.deletion
+
+
+def fill_cards(apps, schema_editor):
+    # like `products.cards.make_card()`, on the historical models
+    Product = apps.get_model("products", "Product")
+    ProductCard = apps.get_model("products", "ProductCard")
+    products = Product.objects.select_related("product_type").prefetch_related(
+        "categories"
+    )
+    ProductCard.objects.bulk_create(
+        (
+            ProductCard(
+                product_id=product.pk,
+                name=product.name,
+                slug=product.slug,
+                description=product.description,
+                is_published=product.is_published,
+                url=reverse(
+                    "product_details",
+                    kwargs={
+                        "product_type": product.product_type.slug,
+                        "slug": product.slug,
+                    },
+                ),
+                product_type_id=product.product_type_id,
+                product_type_name=product.product_type.name,
+                product_type_slug=product.product_type.slug,
+                category_names=sorted(
+                    category.name for category in product.categories.all()
+                ),
+            )
+            for product in products.iterator(chunk_size=1000)
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0004_updated_at"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProductCard",
+            fields=[
+                (
+                    "product",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="card",
+                        serialize=False,
+                        to="products.product",
+                    ),
+                ),
+                ("name", models.CharField(max_length=150)),
+                ("slug", models.SlugField()),
+                ("description", models.TextField()),
+                ("is_published", models.BooleanField()),
+                ("url", models.CharField(max_length=255)),
+                ("product_type_name", models.CharField(max_length=150)),
+                ("product_type_slug", models.SlugField()),
+                ("category_names", models.JSONField(default=list)),
+                (
+                    "product_type",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="products.producttype",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["name", "product"], name="card_name_idx"),
+                    models.Index(
+                        fields=["product_type", "name", "product"],
+                        name="card_type_name_idx",
+                    ),
+                ],
+            },
+        ),
+        migrations.RunPython(fill_cards, migrations.RunPython.noop),
+    ]
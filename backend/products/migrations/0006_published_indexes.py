@@ -0,0 +1,61 @@
+# Generated by Django 4.2.5 on 2026-10-18 20:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0005_product_card"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="product",
+            name="product_name_id_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="product",
+            name="product_type_name_id_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="productcard",
+            name="card_name_idx",
+        ),
+        migrations.RemoveIndex(
+            model_name="productcard",
+            name="card_type_name_idx",
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("is_published", True)),
+                fields=["name", "id"],
+                name="published_name_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=models.Index(
+                condition=models.Q(("is_published", True)),
+                fields=["product_type", "name", "id"],
+                name="published_type_name_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productcard",
+            index=models.Index(
+                condition=models.Q(("is_published", True)),
+                fields=["name", "product"],
+                name="published_card_name_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="productcard",
+            index=models.Index(
+                condition=models.Q(("is_published", True)),
+                fields=["product_type", "name", "product"],
+                name="published_card_type_idx",
+            ),
+        ),
+    ]
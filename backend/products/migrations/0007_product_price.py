@@ -0,0 +1,52 @@
+# Generated by Django 4.2.5 on 2026-10-18 21:12
+
+from decimal import Decimal
+from importlib import import_module
+
+import django.core.validators
+from django.db import migrations, models
+
+# the search triggers don't survive SQLite remaking the table, see 0004
+updated_at = import_module("products.migrations.0004_updated_at")
+search = updated_at.search
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0006_published_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            search.run_on_sqlite(updated_at.DROP_TRIGGERS),
+            search.run_on_sqlite(updated_at.TRIGGERS),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="price",
+            field=models.DecimalField(
+                decimal_places=2,
+                default=Decimal("0.00"),
+                max_digits=10,
+                validators=[django.core.validators.MinValueValidator(Decimal("0.00"))],
+            ),
+        ),
+        migrations.AddField(
+            model_name="product",
+            name="currency",
+            field=models.CharField(
+                default="EUR", help_text="ISO 4217 code, eg. EUR.", max_length=3
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="product",
+            constraint=models.CheckConstraint(
+                check=models.Q(("price__gte", 0)), name="product_price_gte_0"
+            ),
+        ),
+        migrations.RunPython(
+            search.run_on_sqlite(updated_at.TRIGGERS),
+            search.run_on_sqlite(updated_at.DROP_TRIGGERS),
+        ),
+    ]
@@ -1,4 +1,9 @@
+from decimal import Decimal
+from typing import Self
+
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import Prefetch, Q
 from django.urls import reverse
 
 
@@ -6,6 +11,8 @@ class Category(models.Model):
     name = models.CharField(max_length=150)
     description = models.TextField()
     slug = models.SlugField(unique=True, help_text="Must be unique.")
+    # also bumped when products join or leave, see signals.py
+    updated_at = models.DateTimeField(auto_now=True)
 
     def get_absolute_url(self):
         return reverse(
@@ -24,6 +31,8 @@ class ProductType(models.Model):
     )
     description = models.TextField()
     slug = models.SlugField(unique=True, help_text="Must be unique.")
+    # also bumped when products leave, see signals.py
+    updated_at = models.DateTimeField(auto_now=True)
 
     def get_absolute_url(self):
         return reverse(
@@ -35,6 +44,30 @@ class ProductType(models.Model):
         return self.name
 
 
+class ProductQuerySet(models.QuerySet):
+    # product cards show the type name and category names, see cards.py
+    def for_listing(self) -> Self:
+        return self.select_related("product_type").prefetch_related(
+            Prefetch("categories", queryset=Category.objects.only("id", "name", "slug"))
+        )
+
+    # product links, `get_absolute_url` needs the product type slug
+    def for_links(self) -> Self:
+        return self.select_related("product_type")
+
+
+# ISO 4217 code of the prices, unless a product says otherwise
+DEFAULT_CURRENCY = "EUR"
+
+# what the storefront shows, products' and cards' partial indexes cover it
+PUBLISHED = Q(is_published=True)
+
+
+class PublishedManager(models.Manager):
+    def get_queryset(self) -> models.QuerySet:
+        return super().get_queryset().filter(PUBLISHED)
+
+
 class Product(models.Model):
     name = models.CharField(max_length=150)
     description = models.TextField()
@@ -47,6 +80,42 @@ class Product(models.Model):
     )
     categories = models.ManyToManyField(Category)
     slug = models.SlugField(unique=True, help_text="Must be unique.")
+    price = models.DecimalField(
+        max_digits=10,
+        decimal_places=2,
+        default=Decimal("0.00"),
+        validators=[MinValueValidator(Decimal("0.00"))],
+    )
+    currency = models.CharField(
+        max_length=3, default=DEFAULT_CURRENCY, help_text="ISO 4217 code, eg. EUR."
+    )
+    # also bumped by category changes and product type renames, see signals.py
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ProductQuerySet.as_manager()
+    published = PublishedManager.from_queryset(ProductQuerySet)()
+
+    class Meta:
+        # keyset pagination orders listings by (name, id)
+        indexes = [
+            models.Index(
+                fields=["name", "id"], name="published_name_idx", condition=PUBLISHED
+            ),
+            models.Index(
+                fields=["product_type", "name", "id"],
+                name="published_type_name_idx",
+                condition=PUBLISHED,
+            ),
+            # product type page validators, see ConditionalGetMixin
+            models.Index(
+                fields=["product_type", "updated_at"], name="product_type_updated_idx"
+            ),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(price__gte=0), name="product_price_gte_0"
+            ),
+        ]
 
     def get_absolute_url(self):
         return reverse(
@@ -56,3 +125,52 @@ class Product(models.Model):
 
     def __str__(self) -> str:
         return self.name
+
+
+class ProductCard(models.Model):
+    """
+    The listing pages' read model, one row per product with everything its
+    card and link show, so listings are scans of this one table.
+
+    Kept up to date by signals.py, `rebuild_product_cards` rebuilds them all,
+    eg. after bulk writes, which send no signals.
+    """
+
+    product = models.OneToOneField(
+        Product, on_delete=models.CASCADE, primary_key=True, related_name="card"
+    )
+    name = models.CharField(max_length=150)
+    slug = models.SlugField(max_length=50)
+    description = models.TextField()
+    is_published = models.BooleanField()
+    url = models.CharField(max_length=255)
+    product_type = models.ForeignKey(
+        ProductType, on_delete=models.CASCADE, related_name="+"
+    )
+    product_type_name = models.CharField(max_length=150)
+    product_type_slug = models.SlugField(max_length=50)
+    category_names = models.JSONField(default=list)
+
+    objects = models.Manager()
+    published = PublishedManager()
+
+    class Meta:
+        # same keyset orderings as products, see ProductPageMixin
+        indexes = [
+            models.Index(
+                fields=["name", "product"],
+                name="published_card_name_idx",
+                condition=PUBLISHED,
+            ),
+            models.Index(
+                fields=["product_type", "name", "product"],
+                name="published_card_type_idx",
+                condition=PUBLISHED,
+            ),
+        ]
+
+    def get_absolute_url(self) -> str:
+        return self.url
+
+    def __str__(self) -> str:
+        return self.name
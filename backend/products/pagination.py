@@ -0,0 +1,133 @@
+import base64
+import binascii
+import json
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from django.conf import settings
+from django.core.exceptions import BadRequest
+from django.db.models import Q, QuerySet
+
+NEXT = "n"
+PREVIOUS = "p"
+
+
+def encode_cursor(key: tuple, direction: str) -> str:
+    payload = json.dumps([direction, *key], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[tuple, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        direction, *key = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError) as e:
+        raise BadRequest("Invalid page cursor.") from e
+    if direction not in (NEXT, PREVIOUS):
+        raise BadRequest("Invalid page cursor.")
+    return tuple(key), direction
+
+
+@dataclass
+class KeysetPage:
+    items: list = field(default_factory=list)
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+
+    @property
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self) -> bool:
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class KeysetPaginator:
+    """
+    Cursor pagination over a unique, ascending ordering, eg. (name, id).
+
+    Every page is a single `WHERE (name, id) > (...) ORDER BY name, id LIMIT n + 1`
+    query, so deep pages cost the same as the first one and nothing is counted.
+    """
+
+    def __init__(
+        self,
+        queryset: QuerySet,
+        page_size: int,
+        ordering: tuple[str, ...] = ("name", "id"),
+    ) -> None:
+        self.queryset = queryset
+        self.page_size = page_size
+        self.ordering = ordering
+
+    def get_key(self, obj: Any) -> tuple:
+        return tuple(getattr(obj, field_name) for field_name in self.ordering)
+
+    def _seek(self, key: tuple, direction: str) -> Q:
+        if len(key) != len(self.ordering):
+            raise BadRequest("Invalid page cursor.")
+        lookup = "gt" if direction == NEXT else "lt"
+        # (a, b) > (x, y)  ==  a > x OR (a = x AND b > y)
+        condition = Q()
+        for i, field_name in enumerate(self.ordering):
+            equal_prefix = {self.ordering[j]: key[j] for j in range(i)}
+            condition |= Q(**equal_prefix, **{f"{field_name}__{lookup}": key[i]})
+        # and a >= x, so the database seeks into the index rather than scanning
+        # it from the start, it can't for the OR alone
+        return Q(**{f"{self.ordering[0]}__{lookup}e": key[0]}) & condition
+
+    def get_page(self, cursor: Optional[str] = None) -> KeysetPage:
+        queryset, key, direction = self._page_queryset(cursor)
+        return self._make_page(list(queryset[: self.page_size + 1]), key, direction)
+
+    async def aget_page(self, cursor: Optional[str] = None) -> KeysetPage:
+        queryset, key, direction = self._page_queryset(cursor)
+        items = [item async for item in queryset[: self.page_size + 1]]
+        return self._make_page(items, key, direction)
+
+    def _page_queryset(self, cursor: Optional[str]) -> tuple[QuerySet, tuple, str]:
+        queryset = self.queryset
+        if not cursor:
+            key, direction = None, NEXT
+        else:
+            key, direction = decode_cursor(cursor)
+            queryset = queryset.filter(self._seek(key, direction))
+
+        if direction == NEXT:
+            queryset = queryset.order_by(*self.ordering)
+        else:
+            queryset = queryset.order_by(*(f"-{name}" for name in self.ordering))
+        return queryset, key, direction
+
+    def _make_page(
+        self, items: list, key: Optional[tuple], direction: str
+    ) -> KeysetPage:
+        has_more = len(items) > self.page_size
+        items = items[: self.page_size]
+        if direction == PREVIOUS:
+            items.reverse()
+
+        page = KeysetPage(items=items)
+        if not items:
+            return page
+        if has_more or direction == PREVIOUS:
+            page.next_cursor = encode_cursor(self.get_key(items[-1]), NEXT)
+        if key is not None and (has_more or direction == NEXT):
+            page.prev_cursor = encode_cursor(self.get_key(items[0]), PREVIOUS)
+        return page
+
+
+def get_page_size(request) -> int:
+    default_size = settings.CATALOG_PAGE_SIZE
+    try:
+        page_size = int(request.GET.get("page_size", default_size))
+    except ValueError:
+        page_size = default_size
+    return max(1, min(page_size, settings.CATALOG_MAX_PAGE_SIZE))
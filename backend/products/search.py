@@ -0,0 +1,161 @@
+import re
+from typing import Optional
+
+from django.core.exceptions import BadRequest
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+from django.utils.safestring import SafeString, mark_safe
+
+from .models import Product
+from .pagination import (
+    NEXT,
+    PREVIOUS,
+    KeysetPage,
+    KeysetPaginator,
+    decode_cursor,
+    encode_cursor,
+)
+
+# Full-text search over an FTS5 table, one row per product with the same
+# rowid. Triggers from the 0003 migration keep it in sync with products,
+# their categories and product types, whatever way they are written.
+SEARCH_TABLE = "products_search"
+
+# bm25 column weights, in table column order
+NAME_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+CATEGORIES_WEIGHT = 4.0
+PRODUCT_TYPE_WEIGHT = 4.0
+
+# FTS5 marks matches with these, they are swapped for <mark> after escaping
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+SEARCH_INDEX_COLUMNS = "rowid, name, description, categories, product_type"
+SEARCH_INDEX_SELECT = """
+SELECT p.id, p.name, p.description,
+    coalesce((
+        SELECT group_concat(c.name, ' ')
+        FROM products_category c
+        JOIN products_product_categories pc ON pc.category_id = c.id
+        WHERE pc.product_id = p.id
+    ), ''),
+    coalesce((
+        SELECT t.name FROM products_producttype t WHERE t.id = p.product_type_id
+    ), '')
+FROM products_product p
+"""
+
+
+def to_match_expression(query: str) -> Optional[str]:
+    # every word becomes a quoted prefix term, so user input can't be parsed
+    # as FTS5 syntax and "oolo" finds "oolong"
+    terms = re.findall(r"\w+", query)
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+def highlight(text: str) -> SafeString:
+    escaped = escape(text)
+    return mark_safe(
+        escaped.replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>")
+    )
+
+
+def search_products(
+    query: str, page_size: int, cursor: Optional[str] = None
+) -> KeysetPage:
+    """
+    One keyset page of products matching `query`, best matches first.
+
+    Pages are ordered by (bm25 rank, id). Products get `search_rank`,
+    `highlighted_name` and `highlighted_snippet` attributes.
+    """
+    match = to_match_expression(query)
+    if match is None:
+        return KeysetPage()
+    if connection.vendor != "sqlite":
+        return _search_without_index(query, page_size, cursor)
+
+    rank = (
+        f"bm25({SEARCH_TABLE}, {NAME_WEIGHT}, {DESCRIPTION_WEIGHT}, "
+        f"{CATEGORIES_WEIGHT}, {PRODUCT_TYPE_WEIGHT})"
+    )
+    where = f"{SEARCH_TABLE} MATCH %s"
+    params: list = [match]
+    key, direction = None, NEXT
+    if cursor:
+        key, direction = decode_cursor(cursor)
+        if len(key) != 2:
+            raise BadRequest("Invalid page cursor.")
+        where += f" AND ({rank}, rowid) {'>' if direction == NEXT else '<'} (%s, %s)"
+        params += key
+    order = "ASC" if direction == NEXT else "DESC"
+
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(
+            f"SELECT rowid, {rank}, "
+            f"highlight({SEARCH_TABLE}, 0, '{MATCH_START}', '{MATCH_END}'), "
+            f"snippet({SEARCH_TABLE}, 1, '{MATCH_START}', '{MATCH_END}', '…', 16) "
+            f"FROM {SEARCH_TABLE} WHERE {where} "
+            f"ORDER BY {rank} {order}, rowid {order} LIMIT %s",
+            params + [page_size + 1],
+        )
+        rows = db_cursor.fetchall()
+
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == PREVIOUS:
+        rows.reverse()
+
+    # the index has unpublished products too, a page may come up short
+    products = Product.published.for_links().in_bulk(row[0] for row in rows)
+    items = []
+    for product_id, search_rank, name, snippet in rows:
+        if product := products.get(product_id):
+            product.search_rank = search_rank
+            product.highlighted_name = highlight(name)
+            product.highlighted_snippet = highlight(snippet)
+            items.append(product)
+
+    page = KeysetPage(items=items)
+    if not rows:
+        return page
+    first, last = rows[0], rows[-1]
+    if has_more or direction == PREVIOUS:
+        page.next_cursor = encode_cursor((last[1], last[0]), NEXT)
+    if key is not None and (has_more or direction == NEXT):
+        page.prev_cursor = encode_cursor((first[1], first[0]), PREVIOUS)
+    return page
+
+
+def _search_without_index(
+    query: str, page_size: int, cursor: Optional[str]
+) -> KeysetPage:
+    # no FTS5, a slow but correct scan without ranking
+    condition = Q()
+    for term in re.findall(r"\w+", query):
+        condition &= Q(name__icontains=term) | Q(description__icontains=term)
+    page = KeysetPaginator(
+        Product.published.for_links().filter(condition), page_size=page_size
+    ).get_page(cursor)
+    for product in page:
+        product.search_rank = None
+        product.highlighted_name = escape(product.name)
+        product.highlighted_snippet = escape(product.description)
+    return page
+
+
+def rebuild_index() -> int:
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} ({SEARCH_INDEX_COLUMNS}) {SEARCH_INDEX_SELECT}"
+        )
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')"
+        )
+        cursor.execute(f"SELECT count(*) FROM {SEARCH_TABLE}")
+        return cursor.fetchone()[0]
@@ -0,0 +1,219 @@
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save,
+)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import cache, cards
+from .models import Category, Product, ProductType
+
+
+def _product_scopes(products) -> list[str]:
+    return [
+        cache.product_scope(slug) for slug in products.values_list("slug", flat=True)
+    ]
+
+
+def _category_scopes(categories) -> list[str]:
+    return [
+        cache.category_scope(slug) for slug in categories.values_list("slug", flat=True)
+    ]
+
+
+def _touch(queryset) -> None:
+    # `updated_at` feeds the pages' ETag and Last-Modified, see ConditionalGetMixin
+    queryset.update(updated_at=timezone.now())
+
+
+# slugs and the product type may change on save, the old pages need bumping too
+@receiver(pre_save, sender=Product)
+def remember_product_scopes(sender, instance: Product, **kwargs):
+    instance._previous_catalog_scopes = []
+    instance._previous_product_type_id = instance._previous_price = None
+    if instance._state.adding or not instance.pk:
+        return
+    previous = (
+        Product.objects.filter(pk=instance.pk)
+        .values_list(
+            "slug", "product_type__slug", "product_type_id", "price", "currency"
+        )
+        .first()
+    )
+    if previous:
+        instance._previous_catalog_scopes = [
+            cache.product_scope(previous[0]),
+            cache.product_type_scope(previous[1]),
+        ]
+        instance._previous_product_type_id = previous[2]
+        instance._previous_price = previous[3:]
+
+
+@receiver(post_save, sender=Product)
+def invalidate_product(sender, instance: Product, created: bool, **kwargs):
+    scopes = [
+        cache.ALL_PRODUCTS,
+        cache.product_scope(instance.slug),
+        cache.product_type_scope(instance.product_type.slug),
+        *getattr(instance, "_previous_catalog_scopes", []),
+    ]
+    if not created:
+        scopes += _category_scopes(instance.categories.all())
+    # carts with the product in them have other totals now
+    previous_price = getattr(instance, "_previous_price", None)
+    if previous_price and previous_price != (instance.price, instance.currency):
+        scopes.append(cache.PRICES)
+    cache.invalidate(*scopes)
+    # the new type has a newer product now, the old one lost one
+    previous_type_id = getattr(instance, "_previous_product_type_id", None)
+    if previous_type_id and previous_type_id != instance.product_type_id:
+        _touch(ProductType.objects.filter(pk=previous_type_id))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_deleted_product_scopes(sender, instance: Product, **kwargs):
+    # the category links are gone by post_delete
+    instance._deleted_catalog_scopes = _category_scopes(instance.categories.all())
+    instance._deleted_category_ids = list(
+        instance.categories.values_list("pk", flat=True)
+    )
+
+
+@receiver(post_delete, sender=Product)
+def invalidate_deleted_product(sender, instance: Product, **kwargs):
+    # and so do carts with the product in them, its cart items are gone
+    cache.invalidate(
+        cache.ALL_PRODUCTS,
+        cache.PRICES,
+        cache.product_scope(instance.slug),
+        cache.product_type_scope(instance.product_type.slug),
+        *getattr(instance, "_deleted_catalog_scopes", []),
+    )
+    _touch(
+        Category.objects.filter(pk__in=getattr(instance, "_deleted_category_ids", []))
+    )
+    _touch(ProductType.objects.filter(pk=instance.product_type_id))
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=ProductType)
+def remember_group_slug(sender, instance, **kwargs):
+    instance._previous_slug = instance._previous_name = None
+    if not instance._state.adding and instance.pk:
+        instance._previous_slug, instance._previous_name = (
+            sender.objects.filter(pk=instance.pk).values_list("slug", "name").first()
+        ) or (None, None)
+
+
+@receiver(pre_delete, sender=Category)
+@receiver(pre_delete, sender=ProductType)
+def remember_group_products(sender, instance, **kwargs):
+    instance._deleted_catalog_scopes = _product_scopes(instance.product_set.all())
+    instance._deleted_product_ids = list(
+        instance.product_set.values_list("pk", flat=True)
+    )
+
+
+# product cards show type and category names, so their products are bumped too
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=ProductType)
+@receiver(post_delete, sender=ProductType)
+def invalidate_group(sender, instance, **kwargs):
+    group_scope = (
+        cache.category_scope if sender is Category else cache.product_type_scope
+    )
+    scopes = [cache.ALL_PRODUCTS, group_scope(instance.slug)]
+    if previous_slug := getattr(instance, "_previous_slug", None):
+        scopes.append(group_scope(previous_slug))
+    if hasattr(instance, "_deleted_catalog_scopes"):
+        scopes += instance._deleted_catalog_scopes
+    elif not kwargs.get("created"):
+        scopes += _product_scopes(instance.product_set.all())
+    # category pages name and link the type of every product on them
+    categories = None
+    if (
+        sender is ProductType
+        and kwargs.get("created") is False
+        and (previous_slug, instance._previous_name) != (instance.slug, instance.name)
+    ):
+        categories = Category.objects.filter(
+            pk__in=Category.objects.filter(product__product_type=instance).values("pk")
+        )
+        scopes += _category_scopes(categories)
+    cache.invalidate(*scopes)
+    if categories is not None:
+        _touch(categories)
+    # product links include the type's slug
+    if sender is ProductType and previous_slug and previous_slug != instance.slug:
+        _touch(instance.product_set.all())
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def invalidate_product_categories(
+    sender, instance, action: str, reverse: bool, pk_set, **kwargs
+):
+    if action == "pre_clear":
+        linked = instance.product_set.all() if reverse else instance.categories.all()
+        instance._cleared_pks = list(linked.values_list("pk", flat=True))
+        return
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if action == "post_clear":
+        pk_set = getattr(instance, "_cleared_pks", [])
+    if reverse:
+        scopes = [cache.category_scope(instance.slug)]
+        changed = Product.objects.filter(pk__in=pk_set or [])
+        changed_scopes = _product_scopes(changed) if pk_set else []
+    else:
+        scopes = [cache.product_scope(instance.slug)]
+        changed = Category.objects.filter(pk__in=pk_set or [])
+        changed_scopes = _category_scopes(changed) if pk_set else []
+    cache.invalidate(cache.ALL_PRODUCTS, *scopes, *changed_scopes)
+    # both sides of the link changed
+    if pk_set:
+        _touch(type(instance).objects.filter(pk=instance.pk))
+        _touch(changed)
+
+
+# product cards, see cards.py
+@receiver(post_save, sender=Product)
+def refresh_product_card(sender, instance: Product, **kwargs):
+    cards.refresh_cards([instance.pk])
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def refresh_linked_cards(
+    sender, instance, action: str, reverse: bool, pk_set, **kwargs
+):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        cards.refresh_cards([instance.pk])
+        return
+    if action == "post_clear":
+        # from `invalidate_product_categories()`
+        pk_set = getattr(instance, "_cleared_pks", [])
+    if pk_set:
+        cards.refresh_cards(pk_set)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=ProductType)
+def refresh_group_cards(sender, instance, created: bool, **kwargs):
+    # cards show the names, links the product type slug
+    if created or (
+        instance._previous_name == instance.name
+        and instance._previous_slug == instance.slug
+    ):
+        return
+    cards.refresh_cards(instance.product_set.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def refresh_deleted_category_cards(sender, instance: Category, **kwargs):
+    cards.refresh_cards(getattr(instance, "_deleted_product_ids", []))
@@ -1,12 +1,41 @@
-from django.test import TestCase
+import json
+import re
+import shutil
+import tempfile
+from io import StringIO
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.http import Http404
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    TestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import resolve, reverse
 
-from .models import Category, Product, ProductType
+from . import cache as catalog_cache
+from . import facets
+from .facets import FacetFilter
+from .models import Category, Product, ProductCard, ProductType
+from .pagination import NEXT, KeysetPaginator, encode_cursor
 from .views import (
     AllProductsView,
+    AsyncAllProductsView,
+    AsyncCategoryDetailView,
+    AsyncFeaturedProductsView,
+    AsyncProductDetailView,
+    AsyncProductSearchView,
+    AsyncProductTypeDetailView,
     CategoryDetailView,
     FeaturedProductsView,
     ProductDetailView,
+    ProductSearchView,
     ProductTypeDetailView,
 )
 
@@ -203,3 +232,1084 @@ class FeaturedProductsPageTests(TestCase):
     def test_featured_products_url_resolves_featuredproductsview(self):
         view = resolve("/tea-of-the-month/")
         self.assertEqual(view.func.view_class, FeaturedProductsView)
+
+
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+LOCMEM_CACHE = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "catalog-tests",
+    }
+}
+
+
+# budgets are for a cold cache
+@override_settings(CACHES=NO_CACHE)
+class CatalogQueryBudgetTests(TestCase):
+    # maximum queries a catalog page may run, regardless of catalog size
+    QUERY_BUDGETS = {
+        # the product cards and the facet counts
+        "all_products": 2,
+        # plus the ETag validators, see ConditionalGetMixin
+        "products_by_category": 3,
+        "products_by_type": 3,
+        "product_details": 2,
+        "featured_products": 0,
+    }
+
+    def setUp(self) -> None:
+        self.ptypes = [
+            ProductType.objects.create(
+                name=f"Type {i}", slug=f"type-{i}", description="a type"
+            )
+            for i in range(3)
+        ]
+        self.categories = [
+            Category.objects.create(
+                name=f"Category {i}", slug=f"category-{i}", description="a category"
+            )
+            for i in range(4)
+        ]
+        for i in range(30):
+            product = Product.objects.create(
+                name=f"Tea {i}",
+                description="Very tea",
+                is_published=True,
+                quantity=42,
+                product_type=self.ptypes[i % 3],
+                slug=f"tea-{i}",
+            )
+            product.categories.add(*self.categories[: i % 4 + 1])
+        self.product = product
+
+    def get_urls(self) -> dict[str, str]:
+        return {
+            "all_products": reverse("all_products"),
+            "products_by_category": self.categories[0].get_absolute_url(),
+            "products_by_type": self.ptypes[0].get_absolute_url(),
+            "product_details": self.product.get_absolute_url(),
+            "featured_products": reverse("featured_products"),
+        }
+
+    def assertWithinQueryBudget(self, url_name: str, url: str) -> None:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries),
+            self.QUERY_BUDGETS[url_name],
+            f"{url_name} ran {len(queries)} queries:\n"
+            + "\n".join(query["sql"] for query in queries.captured_queries),
+        )
+
+    def test_catalog_pages_within_query_budget(self):
+        for url_name, url in self.get_urls().items():
+            with self.subTest(url_name=url_name):
+                self.assertWithinQueryBudget(url_name, url)
+
+    def test_query_count_does_not_grow_with_catalog(self):
+        before = {}
+        for url_name, url in self.get_urls().items():
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get(url)
+            before[url_name] = len(queries)
+
+        for i in range(30, 60):
+            product = Product.objects.create(
+                name=f"Tea {i}",
+                description="Very tea",
+                is_published=True,
+                quantity=42,
+                product_type=self.ptypes[0],
+                slug=f"tea-{i}",
+            )
+            product.categories.add(*self.categories)
+
+        for url_name, url in self.get_urls().items():
+            with self.subTest(url_name=url_name):
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(url)
+                self.assertEqual(len(queries), before[url_name])
+
+
+@override_settings(CATALOG_PAGE_SIZE=3, CACHES=NO_CACHE)
+class KeysetPaginationTests(TestCase):
+    def setUp(self) -> None:
+        self.ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.category = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        # duplicate names make sure the id tie-breaker is used
+        for i in range(8):
+            product = Product.objects.create(
+                name=f"Oolong {i // 2}",
+                description="Sooo fragrant",
+                is_published=True,
+                quantity=42,
+                product_type=self.ptype,
+                slug=f"oolong-{i}",
+            )
+            product.categories.add(self.category)
+        self.expected = list(
+            Product.objects.order_by("name", "id").values_list("slug", flat=True)
+        )
+
+    def walk(self, url: str) -> list[str]:
+        slugs = []
+        next_url = "?format=json"
+        while next_url is not None:
+            response = self.client.get(url + next_url)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data["results"]), 3)
+            slugs += [product["slug"] for product in data["results"]]
+            next_url = data["next"]
+        return slugs
+
+    def test_pages_cover_listing_in_order(self):
+        for url in (
+            reverse("all_products"),
+            self.category.get_absolute_url(),
+            self.ptype.get_absolute_url(),
+        ):
+            with self.subTest(url=url):
+                self.assertEqual(self.walk(url), self.expected)
+
+    def test_previous_page(self):
+        url = reverse("all_products")
+        first = self.client.get(url, {"format": "json"}).json()
+        self.assertIsNone(first["prev_cursor"])
+        second = self.client.get(
+            url, {"format": "json", "cursor": first["next_cursor"]}
+        ).json()
+        back = self.client.get(
+            url, {"format": "json", "cursor": second["prev_cursor"]}
+        ).json()
+        self.assertEqual(back["results"], first["results"])
+        self.assertIsNone(back["prev_cursor"])
+        self.assertEqual(back["next_cursor"], first["next_cursor"])
+
+    def test_page_size_param(self):
+        response = self.client.get(
+            reverse("all_products"), {"format": "json", "page_size": 5}
+        )
+        self.assertEqual(len(response.json()["results"]), 5)
+
+    def test_template_page_links(self):
+        response = self.client.get(reverse("all_products"))
+        self.assertEqual(len(response.context["products"]), 3)
+        self.assertContains(response, 'rel="next"')
+        self.assertNotContains(response, 'rel="prev"')
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("all_products"), {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_deep_pages_do_not_offset_or_count(self):
+        url = reverse("all_products")
+        data = self.client.get(url, {"format": "json"}).json()
+        while data["next"]:
+            with CaptureQueriesContext(connection) as queries:
+                data = self.client.get(url + data["next"]).json()
+            for query in queries.captured_queries:
+                self.assertNotIn("OFFSET", query["sql"])
+                # the facet counts are the one grouped query, see FacetTests
+                if "UNION ALL" not in query["sql"]:
+                    self.assertNotIn("COUNT(", query["sql"])
+
+
+class CatalogCacheTestsMixin:
+    def setUp(self) -> None:
+        catalog_cache.get_cache().clear()
+        self.ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.oolongs = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        self.greens = Category.objects.create(
+            name="Greens", slug="greens", description="all green teas"
+        )
+        self.oolong = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=self.ptype,
+            slug="best-oolong",
+        )
+        self.oolong.categories.add(self.oolongs)
+        self.green = Product.objects.create(
+            name="Dragon well",
+            description="Nutty",
+            is_published=True,
+            quantity=42,
+            product_type=self.ptype,
+            slug="dragon-well",
+        )
+        self.green.categories.add(self.greens)
+
+    def assertServedFromCache(self, url: str):
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            return self.client.get(url)
+
+    def test_anonymous_pages_are_cached(self):
+        for url in (
+            reverse("all_products"),
+            reverse("featured_products"),
+            self.oolongs.get_absolute_url(),
+            self.oolong.get_absolute_url(),
+            reverse("all_products") + "?format=json",
+        ):
+            with self.subTest(url=url):
+                fresh = self.client.get(url)
+                cached = self.assertServedFromCache(url)
+                self.assertEqual(cached.content, fresh.content)
+                self.assertEqual(cached["Content-Type"], fresh["Content-Type"])
+                # shared only between visitors without a session or cart
+                self.assertIn("Cookie", fresh["Vary"])
+                self.assertIn("Cookie", cached["Vary"])
+
+    def test_product_edit_only_bumps_affected_pages(self):
+        for url in (
+            reverse("all_products"),
+            self.oolongs.get_absolute_url(),
+            self.greens.get_absolute_url(),
+            self.oolong.get_absolute_url(),
+        ):
+            self.client.get(url)
+
+        self.oolong.name = "Renamed oolong"
+        self.oolong.save()
+
+        for url in (
+            reverse("all_products"),
+            self.oolongs.get_absolute_url(),
+            self.oolong.get_absolute_url(),
+        ):
+            with self.subTest(url=url):
+                self.assertContains(self.client.get(url), "Renamed oolong")
+        with self.assertNumQueries(0):
+            self.client.get(self.greens.get_absolute_url())
+
+    def test_category_rename_updates_product_cards(self):
+        self.client.get(reverse("all_products"))
+        self.oolongs.name = "Wulongs"
+        self.oolongs.save()
+        self.assertContains(self.client.get(reverse("all_products")), "Wulongs")
+
+    def test_product_type_rename_updates_category_pages(self):
+        url = self.oolongs.get_absolute_url()
+        self.assertServedFromCache(url)
+        self.ptype.slug = "green-teas"
+        self.ptype.save()
+        response = self.client.get(url)
+        self.assertContains(response, "/green-teas/best-oolong")
+        self.assertNotContains(response, "/teas/best-oolong")
+
+    def test_category_links_invalidate_both_sides(self):
+        self.assertServedFromCache(self.greens.get_absolute_url())
+        self.oolong.categories.add(self.greens)
+        self.assertContains(
+            self.client.get(self.greens.get_absolute_url()), self.oolong.name
+        )
+
+        self.assertServedFromCache(self.oolongs.get_absolute_url())
+        self.oolongs.product_set.clear()
+        self.assertNotContains(
+            self.client.get(self.oolongs.get_absolute_url()), self.oolong.name
+        )
+
+    def test_deleted_product_leaves_listings(self):
+        self.assertServedFromCache(self.greens.get_absolute_url())
+        self.assertServedFromCache(reverse("all_products"))
+        self.green.delete()
+        self.assertNotContains(
+            self.client.get(self.greens.get_absolute_url()), "Dragon well"
+        )
+        self.assertNotContains(self.client.get(reverse("all_products")), "Dragon well")
+
+    def test_pages_with_csrf_token_only_cache_the_listing(self):
+        url = self.ptype.get_absolute_url()
+        self.client.get(url)
+        # the product type itself, the product listing comes from the cache
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertContains(response, self.oolong.name)
+        self.assertContains(response, "csrfmiddlewaretoken")
+
+    def test_visitors_with_a_session_skip_the_page_cache(self):
+        url = self.oolong.get_absolute_url()
+        self.client.get(url)
+        self.client.cookies["sessionid"] = "not-a-session"
+        # and the session, for the cart badge
+        with self.assertNumQueries(2):
+            self.client.get(url)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class LocMemCatalogCacheTests(CatalogCacheTestsMixin, TestCase):
+    pass
+
+
+class FileBasedCatalogCacheTests(CatalogCacheTestsMixin, TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cache_dir = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cache_dir)
+        cls.enterClassContext(
+            override_settings(
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                        "LOCATION": cache_dir,
+                    }
+                }
+            )
+        )
+        super().setUpClass()
+
+
+@override_settings(CACHES=NO_CACHE)
+class ProductCardTests(TestCase):
+    def setUp(self) -> None:
+        self.ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.oolongs = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        self.greens = Category.objects.create(
+            name="Greens", slug="greens", description="all green teas"
+        )
+        self.oolong = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=self.ptype,
+            slug="best-oolong",
+        )
+
+    def card(self) -> ProductCard:
+        return ProductCard.objects.get(product=self.oolong)
+
+    def test_cards_follow_writes(self):
+        card = self.card()
+        self.assertEqual(card.name, "The best oolong tea")
+        self.assertEqual(card.url, self.oolong.get_absolute_url())
+        self.assertEqual(card.product_type_name, "Teas")
+        self.assertEqual(card.category_names, [])
+
+        self.oolong.categories.add(self.oolongs, self.greens)
+        self.assertEqual(self.card().category_names, ["Greens", "Oolongs"])
+        self.greens.product_set.remove(self.oolong)
+        self.assertEqual(self.card().category_names, ["Oolongs"])
+
+        self.oolongs.name = "Wulongs"
+        self.oolongs.save()
+        self.assertEqual(self.card().category_names, ["Wulongs"])
+        self.oolongs.delete()
+        self.assertEqual(self.card().category_names, [])
+
+        self.ptype.slug = "tea"
+        self.ptype.save()
+        self.assertEqual(self.card().url, "/shop/tea/best-oolong/")
+
+        self.oolong.is_published = False
+        self.oolong.save()
+        self.assertFalse(self.card().is_published)
+        self.oolong.delete()
+        self.assertFalse(ProductCard.objects.exists())
+
+    def test_listings_read_cards_only(self):
+        self.oolong.categories.add(self.oolongs)
+        for url in (
+            reverse("all_products"),
+            self.oolongs.get_absolute_url(),
+            self.ptype.get_absolute_url(),
+        ):
+            with self.subTest(url=url):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url)
+                self.assertContains(response, "The best oolong tea")
+                listing = [
+                    query["sql"]
+                    for query in queries.captured_queries
+                    if 'FROM "products_productcard"' in query["sql"]
+                ]
+                self.assertEqual(len(listing), 1)
+                self.assertNotIn("JOIN", listing[0])
+
+    def test_rebuild_product_cards(self):
+        self.oolong.categories.add(self.oolongs)
+        # bulk writes send no signals
+        Product.objects.update(name="Renamed oolong")
+        ProductCard.objects.filter(product=self.oolong).delete()
+        output = StringIO()
+        call_command("rebuild_product_cards", stdout=output)
+        self.assertIn("Rebuilt 1 product cards.", output.getvalue())
+        self.assertEqual(self.card().name, "Renamed oolong")
+        self.assertEqual(self.card().category_names, ["Oolongs"])
+
+
+@override_settings(CACHES=NO_CACHE)
+class PublishedCatalogTests(TestCase):
+    def setUp(self) -> None:
+        self.ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.oolongs = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        self.draft = Product.objects.create(
+            name="Secret oolong",
+            description="Not yet",
+            is_published=False,
+            quantity=42,
+            product_type=self.ptype,
+            slug="secret-oolong",
+        )
+        self.draft.categories.add(self.oolongs)
+
+    def test_storefront_hides_unpublished_products(self):
+        self.assertEqual(
+            self.client.get(self.draft.get_absolute_url()).status_code, 404
+        )
+        for url in (
+            reverse("all_products"),
+            self.oolongs.get_absolute_url(),
+            self.ptype.get_absolute_url(),
+            reverse("product_search") + "?q=secret",
+        ):
+            with self.subTest(url=url):
+                self.assertNotContains(self.client.get(url), "Secret oolong")
+        facets = self.client.get(reverse("all_products"), {"format": "json"}).json()[
+            "facets"
+        ]
+        self.assertEqual(facets["category"][0]["count"], 0)
+        self.assertEqual(
+            self.client.post(
+                reverse("cart_page"), {"product_slug": "secret-oolong"}
+            ).status_code,
+            404,
+        )
+
+        self.draft.is_published = True
+        self.draft.save()
+        self.assertContains(
+            self.client.get(self.oolongs.get_absolute_url()), "Secret oolong"
+        )
+
+    def test_unpublished_products_can_leave_the_cart(self):
+        self.draft.is_published = True
+        self.draft.save()
+        self.client.post(reverse("cart_page"), {"product_slug": "secret-oolong"})
+        Product.objects.update(is_published=False)
+        response = self.client.post(
+            reverse("cart_page"),
+            {"product_slug": "secret-oolong", "remove_from_cart": True},
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertNotContains(self.client.get(reverse("cart_page")), "Secret oolong")
+
+
+class PublishedIndexTests(TestCase):
+    # query plans depend on table sizes, so a catalog of realistic size
+    PRODUCTS = 100_000
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.ptypes = ProductType.objects.bulk_create(
+            ProductType(name=f"Type {i}", slug=f"type-{i}", description="a type")
+            for i in range(20)
+        )
+        products = Product.objects.bulk_create(
+            (
+                Product(
+                    name=f"Tea {i * 7919 % cls.PRODUCTS}",
+                    description="Very tea",
+                    is_published=i % 10 != 0,
+                    quantity=1,
+                    product_type=cls.ptypes[i % 20],
+                    slug=f"tea-{i}",
+                )
+                for i in range(cls.PRODUCTS)
+            ),
+            batch_size=10_000,
+        )
+        # no signals for bulk inserts, the cards are made here
+        ProductCard.objects.bulk_create(
+            (
+                ProductCard(
+                    product=product,
+                    name=product.name,
+                    slug=product.slug,
+                    description=product.description,
+                    is_published=product.is_published,
+                    url=f"/shop/{product.product_type.slug}/{product.slug}/",
+                    product_type=product.product_type,
+                    product_type_name=product.product_type.name,
+                    product_type_slug=product.product_type.slug,
+                )
+                for product in products
+            ),
+            batch_size=10_000,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def assertUsesIndex(self, queryset, index: str, ordering=("name", "pk")):
+        for cursor in (None, encode_cursor(("Tea 5", 5), NEXT)):
+            with self.subTest(index=index, cursor=cursor):
+                page_queryset, _, _ = KeysetPaginator(
+                    queryset, page_size=20, ordering=ordering
+                )._page_queryset(cursor)
+                plan = page_queryset[:21].explain()
+                self.assertIn(f"USING INDEX {index}", plan)
+                self.assertNotIn("TEMP B-TREE", plan)
+                if cursor:
+                    # a seek into the index, not a scan from its start
+                    self.assertIn("name>?", plan)
+
+    def test_listings_use_partial_indexes(self):
+        ptype = self.ptypes[3]
+        self.assertUsesIndex(ProductCard.published.all(), "published_card_name_idx")
+        self.assertUsesIndex(
+            ProductCard.published.filter(product_type=ptype), "published_card_type_idx"
+        )
+        self.assertUsesIndex(
+            Product.published.all(), "published_name_idx", ordering=("name", "id")
+        )
+        self.assertUsesIndex(
+            Product.published.filter(product_type=ptype),
+            "published_type_name_idx",
+            ordering=("name", "id"),
+        )
+
+    def test_listing_pages_are_published_only(self):
+        response = self.client.get(reverse("all_products"), {"format": "json"})
+        slugs = [product["slug"] for product in response.json()["results"]]
+        self.assertEqual(len(slugs), settings.CATALOG_PAGE_SIZE)
+        self.assertTrue(
+            all(
+                product.is_published
+                for product in Product.objects.filter(slug__in=slugs)
+            )
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConditionalGetTests(TestCase):
+    def setUp(self) -> None:
+        self.ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.other_ptype = ProductType.objects.create(
+            name="Teaware", slug="teaware", description="pots and cups"
+        )
+        self.oolongs = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        self.greens = Category.objects.create(
+            name="Greens", slug="greens", description="all green teas"
+        )
+        self.oolong = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=self.ptype,
+            slug="best-oolong",
+        )
+        self.oolong.categories.add(self.oolongs)
+        self.urls = [
+            self.oolong.get_absolute_url(),
+            self.oolongs.get_absolute_url(),
+            self.greens.get_absolute_url(),
+            self.ptype.get_absolute_url(),
+            self.other_ptype.get_absolute_url(),
+        ]
+        # the CSRF cookie is part of every ETag, get it before comparing
+        self.client.get(self.ptype.get_absolute_url())
+
+    def tearDown(self) -> None:
+        catalog_cache.get_cache().clear()
+
+    def etags(self) -> dict[str, str]:
+        return {url: self.client.get(url)["ETag"] for url in self.urls}
+
+    def assertChanged(self, before: dict, changed: set[str]) -> None:
+        after = self.etags()
+        for url in self.urls:
+            with self.subTest(url=url):
+                if url in changed:
+                    self.assertNotEqual(after[url], before[url])
+                else:
+                    self.assertEqual(after[url], before[url])
+
+    def test_revalidation_is_304_without_rendering(self):
+        for url in self.urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertTrue(response["ETag"].startswith('W/"'))
+                self.assertIn("Cookie", response["Vary"])
+                with self.assertNumQueries(0):
+                    not_modified = self.client.get(
+                        url, HTTP_IF_NONE_MATCH=response["ETag"]
+                    )
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified.templates, [])
+                self.assertEqual(not_modified["ETag"], response["ETag"])
+                since = self.client.get(
+                    url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+                )
+                self.assertEqual(since.status_code, 304)
+
+    @override_settings(CACHES=NO_CACHE)
+    def test_validators_are_one_query(self):
+        for url in self.urls:
+            with self.subTest(url=url):
+                etag = self.client.get(url)["ETag"]
+                with self.assertNumQueries(1):
+                    response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+
+    def test_product_edit(self):
+        before = self.etags()
+        self.oolong.description = "Even more fragrant"
+        self.oolong.save()
+        self.assertChanged(
+            before,
+            {
+                self.oolong.get_absolute_url(),
+                self.oolongs.get_absolute_url(),
+                self.ptype.get_absolute_url(),
+            },
+        )
+
+    def test_category_links_change_both_sides(self):
+        before = self.etags()
+        self.oolong.categories.add(self.greens)
+        self.assertChanged(
+            before,
+            {
+                self.oolong.get_absolute_url(),
+                self.greens.get_absolute_url(),
+            },
+        )
+        before = self.etags()
+        self.oolongs.product_set.clear()
+        self.assertChanged(
+            before,
+            {
+                self.oolong.get_absolute_url(),
+                self.oolongs.get_absolute_url(),
+            },
+        )
+
+    def test_product_moves_and_deletes(self):
+        before = self.etags()
+        self.oolong.product_type = self.other_ptype
+        self.oolong.save()
+        self.assertChanged(
+            before,
+            {
+                self.urls[0],
+                self.oolongs.get_absolute_url(),
+                self.ptype.get_absolute_url(),
+                self.other_ptype.get_absolute_url(),
+            },
+        )
+        url = self.oolongs.get_absolute_url()
+        response = self.client.get(url)
+        self.oolong.delete()
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"]).status_code,
+            200,
+        )
+
+    def test_product_type_rename(self):
+        # category pages show the types of their products
+        before = self.etags()
+        self.ptype.name = "Green teas"
+        self.ptype.save()
+        self.assertChanged(
+            before,
+            {
+                self.oolongs.get_absolute_url(),
+                self.ptype.get_absolute_url(),
+            },
+        )
+
+    def test_csrf_cookie_is_part_of_the_etag(self):
+        url = self.ptype.get_absolute_url()
+        etag = self.client.get(url)["ETag"]
+        self.client.cookies[settings.CSRF_COOKIE_NAME] = "x" * 32
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_missing_object_is_404(self):
+        response = self.client.get("/shop/teas/nope/", HTTP_IF_NONE_MATCH="*")
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn("ETag", response)
+
+    async def test_async_views(self):
+        # like the request factory's requests, without a CSRF cookie
+        self.client.cookies.clear()
+        url = self.oolong.get_absolute_url()
+        etag = (await sync_to_async(self.client.get)(url))["ETag"]
+        kwargs = {"product_type": "teas", "slug": "best-oolong"}
+        request = AsyncRequestFactory().get(url, headers={"If-None-Match": etag})
+        response = await AsyncProductDetailView.as_view()(request, **kwargs)
+        self.assertEqual(response.status_code, 304)
+        request = AsyncRequestFactory().get(url)
+        response = await AsyncProductDetailView.as_view()(request, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], etag)
+
+
+@override_settings(CACHES=NO_CACHE)
+class ProductSearchTests(TestCase):
+    def setUp(self) -> None:
+        self.teas = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.teawares = ProductType.objects.create(
+            name="Teawares", slug="teawares", description="for making tea"
+        )
+        self.oolongs = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        self.best = Product.objects.create(
+            name="The best oolong tea",
+            description="Sooo fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=self.teas,
+            slug="best-oolong",
+        )
+        self.inferior = Product.objects.create(
+            name="Inferior tea",
+            description="Tastes a bit like an oolong, only so fragrant",
+            is_published=True,
+            quantity=42,
+            product_type=self.teas,
+            slug="not-best-oolong",
+        )
+        self.pot = Product.objects.create(
+            name="Gaiwan <b>bowl</b>",
+            description="Brews any tea & more",
+            is_published=True,
+            quantity=42,
+            product_type=self.teawares,
+            slug="gaiwan",
+        )
+        self.url = reverse("product_search")
+
+    def search(self, query: str, **params) -> dict:
+        response = self.client.get(self.url, {"q": query, "format": "json", **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def slugs(self, query: str) -> list[str]:
+        return [product["slug"] for product in self.search(query)["results"]]
+
+    def test_search_url_is_not_a_product_type(self):
+        self.assertEqual(resolve(self.url).func.view_class, ProductSearchView)
+
+    def test_name_matches_rank_first(self):
+        self.assertEqual(self.slugs("oolong"), ["best-oolong", "not-best-oolong"])
+
+    def test_prefix_queries(self):
+        self.assertEqual(self.slugs("oolo"), ["best-oolong", "not-best-oolong"])
+        self.assertEqual(self.slugs("gaiw"), ["gaiwan"])
+
+    def test_user_input_is_not_fts_syntax(self):
+        self.assertEqual(self.slugs('oolong" OR (NEAR'), [])
+        self.assertEqual(self.slugs("***"), [])
+        self.assertEqual(self.slugs(""), [])
+
+    def test_highlights_are_escaped(self):
+        result = self.search("gaiwan bowl")["results"][0]
+        self.assertEqual(
+            result["highlighted_name"],
+            "<mark>Gaiwan</mark> &lt;b&gt;<mark>bowl</mark>&lt;/b&gt;",
+        )
+        response = self.client.get(self.url, {"q": "brews"})
+        self.assertContains(response, "<mark>Brews</mark> any tea &amp; more")
+
+    def test_index_follows_writes(self):
+        self.best.categories.add(self.oolongs)
+        self.assertEqual(self.slugs("oolongs"), ["best-oolong"])
+        self.oolongs.name = "Wulongs"
+        self.oolongs.save()
+        self.assertEqual(self.slugs("wulongs"), ["best-oolong"])
+        self.best.categories.remove(self.oolongs)
+        self.assertEqual(self.slugs("wulongs"), [])
+
+        Product.objects.filter(pk=self.pot.pk).update(name="Teapot")
+        self.assertEqual(self.slugs("teapot"), ["gaiwan"])
+        ProductType.objects.filter(pk=self.teawares.pk).update(name="Pottery")
+        self.assertEqual(self.slugs("pottery"), ["gaiwan"])
+
+        self.pot.delete()
+        self.assertEqual(self.slugs("teapot"), [])
+
+    def test_pagination(self):
+        Product.objects.bulk_create(
+            Product(
+                name=f"Oolong {i}",
+                description="Oolong",
+                is_published=True,
+                quantity=1,
+                product_type=self.teas,
+                slug=f"oolong-{i}",
+            )
+            for i in range(7)
+        )
+        expected = self.slugs("oolong")
+        self.assertEqual(len(expected), 9)
+
+        seen, cursor = [], None
+        with self.assertNumQueries(2):
+            page = self.search("oolong", page_size=4)
+        while True:
+            seen += [product["slug"] for product in page["results"]]
+            if not page["next_cursor"]:
+                break
+            cursor = page["next_cursor"]
+            page = self.search("oolong", page_size=4, cursor=cursor)
+        self.assertEqual(seen, expected)
+
+        previous = self.search("oolong", page_size=4, cursor=page["prev_cursor"])
+        self.assertEqual(
+            [product["slug"] for product in previous["results"]], expected[4:8]
+        )
+        self.assertEqual(
+            self.client.get(self.url, {"q": "oolong", "cursor": "nope"}).status_code,
+            400,
+        )
+
+    def test_rebuild_search_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM products_search")
+        self.assertEqual(self.slugs("oolong"), [])
+        output = StringIO()
+        call_command("rebuild_search_index", stdout=output)
+        self.assertIn("Indexed 3 products.", output.getvalue())
+        self.assertEqual(self.slugs("oolong"), ["best-oolong", "not-best-oolong"])
+
+
+@override_settings(CACHES=NO_CACHE)
+class FacetTests(TestCase):
+    def setUp(self) -> None:
+        self.teas = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.teawares = ProductType.objects.create(
+            name="Teawares", slug="teawares", description="for making tea"
+        )
+        self.oolongs = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        self.greens = Category.objects.create(
+            name="Greens", slug="greens", description="all green teas"
+        )
+        Category.objects.create(name="Empty", slug="empty", description="nothing")
+        products = {}
+        for slug, product_type, categories in [
+            ("oolong", self.teas, [self.oolongs]),
+            ("green", self.teas, [self.greens]),
+            ("green-oolong", self.teas, [self.oolongs, self.greens]),
+            ("oolong-cup", self.teawares, [self.oolongs]),
+            ("kettle", self.teawares, []),
+        ]:
+            products[slug] = Product.objects.create(
+                name=slug,
+                description="very tea",
+                is_published=True,
+                quantity=1,
+                product_type=product_type,
+                slug=slug,
+            )
+            products[slug].categories.set(categories)
+        self.url = reverse("all_products")
+
+    def get(self, **filters) -> dict:
+        response = self.client.get(self.url, {**filters, "format": "json"})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def counts(self, data: dict) -> dict:
+        return {
+            facet: {value["slug"]: value["count"] for value in values}
+            for facet, values in data["facets"].items()
+        }
+
+    def slugs(self, data: dict) -> list[str]:
+        return sorted(product["slug"] for product in data["results"])
+
+    def test_unfiltered_counts(self):
+        data = self.get()
+        self.assertEqual(len(data["results"]), 5)
+        self.assertEqual(
+            self.counts(data),
+            {
+                "category": {"empty": 0, "greens": 2, "oolongs": 3},
+                "type": {"teas": 3, "teawares": 2},
+            },
+        )
+
+    def test_values_are_ored_within_and_anded_across_facets(self):
+        data = self.get(category=["oolongs", "greens"])
+        self.assertEqual(
+            self.slugs(data), ["green", "green-oolong", "oolong", "oolong-cup"]
+        )
+        data = self.get(category=["oolongs", "greens"], type="teas")
+        self.assertEqual(self.slugs(data), ["green", "green-oolong", "oolong"])
+        # a facet's counts ignore its own selection
+        self.assertEqual(
+            self.counts(data),
+            {
+                "category": {"empty": 0, "greens": 2, "oolongs": 2},
+                "type": {"teas": 3, "teawares": 1},
+            },
+        )
+
+    def test_counts_are_one_query_and_cached(self):
+        facet_filter = FacetFilter(categories=("oolongs",))
+        with self.assertNumQueries(1):
+            facets.count_facets(facet_filter)
+        with self.settings(CACHES=LOCMEM_CACHE):
+            with self.assertNumQueries(1):
+                facets.count_facets(facet_filter)
+            with self.assertNumQueries(0):
+                counts = facets.count_facets(facet_filter)
+            self.assertEqual(
+                {value.slug: value.count for value in counts["type"]},
+                {"teas": 2, "teawares": 1},
+            )
+            # any catalog edit makes for new counts
+            Product.objects.get(slug="kettle").categories.add(self.oolongs)
+            counts = facets.count_facets(facet_filter)
+            self.assertEqual(
+                {value.slug: value.count for value in counts["type"]},
+                {"teas": 2, "teawares": 2},
+            )
+
+    def test_facet_links_toggle_values(self):
+        data = self.get(category="oolongs", cursor="")
+        oolongs, greens = (
+            next(value for value in data["facets"]["category"] if value["slug"] == slug)
+            for slug in ("oolongs", "greens")
+        )
+        self.assertTrue(oolongs["selected"])
+        self.assertEqual(oolongs["url"], "?format=json")
+        self.assertFalse(greens["selected"])
+        self.assertEqual(greens["url"], "?category=oolongs&category=greens&format=json")
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AsyncCatalogViewTests(TestCase):
+    def setUp(self) -> None:
+        self.ptype = ProductType.objects.create(
+            name="Teas", slug="teas", description="all the teas"
+        )
+        self.category = Category.objects.create(
+            name="Oolongs", slug="oolongs", description="all oolong teas"
+        )
+        for i in range(3):
+            product = Product.objects.create(
+                name=f"Oolong tea {i}",
+                description="Sooo fragrant",
+                is_published=True,
+                quantity=42,
+                product_type=self.ptype,
+                slug=f"oolong-{i}",
+            )
+            product.categories.add(self.category)
+        self.views = [
+            (AllProductsView, AsyncAllProductsView, "/shop/", {}),
+            (FeaturedProductsView, AsyncFeaturedProductsView, "/tea-of-the-month/", {}),
+            (
+                CategoryDetailView,
+                AsyncCategoryDetailView,
+                "/shop/category/oolongs/",
+                {"slug": "oolongs"},
+            ),
+            (
+                ProductTypeDetailView,
+                AsyncProductTypeDetailView,
+                "/shop/teas/",
+                {"slug": "teas"},
+            ),
+            (
+                ProductDetailView,
+                AsyncProductDetailView,
+                "/shop/teas/oolong-1/",
+                {"product_type": "teas", "slug": "oolong-1"},
+            ),
+            (ProductSearchView, AsyncProductSearchView, "/shop/search/?q=oolo", {}),
+        ]
+
+    def tearDown(self) -> None:
+        catalog_cache.get_cache().clear()
+
+    def without_csrf_token(self, content: bytes) -> bytes:
+        # tokens are masked differently every time
+        return re.sub(rb'name="csrfmiddlewaretoken" value="\w+"', b"", content)
+
+    async def test_async_views_render_what_sync_views_do(self):
+        for sync_view, async_view, path, kwargs in self.views:
+            with self.subTest(async_view.__name__):
+                self.assertTrue(async_view.view_is_async)
+                # a session cookie skips the page cache, a second request
+                # renders again from the cached listing
+                for cookies in ({"sessionid": "x"}, {"sessionid": "x"}, {}):
+                    request = RequestFactory().get(path)
+                    request.COOKIES = cookies
+                    expected = await sync_to_async(
+                        lambda: sync_view.as_view()(request, **kwargs).render()
+                    )()
+                    request = AsyncRequestFactory().get(path)
+                    request.COOKIES = cookies
+                    response = await async_view.as_view()(request, **kwargs)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(
+                        self.without_csrf_token(response.content),
+                        self.without_csrf_token(expected.content),
+                    )
+
+    async def test_missing_object_is_404(self):
+        request = AsyncRequestFactory().get("/shop/teas/nope/")
+        with self.assertRaises(Http404):
+            await AsyncProductDetailView.as_view()(
+                request, product_type="teas", slug="nope"
+            )
+
+    async def test_json_listing(self):
+        request = AsyncRequestFactory().get(
+            "/shop/", {"format": "json", "page_size": 2}
+        )
+        data = json.loads((await AsyncAllProductsView.as_view()(request)).content)
+        self.assertEqual(
+            [product["slug"] for product in data["results"]], ["oolong-0", "oolong-1"]
+        )
+        self.assertIsNotNone(data["next_cursor"])
+        self.assertEqual(data["facets"]["category"][0]["count"], 3)
+
+    def test_benchmark_handlers(self):
+        out = call_command(
+            "benchmark_handlers",
+            handler="asgi",
+            requests=12,
+            concurrency=2,
+            stdout=StringIO(),
+            stderr=StringIO(),
+        )
+        self.assertRegex(out, r"^asgi: 12 requests, 0 errors")
@@ -1,11 +1,21 @@
+from django.conf import settings
 from django.urls import path
 
-from .views import (
-    AllProductsView,
-    CategoryDetailView,
-    ProductDetailView,
-    ProductTypeDetailView,
-)
+# when served by ASGI with `settings.ASYNC_VIEWS` on
+if settings.ASYNC_VIEWS:
+    from .views import AsyncAllProductsView as AllProductsView
+    from .views import AsyncCategoryDetailView as CategoryDetailView
+    from .views import AsyncProductDetailView as ProductDetailView
+    from .views import AsyncProductSearchView as ProductSearchView
+    from .views import AsyncProductTypeDetailView as ProductTypeDetailView
+else:
+    from .views import (
+        AllProductsView,
+        CategoryDetailView,
+        ProductDetailView,
+        ProductSearchView,
+        ProductTypeDetailView,
+    )
 
 urlpatterns = [
     path("", AllProductsView.as_view(), name="all_products"),
@@ -14,6 +24,8 @@ urlpatterns = [
         CategoryDetailView.as_view(),
         name="products_by_category",
     ),
+    # before the product type slugs, or "search" would be taken for one
+    path("search/", ProductSearchView.as_view(), name="product_search"),
     path("<slug:slug>/", ProductTypeDetailView.as_view(), name="products_by_type"),
     path(
         "<slug:product_type>/<slug:slug>/",
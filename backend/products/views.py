@@ -1,34 +1,547 @@
+import hashlib
+from datetime import datetime
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse, JsonResponse
+from django.template.response import SimpleTemplateResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
 from django.views.generic import DetailView, ListView, TemplateView
+from django.views.generic.detail import SingleObjectMixin
+
+from TeaShop.instrumentation import timed
+
+from . import cache as catalog_cache
+from .facets import FacetCount, FacetFilter, acount_facets, count_facets
+from .models import Category, Product, ProductCard, ProductType
+from .pagination import KeysetPage, KeysetPaginator, get_page_size
+from .search import search_products
+
+
+def product_json(product: Product) -> dict:
+    return {
+        "name": product.name,
+        "slug": product.slug,
+        "url": product.get_absolute_url(),
+        "product_type": product.product_type.slug,
+    }
+
+
+def card_json(card: ProductCard) -> dict:
+    return {
+        "name": card.name,
+        "slug": card.slug,
+        "url": card.url,
+        "product_type": card.product_type_slug,
+    }
+
+
+def render_now(response: HttpResponse) -> HttpResponse:
+    # for async views, the async handler would render a template response in a
+    # thread, even one that is rendered already
+    if not isinstance(response, SimpleTemplateResponse):
+        return response
+    with timed("template"):
+        content = response.render().content
+    rendered = HttpResponse(content, status=response.status_code)
+    for header, value in response.items():
+        rendered[header] = value
+    return rendered
+
+
+def get_page_url(request, cursor: Optional[str]) -> Optional[str]:
+    if cursor is None:
+        return None
+    query = request.GET.copy()
+    query["cursor"] = cursor
+    return f"?{query.urlencode()}"
+
+
+def group_validators(model, slug: str):
+    # the group and its newest product, and a count for products that left
+    return (
+        model.objects.filter(slug=slug)
+        .values("pk")
+        .annotate(
+            products_updated_at=Max("product__updated_at"), products=Count("product")
+        )
+        .values_list("updated_at", "products_updated_at", "products")
+    )
+
+
+class ConditionalGetMixin:
+    """
+    ETag and Last-Modified for the page of one catalog object.
+
+    The validators come from one query, `get_validator_queryset()`, cached
+    under the page's cache scopes like the page itself. They are looked up
+    before the page cache or any template, so a matching revalidation is a 304
+    for the price of that lookup.
+    """
+
+    def get_validator_queryset(self):
+        # one row of the `updated_at` values and counts the page depends on
+        raise NotImplementedError
+
+    def get_validator_row(self) -> Optional[tuple]:
+        key = catalog_cache.make_key("validators", self.get_cache_scopes())
+        if (row := catalog_cache.get_entry(key)) is None:
+            row = self.get_validator_queryset().first()
+            if row is not None:
+                catalog_cache.set_entry(key, row)
+        return row
+
+    async def aget_validator_row(self) -> Optional[tuple]:
+        key = await catalog_cache.amake_key("validators", self.get_cache_scopes())
+        if (row := await catalog_cache.aget_entry(key)) is None:
+            row = await self.get_validator_queryset().afirst()
+            if row is not None:
+                await catalog_cache.aset_entry(key, row)
+        return row
+
+    def get_validators(self, row: tuple) -> tuple[str, Optional[int]]:
+        # pages may carry a CSRF token, which comes from the visitor's secret,
+        # a new one if the page just made it
+        csrf_secret = self.request.META.get("CSRF_COOKIE", "")
+        # and the header's cart badge, see cart/context_processors.py
+        cart = getattr(self.request, "cart", None)
+        badge = cart.get_summary() if cart and cart.has_cart() else None
+        digest = hashlib.md5(
+            repr((row, csrf_secret, badge)).encode(), usedforsecurity=False
+        ).hexdigest()
+        # weak, CSRF tokens are masked differently on every render
+        etag = f'W/"{digest}"'
+        if badge is not None:
+            # a date can't tell a cart change, If-Modified-Since alone would
+            # be a 304 with the old badge
+            return etag, None
+        last_modified = max(value for value in row if isinstance(value, datetime))
+        return etag, int(last_modified.timestamp())
+
+    def get_not_modified(self, row: Optional[tuple]) -> Optional[HttpResponse]:
+        if row is None:
+            # the view's 404
+            return None
+        response = get_conditional_response(self.request, *self.get_validators(row))
+        return response and self.set_validators(response, row)
+
+    def set_validators(self, response, row: Optional[tuple]):
+        if row is None or response.status_code not in (200, 304):
+            return response
+        if not getattr(response, "is_rendered", True):
+            # after rendering, which may have made a CSRF secret
+            response.add_post_render_callback(
+                lambda response: self.set_validators(response, row)
+            )
+            return response
+        etag, last_modified = self.get_validators(row)
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+        patch_vary_headers(response, ("Cookie",))
+        return response
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return super().dispatch(request, *args, **kwargs)
+        if self.view_is_async:
+            return self.aconditional_dispatch(request, *args, **kwargs)
+
+        row = self.get_validator_row()
+        if response := self.get_not_modified(row):
+            return response
+        return self.set_validators(super().dispatch(request, *args, **kwargs), row)
+
+    async def aconditional_dispatch(self, request, *args, **kwargs):
+        row = await self.aget_validator_row()
+        if response := self.get_not_modified(row):
+            return response
+        response = await super().dispatch(request, *args, **kwargs)
+        return self.set_validators(response, row)
+
+
+def vary_on_cookie(response: HttpResponse) -> HttpResponse:
+    patch_vary_headers(response, ("Cookie",))
+    return response
 
-from .models import Category, Product, ProductType
 
+class CatalogCacheMixin:
+    # whole-page cache for anonymous visitors, keyed by the page's cache scopes
+    def get_cache_scopes(self) -> list[str]:
+        raise NotImplementedError
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.view_is_async:
+            return self.adispatch(request, *args, **kwargs)
+        # whether the page is shared depends on the cookies, so do caches
+        # downstream
+        return vary_on_cookie(self.cached_dispatch(request, *args, **kwargs))
+
+    def cached_dispatch(self, request, *args, **kwargs):
+        if not catalog_cache.is_page_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        key = catalog_cache.make_key(
+            "page", self.get_cache_scopes(), request.get_full_path()
+        )
+        if cached := catalog_cache.get_entry(key):
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        def store(response):
+            # a page with a CSRF token in it belongs to the visitor's cookie
+            if response.status_code == 200 and not request.META.get(
+                "CSRF_COOKIE_NEEDS_UPDATE"
+            ):
+                catalog_cache.set_entry(
+                    key, (response.content, response["Content-Type"])
+                )
+
+        response = super().dispatch(request, *args, **kwargs)
+        if getattr(response, "is_rendered", True):
+            store(response)
+        else:
+            response.add_post_render_callback(store)
+        return response
+
+    async def adispatch(self, request, *args, **kwargs):
+        return vary_on_cookie(await self.acached_dispatch(request, *args, **kwargs))
+
+    async def acached_dispatch(self, request, *args, **kwargs):
+        if not catalog_cache.is_page_cacheable(request):
+            return await super().dispatch(request, *args, **kwargs)
+
+        key = await catalog_cache.amake_key(
+            "page", self.get_cache_scopes(), request.get_full_path()
+        )
+        if cached := await catalog_cache.aget_entry(key):
+            content, content_type = cached
+            return HttpResponse(content, content_type=content_type)
+
+        # async views hand back rendered responses, see `render_now()`
+        response = await super().dispatch(request, *args, **kwargs)
+        if response.status_code == 200 and not request.META.get(
+            "CSRF_COOKIE_NEEDS_UPDATE"
+        ):
+            await catalog_cache.aset_entry(
+                key, (response.content, response["Content-Type"])
+            )
+        return response
+
+
+class AsyncViewMixin:
+    """
+    Async GET for the catalog views, served by ASGI without a worker thread.
+
+    Data is loaded with `aget_object()` and `aget_context_data()` where a view
+    has them. Template responses are rendered right away, see `render_now()`.
+    """
+
+    async def get(self, request, *args, **kwargs):
+        if isinstance(self, SingleObjectMixin):
+            self.object = await self.aget_object()
+        if hasattr(self, "aget_context_data"):
+            context = await self.aget_context_data(**kwargs)
+        else:
+            context = self.get_context_data(**kwargs)
+        return render_now(self.render_to_response(context))
+
+    async def aget_object(self):
+        queryset = self.get_queryset()
+        slug = self.kwargs[self.slug_url_kwarg]
+        try:
+            return await queryset.aget(**{self.get_slug_field(): slug})
+        except queryset.model.DoesNotExist:
+            raise Http404(f"No {queryset.model._meta.verbose_name} found.")
+
+
+class ProductPageMixin(CatalogCacheMixin):
+    # renders one keyset page of the `ProductCard` queryset `get_products()`,
+    # or JSON with `?format=json`
+    listing_ordering = ("name", "pk")
+
+    def get_products(self):
+        raise NotImplementedError
+
+    def get_paginator(self, page_size: int) -> KeysetPaginator:
+        return KeysetPaginator(
+            self.get_products(), page_size=page_size, ordering=self.listing_ordering
+        )
+
+    def get_listing_signature(self) -> str:
+        # anything besides the cursor and page size that changes the listing
+        return ""
+
+    def get_page_url(self, cursor: Optional[str]) -> Optional[str]:
+        return get_page_url(self.request, cursor)
+
+    def get_listing_key_parts(self) -> tuple:
+        return (
+            self.request.GET.get("cursor"),
+            get_page_size(self.request),
+            self.get_listing_signature(),
+        )
+
+    def get_page_context(self, page: KeysetPage) -> dict:
+        return {
+            "page": page,
+            "products": page.items,
+            "next_page_url": self.get_page_url(page.next_cursor),
+            "prev_page_url": self.get_page_url(page.prev_cursor),
+        }
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        cursor, page_size, signature = self.get_listing_key_parts()
+        key = catalog_cache.make_key(
+            "listing", self.get_cache_scopes(), cursor, page_size, signature
+        )
+        page: KeysetPage = catalog_cache.get_entry(key)
+        if page is None:
+            page = self.get_paginator(page_size).get_page(cursor)
+            catalog_cache.set_entry(key, page)
+        context.update(self.get_page_context(page))
+        return context
 
-class AllProductsView(TemplateView):
+    async def aget_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        cursor, page_size, signature = self.get_listing_key_parts()
+        key = await catalog_cache.amake_key(
+            "listing", self.get_cache_scopes(), cursor, page_size, signature
+        )
+        page: KeysetPage = await catalog_cache.aget_entry(key)
+        if page is None:
+            page = await self.get_paginator(page_size).aget_page(cursor)
+            await catalog_cache.aset_entry(key, page)
+        context.update(self.get_page_context(page))
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.request.GET.get("format") != "json":
+            return super().render_to_response(context, **response_kwargs)
+
+        return JsonResponse(self.get_json_data(context))
+
+    def get_json_data(self, context) -> dict:
+        page: KeysetPage = context["page"]
+        return {
+            "results": [card_json(card) for card in page],
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
+            "next": context["next_page_url"],
+            "previous": context["prev_page_url"],
+        }
+
+
+class AllProductsView(ProductPageMixin, TemplateView):
     template_name = "products/all_products.html"
 
+    def setup(self, request, *args, **kwargs):
+        super().setup(request, *args, **kwargs)
+        self.facet_filter = FacetFilter.from_request(request)
+
+    def get_cache_scopes(self) -> list[str]:
+        return [catalog_cache.ALL_PRODUCTS]
+
+    def get_products(self):
+        return self.facet_filter.apply(ProductCard.published.all())
+
+    def get_listing_signature(self) -> str:
+        return self.facet_filter.signature
+
+    def get_facet_url(self, facet: str, slug: str) -> str:
+        # toggles one facet value, back to the first page
+        query = self.request.GET.copy()
+        query.pop("cursor", None)
+        selected = query.getlist(facet)
+        query.setlist(
+            facet,
+            (
+                [value for value in selected if value != slug]
+                if slug in selected
+                else selected + [slug]
+            ),
+        )
+        return f"?{query.urlencode()}"
+
+    def get_facets(
+        self, facet_counts: dict[str, list[FacetCount]]
+    ) -> dict[str, list[dict]]:
+        return {
+            facet: [
+                {
+                    "slug": facet_count.slug,
+                    "name": facet_count.name,
+                    "count": facet_count.count,
+                    "selected": facet_count.slug
+                    in self.facet_filter.get_selected(facet),
+                    "url": self.get_facet_url(facet, facet_count.slug),
+                }
+                for facet_count in counts
+            ]
+            for facet, counts in facet_counts.items()
+        }
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["products"] = Product.objects.all()
+        catalog_cache.annotate_card_versions(context["products"])
+        context["catalog_cache_alias"] = settings.CATALOG_CACHE_ALIAS
+        context["facets"] = self.get_facets(count_facets(self.facet_filter))
         return context
 
+    async def aget_context_data(self, **kwargs):
+        context = await super().aget_context_data(**kwargs)
+        await catalog_cache.aannotate_card_versions(context["products"])
+        context["catalog_cache_alias"] = settings.CATALOG_CACHE_ALIAS
+        context["facets"] = self.get_facets(await acount_facets(self.facet_filter))
+        return context
+
+    def get_json_data(self, context) -> dict:
+        return super().get_json_data(context) | {"facets": context["facets"]}
 
-class FeaturedProductsView(TemplateView):
+
+class FeaturedProductsView(CatalogCacheMixin, TemplateView):
     template_name = "products/featured.html"
 
+    def get_cache_scopes(self) -> list[str]:
+        return [catalog_cache.ALL_PRODUCTS]
+
 
-class CategoryDetailView(DetailView):
+class CategoryDetailView(ConditionalGetMixin, ProductPageMixin, DetailView):
     template_name = "products/by_category.html"
     context_object_name = "category"
     model = Category
 
+    def get_validator_queryset(self):
+        return group_validators(Category, self.kwargs["slug"])
+
+    def get_cache_scopes(self) -> list[str]:
+        return [catalog_cache.category_scope(self.kwargs["slug"])]
+
+    def get_products(self):
+        return ProductCard.published.filter(
+            pk__in=Product.categories.through.objects.filter(
+                category=self.object
+            ).values("product_id")
+        )
+
 
-class ProductTypeDetailView(DetailView):
+class ProductTypeDetailView(ConditionalGetMixin, ProductPageMixin, DetailView):
     template_name = "products/by_type.html"
     context_object_name = "ptype"
     model = ProductType
 
+    def get_validator_queryset(self):
+        return group_validators(ProductType, self.kwargs["slug"])
 
-class ProductDetailView(DetailView):
+    def get_cache_scopes(self) -> list[str]:
+        return [catalog_cache.product_type_scope(self.kwargs["slug"])]
+
+    def get_products(self):
+        return ProductCard.published.filter(product_type=self.object)
+
+
+class ProductDetailView(ConditionalGetMixin, CatalogCacheMixin, DetailView):
     template_name = "products/product_detail.html"
     context_object_name = "product"
-    model = Product
+    queryset = Product.published.for_links()
+
+    def get_validator_queryset(self):
+        return Product.published.filter(slug=self.kwargs["slug"]).values_list(
+            "updated_at"
+        )
+
+    def get_cache_scopes(self) -> list[str]:
+        return [catalog_cache.product_scope(self.kwargs["slug"])]
+
+
+class ProductSearchView(CatalogCacheMixin, TemplateView):
+    template_name = "products/search.html"
+
+    def get_cache_scopes(self) -> list[str]:
+        return [catalog_cache.ALL_PRODUCTS]
+
+    def get_page_url(self, cursor: Optional[str]) -> Optional[str]:
+        return get_page_url(self.request, cursor)
+
+    def get_search_args(self) -> tuple:
+        return (
+            self.request.GET.get("q", "").strip(),
+            get_page_size(self.request),
+            self.request.GET.get("cursor"),
+        )
+
+    def get_search_context(self, query: str, page: KeysetPage) -> dict:
+        return {
+            "query": query,
+            "page": page,
+            "products": page.items,
+            "next_page_url": self.get_page_url(page.next_cursor),
+            "prev_page_url": self.get_page_url(page.prev_cursor),
+        }
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query, page_size, cursor = self.get_search_args()
+        page = search_products(query, page_size, cursor)
+        context.update(self.get_search_context(query, page))
+        return context
+
+    async def aget_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query, page_size, cursor = self.get_search_args()
+        # FTS5 needs raw SQL, which has no async API yet
+        page = await sync_to_async(search_products)(query, page_size, cursor)
+        context.update(self.get_search_context(query, page))
+        return context
+
+    def render_to_response(self, context, **response_kwargs):
+        if self.request.GET.get("format") != "json":
+            return super().render_to_response(context, **response_kwargs)
+
+        page: KeysetPage = context["page"]
+        return JsonResponse(
+            {
+                "query": context["query"],
+                "results": [
+                    product_json(product)
+                    | {
+                        "highlighted_name": product.highlighted_name,
+                        "highlighted_snippet": product.highlighted_snippet,
+                    }
+                    for product in page
+                ],
+                "next_cursor": page.next_cursor,
+                "prev_cursor": page.prev_cursor,
+                "next": context["next_page_url"],
+                "previous": context["prev_page_url"],
+            }
+        )
+
+
+# when served by ASGI with `settings.ASYNC_VIEWS` on
+class AsyncAllProductsView(AsyncViewMixin, AllProductsView):
+    pass
+
+
+class AsyncFeaturedProductsView(AsyncViewMixin, FeaturedProductsView):
+    pass
+
+
+class AsyncCategoryDetailView(AsyncViewMixin, CategoryDetailView):
+    pass
+
+
+class AsyncProductTypeDetailView(AsyncViewMixin, ProductTypeDetailView):
+    pass
+
+
+class AsyncProductDetailView(AsyncViewMixin, ProductDetailView):
+    pass
+
+
+class AsyncProductSearchView(AsyncViewMixin, ProductSearchView):
+    pass